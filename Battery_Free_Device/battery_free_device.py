@@ -8,13 +8,23 @@ import threading
 
 from utils.utils import *
 from utils.find import Find
+from utils.engine import charge_until, repeat_add
+from utils import rle
+from utils.scheduler import Until, WaitFor, Stall, Handshake
+from utils.topology import LinkScheduler
+from utils.nodestore import NodeStore, NodeView, StoreField, BONITO
+from utils import eventlog as ev
+from utils import profiling
 from utils.distributions import inverse_joint_cdf
+from utils.tasking import get_task, Packet, PacketBuffer
 
-from Battery_Free_Device.tasks import task_mapping
+import Battery_Free_Device.tasks # Registers the tasks of the nodes (see utils.tasking)
 
-class BatteryfreeDevice(object):
+class BatteryfreeDevice(NodeView):
     """Simple simulation model of a battery-free device.
 
+    The scalar state of the node (iteration, stored energy, protocol state, counters) lives in its row of the node store, the node itself is a view of that row with slots for its references (see utils.nodestore).
+
     Args:
         name (str):               name of the node
         capacity (float):           energy storage capacity (in farad)
@@ -27,29 +37,62 @@ class BatteryfreeDevice(object):
         max_offset (float):         length of the listening window of a node (after packet transmission for establishing connection with another node) (in secs)
         target_probability (float): 'Bonito' - degree of accuracy required in the connection intervals generated
         times_len (int):          length of the power trace array
+        conn_int_cache (IntervalCache): optional cache of connection intervals, shared between nodes (see utils.distributions.IntervalCache)
+        node_store (NodeStore):   store the scalar state of the node is kept in, shared by all the nodes of a simulation (default: a store of its own, see utils.nodestore)
+        kernel (str):             kernel driving the node, 'des' (default, see utils.scheduler.Scheduler) or 'threads' (see 'switchOn')
+        rng (np.random.Generator): random number generator of the node (default: global numpy state)
+        tasks (dict):             name of the node -> name of the task it runs, overriding the default one (see utils.tasking)
+        sink (str):               name of the node the packets produced by the tasks are ferried to (default: None, no packets)
+        buffer_size (int):        maximum no. of packets in the buffer of the node (default: 16)
+        tx_energy (float):        energy consumed to hand one packet over to a connected node (in joules, default: 1e-6)
 
     """
 
+    __slots__ = (
+        "name", "node_id", "Ts", "slot_length", "opt_scale_path", "max_offset", "_wait_slots", "target_probability", "conn_int_cache", "rng", "_charge_until", "times_len",
+        "node_task", "sink", "tx_energy", "buffer", "target_event", "on_target_set", "clock", "conn_ints", "bonito_tchrgs", "latencies",
+        "target_name", "_target_node", "target_dist", "target_awake", "barrier", "links", "link", "link_scheduler", "_link_chosen",
+        "pwr", "dist", "evlog", "awake", "dists", "nodes", "events",
+    )
+
+    # Scalar state kept in the row of the node store besides the columns of 'NodeView' (see utils.nodestore)
+    _target_is_set = StoreField("target_is_set")
+    _sleep_till_iteration = StoreField("sleep_till")
+    _wait_till_iteration = StoreField("wait_till")
+
+    _targets_lock = threading.Lock() # Serializes changes of the targets (e.g. from the GUI thread)
+
     def __init__(self, name, **kwargs):
+        self.name = name
+        self.node_id = node_index(name)
+        store = kwargs.get('node_store')
+        if store is None: store = NodeStore(1)
+        super().__init__(store, store.add(name, self.node_id))  # Row of the node in the store
+
         # Constants
-        self._capacity = kwargs['capacity']
-        self._von = kwargs['von']
-        self._voff = kwargs['voff']
-        self._vmax = kwargs['vmax']
+        capacity, von, voff, vmax = kwargs['capacity'], kwargs['von'], kwargs['voff'], kwargs['vmax']
 
-        self.energy_per_cycle = 0.5 * self._capacity * (self._von**2 - self._voff**2)       # Energy Threshold for node to wake up
-        self.max_energy_per_cycle = 0.5 * self._capacity * (self._vmax**2 - self._voff**2)  # Max Energy limit
+        self.energy_per_cycle = 0.5 * capacity * (von**2 - voff**2)       # Energy Threshold for node to wake up
+        self.max_energy_per_cycle = 0.5 * capacity * (vmax**2 - voff**2)  # Max Energy limit
         
         self.Ts = kwargs['Ts']
-        self.name = name
         self.slot_length = kwargs['slot_length']
         self.opt_scale_path = kwargs['opt_scale_path']
         self.max_offset = kwargs['max_offset']
         # self._wait_slots = secs_to_slots(self.max_offset, self.Ts) * 10
         self._wait_slots = secs_to_slots(self.max_offset, self.Ts)  # Converting wait time in secs to simulation time steps (or slots)
         self.target_probability = kwargs['target_probability']
+        self.conn_int_cache = kwargs.get('conn_int_cache')
+        self.rng = kwargs.get('rng')
+        self._charge_until = charge_until  # Charging engine of the sleep cycles (see utils.engine, utils.rle)
         self.times_len = kwargs['times_len']
-        self.lock = threading.Lock()
+        self.node_task = get_task(name, kwargs.get('tasks'))   # Task of the node with its cost (see utils.tasking)
+        self.sink = kwargs.get('sink')
+        self.tx_energy = kwargs.get('tx_energy', 1e-6)
+        threaded = kwargs.get('kernel', 'des') != 'des'
+        self.buffer = PacketBuffer(int(kwargs.get('buffer_size', 16)), threadsafe=threaded)  # Packets waiting to be handed over to a connected node
+        self.target_event = None                # Set while the node has a target (see 'target_is_set'), only created for nodes driven by a thread of their own (see 'switchOn')
+        self.on_target_set = None               # Optional callback when the node gets a target (set by the discrete-event scheduler)
 
         # State Variables
         self.currState = "Find"     # Current state of the node - Either 'Find' or 'Bonito'
@@ -57,37 +100,48 @@ class BatteryfreeDevice(object):
         self.prev_tchrg = 0         # Latest charging time of the node in secs.
         self.curr_conn_no = 0       # Variable to keep track of Bonito connections in the node logs
         self.target_is_set = False  # Keeps tarck of whether the current node has a target defined
+        self.wake_iteration = -1    # Iteration at which the node wakes up from its latest sleep cycle, published for the nodes waiting for it
+        self.stopped = False        # Set to end the state machine before the end of the power trace (see 'stop')
+        self.clock = 0              # Iteration the node has simulated up to, published to the thread of its target (thread driver only, see utils.scheduler.ThreadClock)
 
-        # Metadata
-        self.wakeup_cnt = 0         # No. of times the current node wakes up
-        self.bonito_wakeup_cnt = 0  # No. of times the current node wakes up in 'Bonito' state
-        self.connection_success = 0 # No. of successful connections
+        # Metadata (counters in the store: wakeup_cnt, bonito_wakeup_cnt, connection_success, task_runs, task_skips, energy_used, energy_drained, packets_generated, packets_dropped, packets_forwarded)
         self.conn_ints = [0]        # List of connection intervals generated
         self.bonito_tchrgs = []     # Charging time corresponding to the generated connection interval (i.e. time taken by the current node to charge when the corresponding connection interval time was generated)
+        self.latencies = []         # End-to-end latency of every packet received as destination (in secs)
 
         # Variables modified by external environment
         self.target_name = None     # Name of the target node
         self.target_node = None     # 'BatteryfreeDevice' object of the target node
         self.target_dist = None     # Charging time distribution of the target node
-        self.barrier = None         # threading.Barrier object shared between the current and target node
+        self.target_awake = None    # Awake status of the target node
+        self.barrier = None         # Rendezvous shared between the current and target node (see utils.scheduler.Rendezvous)
+
+        # Links to many neighbours (see 'setLinks' and utils.topology). The target is then the neighbour of the link being served.
+        self.links = None           # Name of the neighbour -> 'Link' (None for a single target)
+        self.link = None            # Link being served
+        self.link_scheduler = None  # Picks the link to serve next
+        self._link_chosen = False   # Whether the link to serve next was already picked
 
-    def setup(self, pwr, dists, nodes, fp_rt_logs, events):
-        """Store global variables and log file pointer.
+    def setup(self, pwr, dists, nodes, evlog, events):
+        """Store global variables and the event log.
 
         Args:
             pwr (dict):             Dictionary of power array of all nodes             
             dists (dict):           Dictionary of charging time distribution of all nodes
             nodes (dict):           Dictionary of 'BatteryfreeDevice' objects assciated with all nodes in the environment
-            fp_rt_logs (pointer):   Pointer of the log file of the current node
+            evlog (EventLog):       Event log shared by all nodes (see utils.eventlog)
             events (dict):          Dictionary of the awake status (event - boolean variable) of all nodes
         """
 
         # Constants
         self.pwr = pwr[self.name]               # power array of the current node
         self.dist = dists[self.name]            # charging time distribution of the current node
-        self.fp_rt_logs = fp_rt_logs[self.name]
+        self.evlog = evlog
         self.awake = events[self.name]          # awake status of the current node
 
+        # Run-length compacted traces are charged on segment by segment (see utils.rle)
+        if isinstance(self.pwr, rle.RunLengthDataset): self._charge_until = rle.charge_until
+
         # Global quantities
         self.dists = dists
         self.nodes = nodes
@@ -102,12 +156,15 @@ class BatteryfreeDevice(object):
 
         Args:
             target_name (string): Name of the target node
-            barrier (threading.Barrier): A synchronization object provided by the threading module used here as a means of simulating the event of a connection being established between two nodes (See threading.Barrier docs for more reference) 
+            barrier (Rendezvous): Meeting point in simulated time shared with the target node, used here as a means of simulating the event of a connection being established between two nodes (See utils.scheduler.Rendezvous)
         """
 
         self.curr_conn_no = 0
 
-        self.lock.acquire()
+        self._targets_lock.acquire()
+
+        # A single target replaces the links of the node
+        self.links, self.link, self.link_scheduler = None, None, None
 
         try:
             self.target_node.target_is_set = False
@@ -120,16 +177,190 @@ class BatteryfreeDevice(object):
         self.target_dist = self.dists[target_name]
         self.target_awake = self.events[target_name]
 
-        # Common Barrier for current and target Node
+        # Common Rendezvous for current and target Node
         self.barrier = barrier
+        barrier.join(self)
+
+        self._targets_lock.release()
+
+    def setLinks(self, links):
+        """Set the links to the neighbours the current node establishes Bonito connections with (many-to-many alternative to 'setTarget', see utils.topology). The node serves one link at a time, picked by earliest predicted connection, and keeps the Bonito state of the others in the links.
+
+        Args:
+            links (list): 'Link' objects of the node
+        """
+
+        self._targets_lock.acquire()
+
+        self.links = {link.other(self.name): link for link in links}
+        self.link = None
+        self.link_scheduler = LinkScheduler(self.name, links)
+        self._activate(self.link_scheduler.next(self.iteration, 0))
+        self._link_chosen = True
+
+        self._targets_lock.release()
+
+    def select_link(self):
+        """Switches to the link with the earliest predicted connection (see utils.topology.LinkScheduler). The state of the link served so far is kept in that link.
+        """
+
+        if self.link is not None:
+            end = self.link.end(self.name)
+            end.state, end.conn_no = self.currState, self.curr_conn_no
+            self.link_scheduler.update(self.link, self.iteration)
+
+        self._activate(self.link_scheduler.next(self.iteration, secs_to_slots(self.prev_tchrg, self.Ts)))
 
-        self.lock.release()
+    def _activate(self, link):
+        # The neighbour of the link becomes the target of the node
+        neighbour = link.other(self.name)
+        end = link.end(self.name)
+
+        self.link = link
+        self.target_name = neighbour
+        self.target_node = self.nodes[neighbour]
+        self.target_dist = self.dists[neighbour]
+        self.target_awake = self.events[neighbour]
+        self.barrier = link.rendezvous
+        self.barrier.join(self)
+
+        self.currState = end.state
+        self.curr_conn_no = end.conn_no
+
+    def log(self, code, peer=-1, arg=0, value=0.0):
+        """Appends an event of the current node at the current iteration to the event log.
+
+        Args:
+            code (int): event code (see utils.eventlog)
+            peer (int): id of the node the event refers to
+            arg (int): integer argument of the event
+            value (float): floating point argument of the event
+        """
+
+        self.evlog.append(self.iteration, self.node_id, code, peer, arg, value)
+
+    @property
+    def target_is_set(self):
+        return self._target_is_set
+
+    @target_is_set.setter
+    def target_is_set(self, value):
+        # Signals the nodes stalled for a target instead of letting them poll
+        self._target_is_set = value
+        event = self.target_event
+        if value:
+            if event is not None: event.set()
+            if self.on_target_set is not None: self.on_target_set()
+        elif event is not None:
+            event.clear()
+
+    @property
+    def target_node(self):
+        return self._target_node
+
+    @target_node.setter
+    def target_node(self, node):
+        # Mirrors the target in the node store (row of the target node, -1 if none or not in the same store)
+        self._target_node = node
+        self.store.target[self.index] = node.index if node is not None and node.store is self.store else -1
+
+    @property
+    def target_id(self):
+        # Id of the target node, -1 if the target was taken away by another node meanwhile
+        target_node = self.target_node
+        return target_node.node_id if target_node is not None else -1
 
     def task(self):
-        """Task to be performed by the node. This will vary with the specific use case. All tasks must be defined in the tasks.py file. Calls the task for the current node from the task.py file passing itself as the argument.
+        """Task to be performed by the node. This will vary with the specific use case. All tasks must be defined in the tasks.py file. Calls the task for the current node from the task.py file passing itself as the argument (nodes without a task do nothing). Generator, yields while the task takes simulated time.
+
+        1. Skips the task if the energy stored does not cover its cost.
+        2. Consumes the energy of the task and runs it.
+        3. Stays awake for the duration of the task (harvested energy is immediately consumed meanwhile).
+
+        The task runs at the end of a charging cycle, right before 'reset' drains the node to the turn-off threshold. Its energy is therefore paid from energy that would be drained anyway: it decides whether the task runs, but does not delay the next wake-up. 'energy_used' counts the energy of the tasks and hand-overs, 'energy_drained' what 'reset' discards after them.
         """
 
-        task_mapping.get(self.name)(self)
+        task = self.node_task
+        if task is None: return
+
+        if self.estored < task.energy:
+            self.task_skips += 1
+            self.log(ev.TASK_SKIPPED, value=task.energy)
+            return
+
+        self.estored -= task.energy
+        self.energy_used += task.energy
+        self.task_runs += 1
+        task(self)
+
+        if task.duration > 0:
+            self.iteration = min(self.iteration + secs_to_slots(task.duration, self.Ts), self.times_len)
+            yield Until(self.iteration)
+
+    def produce(self, dst=None):
+        """Produces a packet for a destination (default: the sink) and queues it in the buffer of the node, or drops it if the buffer is full. Called by the tasks.
+
+        Args:
+            dst (str): name of the destination node
+
+        Returns:
+            (boolean): Whether the packet was queued
+        """
+
+        dst = dst or self.sink
+        if dst is None or dst == self.name: return False
+
+        self.packets_generated += 1
+        if self.buffer.put(Packet(self.name, dst, self.iteration)): return True
+
+        self.packets_dropped += 1
+        self.log(ev.DROPPED, arg=len(self.buffer))
+        return False
+
+    def ferry(self):
+        """Hands the packets of the buffer over to the target node while connected, oldest first, as long as the energy stored covers 'tx_energy' per packet. Packets are not handed back to a node they already passed through, and stay in the buffer if the buffer of the target node is full.
+        """
+
+        target = self.target_node
+        handed = 0
+
+        while self.estored >= self.tx_energy:
+            packet = self.buffer.take(lambda packet: target.name not in packet.route)
+            if packet is None: break
+            if not target.receive(packet, self, self.iteration):
+                self.buffer.put_back(packet)
+                break
+
+            self.estored -= self.tx_energy
+            self.energy_used += self.tx_energy
+            handed += 1
+
+        if handed:
+            self.packets_forwarded += handed
+            self.log(ev.FERRIED, peer=target.node_id, arg=handed)
+
+    def receive(self, packet, sender, iteration):
+        """Takes a packet handed over by a connected node: records its latency if the current node is its destination, or queues it otherwise.
+
+        Args:
+            packet (Packet): packet handed over
+            sender (BatteryfreeDevice): node handing the packet over
+            iteration (int): iteration of the connection
+
+        Returns:
+            (boolean): Whether the packet was taken (False if the buffer is full)
+        """
+
+        if packet.dst != self.name:
+            if not self.buffer.put(packet): return False
+            packet.route.append(self.name)
+            return True
+
+        packet.route.append(self.name)
+        latency = (iteration - packet.created) * self.Ts
+        self.latencies.append(latency)
+        self.evlog.append(iteration, self.node_id, ev.DELIVERED, sender.node_id, packet.hops, latency)
+        return True
 
     @property
     def charged(self):
@@ -152,7 +383,7 @@ class BatteryfreeDevice(object):
         return self.estored >= self.max_energy_per_cycle
     
     def find(self):
-        """Defines the FIND protocol. This function is executed when the node is in the 'Find' state.
+        """Defines the FIND protocol. This function is executed when the node is in the 'Find' state. Generator, run as part of the state machine in 'run'.
 
         1. Sets the node to sleep till wake up energy threshold is reached.
         2. Checks if the target node is awake - If Yes, sets the state to 'Bonito' and returns.
@@ -164,8 +395,8 @@ class BatteryfreeDevice(object):
         """
 
         # Sleep till wake up energy threshold is reached
-        self.fp_rt_logs.write(f"Iteration {self.iteration}: {self.name} set to sleep for charging\n")            
-        self.sleep()
+        self.log(ev.SLEEP_CHARGE)
+        yield from self.sleep()
 
         # Check if the target node is awake
         if self.target_awake.is_set():
@@ -175,34 +406,39 @@ class BatteryfreeDevice(object):
 
         # If target node is not awake, sample random sleep time according to Find
         t_chr_slots = secs_to_slots(self.prev_tchrg, self.slot_length)
-        sleep_time_slots = Find(self.opt_scale_path, t_chr_slots)
+        prof = profiling.active
+        if prof: t0 = time.perf_counter()
+        sleep_time_slots = Find(self.opt_scale_path, t_chr_slots, rng=self.rng)
+        if prof:
+            prof.count("find_calls", node=self.name)
+            prof.add_time("find_calls", time.perf_counter() - t0, node=self.name)
         sleep_time_secs = slots_to_secs(sleep_time_slots, self.slot_length, self.Ts) * 10 
         # sleep_time_secs = slots_to_secs(sleep_time_slots, self.slot_length, self.Ts)
         sleep_time_slots = secs_to_slots(sleep_time_secs, self.slot_length)
 
         # Sleep for sampled amount of random sleep time
         self._sleep_till_iteration = self.iteration + sleep_time_slots
-        self.fp_rt_logs.write(f"Iteration {self.iteration}: {self.name} set to sleep by Find till {self._sleep_till_iteration} ({sleep_time_secs: .6f}s)\n")
-        self.sleep()
+        self.log(ev.SLEEP_FIND, arg=self._sleep_till_iteration, value=sleep_time_secs)
+        yield from self.sleep()
 
         # Wait for (max offset) time for the target node to wake up
         self._wait_till_iteration = self.iteration + self._wait_slots
-        self.fp_rt_logs.write(f"Iteration {self.iteration}: {self.name} waiting for Find discovery till {self._wait_till_iteration} ({self.max_offset}s)\n")
+        self.log(ev.WAIT_FIND, arg=self._wait_till_iteration, value=self.max_offset)
 
         # Waiting
-        if self.wait():
+        if (yield from self.wait()):
             self.currState = "Bonito"
             self.bonito_wakeup_cnt += 1
             return 
 
         # Target node did not wake up within the time limit. The node runs its dedicated function, drains out energy to the turn-off threshold and then resets
-        self.task()
+        yield from self.task()
         self.reset()
-        self.fp_rt_logs.write(f"Iteration {self.iteration}: {self.name} reset by Find\n")
+        self.log(ev.RESET_FIND)
 
     
     def bonito(self):
-        """Defines the BONITO protocol. This function is executed when the node is in the 'Bonito' state.
+        """Defines the BONITO protocol. This function is executed when the node is in the 'Bonito' state. Generator, run as part of the state machine in 'run'.
 
         1. Waits for (max offset) time for the target node to wake up.
         2. If the 'wait' function returns 'True', tries to establish connection with the target node (Runs the Bonito logic).
@@ -211,53 +447,71 @@ class BatteryfreeDevice(object):
 
         # Wait for (max offset) time for the target node to wake up
         self._wait_till_iteration = self.iteration + self._wait_slots
-        self.fp_rt_logs.write(f"Iteration {self.iteration}: {self.name} waiting for Bonito discovery till {self._wait_till_iteration} ({self.max_offset}s)\n")
+        self.log(ev.WAIT_BONITO, arg=self._wait_till_iteration, value=self.max_offset)
 
         # Waiting
-        if self.wait():
-            try:
-                # Barrier placed here so that this current node code execution will only proceed with the Bonito connection code if the target node code execution reaches this point of code too (an abstract way of simulating the establishing of connection). Else the connection will fail and the state will go back to Find.
-                self.barrier.wait(1) # The max wait time for the barrier is 1 sec here after which it will throw an BrokenBarrierError.
-                # self.barrier.wait(0.1)
-                self.barrier.reset()
-
-                # If execution reaches this point, that means current node has established connection with target node successfully (in any other case it will go into the except block)
-                # self.fp_rt_logs.write(f"{self.target_awake.is_set()}\n")
+        if (yield from self.wait()):
+            # Handshake placed here so that this current node code execution will only proceed with the Bonito connection code if the target node code execution reaches this point of code too, while the current node is still listening (an abstract way of simulating the establishing of connection). Else the connection will fail and the state will go back to Find.
+            connected, self.iteration = yield Handshake(self.barrier, self, self.iteration, self._wait_till_iteration)
+            if connected:
+                # If execution reaches this point, that means current node has established connection with target node successfully
                 self.curr_conn_no += 1
                 self.connection_success += 1
-                self.fp_rt_logs.write(f"Iteration {self.iteration} :{self.curr_conn_no} - Connected to {self.target_name}!\n")
+                self.log(ev.CONNECTED, peer=self.target_id, arg=self.curr_conn_no)
 
                 # Compute the next connection interval
-                conn_int = inverse_joint_cdf((self.dist, self.target_dist), self.target_probability)
+                prof = profiling.active
+                if prof:
+                    prof.set_node(self.name) # Bisection iterations are counted for the current node
+                    t0 = time.perf_counter()
+                partner_dist = self.link.learn(self.name, self.target_dist) if self.link is not None else self.target_dist # Model of the target exchanged while connected
+                conn_int = inverse_joint_cdf((self.dist, partner_dist), self.target_probability, self.conn_int_cache)
+                if prof:
+                    prof.count("ijcdf_calls", node=self.name)
+                    prof.add_time("ijcdf_calls", time.perf_counter() - t0, node=self.name)
                 self.conn_ints.append(conn_int)
                 self.bonito_tchrgs.append(self.prev_tchrg)
+
+                # Hand the buffered packets over to the target node while connected
+                self.ferry()
+                conn_iteration = self.iteration # Both nodes count the connection interval from the connection, whatever time their tasks take
                 
                 # The node runs its dedicated function, drains out energy to the turn-off threshold and then resets
-                self.task()
+                yield from self.task()
                 self.reset()
 
                 # Sleep for connection interval amount of time
-                self._sleep_till_iteration = self.iteration + secs_to_slots(conn_int, self.Ts)
-                self.fp_rt_logs.write(f"Iteration {self.iteration}: {self.name} reset and set to sleep by Bonito till {self._sleep_till_iteration} ({conn_int}s)\n")
-                self.sleep()
+                self._sleep_till_iteration = max(self.iteration, conn_iteration + secs_to_slots(conn_int, self.Ts))
+
+                if self.link is not None:
+                    # Nodes with links to many neighbours sleep till the next connection of any link instead
+                    self.link.connected(self.name, conn_iteration, conn_int, self._sleep_till_iteration)
+                    self.select_link()
+                    self._link_chosen = True
+                    if self.currState != "Bonito": return # The next link is still to be discovered
+
+                    due = max(self.iteration, self.link.end(self.name).due)
+                    if due != self._sleep_till_iteration: self._sleep_till_iteration, conn_int = due, (due - self.iteration) * self.Ts
+
+                self.log(ev.SLEEP_BONITO, arg=self._sleep_till_iteration, value=conn_int)
+                yield from self.sleep()
                 
                 return # Return placed here to indicate that the node sucessfully established connection with the target node
 
-            except:
-                # Nodes discovered each other but could not establish connnection
-                self.barrier.reset() 
-                self.fp_rt_logs.write(f"Barrier Broken Error\n")
+            # Nodes discovered each other but could not establish connnection
+            self.log(ev.HANDSHAKE_FAILED)
+            if profiling.active: profiling.active.count("barrier_timeouts", node=self.name)
 
         # If current node code execution reaches this point means that connection could not be established. Switch state to Find
         self.currState = "Find"
 
         # The node runs its dedicated function, drains out energy to the turn-off threshold and then resets
-        self.task()
+        yield from self.task()
         self.reset()
-        self.fp_rt_logs.write(f"Iteration {self.iteration}: Connection with {self.target_name} lost! {self.name} reset by Bonito\n")
+        self.log(ev.LOST, peer=self.target_id)
 
     def sleep(self):
-        """Defines the sleep activity cycle for the node
+        """Defines the sleep activity cycle for the node. Generator, yields till the iteration at which the node wakes up.
 
         1. Sets the awake status of current node to False.
         2. Goes into a low power sleep state till the sleep conditions are met (and harvests energy meanwhile).
@@ -266,34 +520,50 @@ class BatteryfreeDevice(object):
         5. Sets the awake status of current node to True.
         """
 
-        self.iteration += 1
+        # Hot path: the row of the node is read and written column by column once per sleep cycle, instead of through the fields of the node
+        store, row = self.store, self.index
+        iteration = store.iteration.item(row) + 1
+        store.iteration[row] = iteration
         self.awake.clear() # Set the awake status of current node to False
 
-        # Specifies the sleeping condition according to various scenarios
-        while (self.iteration < self.times_len) and ((not self.charged) or (self.iteration < self._sleep_till_iteration)):
-            # Harvest energy from incoming power
-            self.harvest(self.Ts * self.pwr[self.iteration], self.Ts)
-            self.iteration += 1
+        prof = profiling.active
+        if prof:
+            prof.set_node(self.name) # Cache misses of the trace are counted for the current node
+            t0, sleep_start = time.perf_counter(), iteration
+
+        # Harvest energy from incoming power till the node is charged and the sleep time is over (or the power trace ends). Equivalent to calling 'harvest' for every sample of the power trace, but vectorized.
+        iteration, estored, uncharged_slots = self._charge_until(self.pwr, self.Ts, iteration, self.times_len, store.estored.item(row), store.energy_per_cycle.item(row), store.max_energy_per_cycle.item(row), store.sleep_till.item(row))
+        if prof:
+            prof.count("sleep_samples", iteration - sleep_start, node=self.name)
+            prof.add_time("sleep_samples", time.perf_counter() - t0, node=self.name)
+        latest_tchrg = repeat_add(store.latest_tchrg.item(row), self.Ts, uncharged_slots)
+        store.estored[row] = estored
+        store.latest_tchrg[row] = latest_tchrg
+        store.iteration[row] = store.wake_iteration[row] = iteration
+        yield Until(iteration)
 
         # Node woke up
-        woke_up_msg = f"Iteration {self.iteration}: {self.name} woke up!"
-
-        if not self.latest_tchrg_flag:
-            self.fp_rt_logs.write(woke_up_msg + f" Charging time: {self.latest_tchrg: .6f}s\n")
-
-            self.wakeup_cnt += 1
-            if self.currState == "Bonito": self.bonito_wakeup_cnt += 1
-            self.dist.sgd_update(self.latest_tchrg)
-            self.prev_tchrg = self.latest_tchrg
-            self.latest_tchrg_flag = True
+        if not store.latest_tchrg_flag[row]:
+            self.log(ev.WOKE_CHARGED, value=latest_tchrg)
+
+            store.wakeup_cnt[row] += 1
+            if store.state[row] == BONITO: store.bonito_wakeup_cnt[row] += 1
+            prof = profiling.active
+            if prof: t0 = time.perf_counter()
+            self.dist.sgd_update(latest_tchrg)
+            if prof:
+                prof.count("sgd_updates", node=self.name)
+                prof.add_time("sgd_updates", time.perf_counter() - t0, node=self.name)
+            store.prev_tchrg[row] = latest_tchrg
+            store.latest_tchrg_flag[row] = True
 
         else:
-            self.fp_rt_logs.write(woke_up_msg + "\n")
+            self.log(ev.WOKE)
 
         self.awake.set() # Set the awake status of current node to True
 
     def wait(self):
-        """Defines the waiting for discovery cycle for the node
+        """Defines the waiting for discovery cycle for the node. Generator, yields till the target node wakes up or the wait time elapses.
 
         1. Waits till either wait time elapses or target node is discovered. Harvested energy is immediately consumed while waiting.
         2. If target node is discovered, return True.
@@ -304,13 +574,20 @@ class BatteryfreeDevice(object):
         """
         
         currState = self.currState
+        wait_start = self.iteration
 
         # Wait till either wait time elapses or target node is discovered
-        while (not self.target_awake.is_set()) and self.iteration <= self._wait_till_iteration:
-            self.fp_rt_logs.write(f"{currState} - Waiting for Discovery\n")
-            self.iteration += 1
-
-        # self.fp_rt_logs.write(f"{self.target_awake.is_set()}\n")
+        self.iteration = yield WaitFor(self.target_awake, wait_start, self._wait_till_iteration, self.target_node)
+
+        # Waiting records are only logged on request (see utils.eventlog verbosity levels)
+        n_waited = self.iteration - wait_start
+        if profiling.active: profiling.active.count("wait_samples", n_waited, node=self.name)
+        if self.evlog.verbosity >= ev.SUMMARY and n_waited > 0:
+            code = ev.WAITING_FIND if currState == "Find" else ev.WAITING_BONITO
+            if self.evlog.verbosity >= ev.PER_SAMPLE:
+                for i in range(wait_start, self.iteration): self.evlog.append(i, self.node_id, code, arg=1)
+            else:
+                self.evlog.append(wait_start, self.node_id, code, arg=n_waited)
 
         if self.iteration <= self._wait_till_iteration: return True # Target node found
         return False # Target node not found
@@ -332,18 +609,31 @@ class BatteryfreeDevice(object):
     def reset(self):
         """Deplete all energy of the node.
         Every device starts off with min energy corresponding to turn off voltage and every reset also brings it back to turn off voltage (voltage of the device never goes below turn off voltage). So we do not add that amount of energy in the self.estored and consider it as starting from 0 instead of starting from self.estored = 0.5 * self._capacity * (self._voff**2)
+        The energy left is added to 'energy_drained'.
         """
 
         self.latest_tchrg = 0
         self.latest_tchrg_flag = False
-        self.waiting = False
         self._sleep_till_iteration = 0
         self._wait_till_iteration = 0
+        self.energy_drained += self.estored
         self.estored = 0
         self.awake.clear() # Set the awake status of current node to False
     
-    def switchOn(self):
+    def stop(self):
+        """Ends the state machine of the node after its current request (e.g. when the simulation times out). Thread-safe.
+        """
+
+        self.stopped = True
+        self.iteration = self.times_len
+        if self.target_event is not None: self.target_event.set() # Wakes the node up if it is stalled for a target
+
+    def switchOn(self, clock):
         """Heart of the node. This is the function that gives this node life. Called by a dedicated thread for this node from the simulator code to enable parallel execution of all the nodes in the given power trace file.
+        Drives the state machine in 'run' on the calling thread: every request of the state machine is served as soon as the target node has simulated up to the iteration of the request. (See 'utils.scheduler.Scheduler' for the single-threaded discrete-event alternative)
+
+        Args:
+            clock (ThreadClock): clocks of the nodes driven by their own threads, shared by all the nodes of the simulation (see utils.scheduler.ThreadClock)
         """
 
         # try:
@@ -352,19 +642,41 @@ class BatteryfreeDevice(object):
         
         # except: pass
 
-        self.fp_rt_logs.write(f'{self.name} started at {time.time(): .6f}!\n')
+        # Only nodes driven by a thread of their own block on their target being set (see utils.scheduler.Stall)
+        self.target_event = threading.Event()
+        if self.target_is_set: self.target_event.set()
+
+        cycle = self.run()
+        value = None
+
+        try:
+            while True:
+                try: request = cycle.send(value)
+                except StopIteration: break
+                value = clock.serve(self, request)
+        finally:
+            clock.finish(self)
+
+    def run(self):
+        """State machine of the node as a generator. Yields a request (see 'utils.scheduler') whenever the node has to wait for simulated time to pass or for another node, and is resumed with the result of that request.
+        """
+
+        self.log(ev.STARTED, value=time.time())
 
-        while self.iteration < self.times_len:
+        while self.iteration < self.times_len and not self.stopped:
             if not self.target_is_set:
                 # If target node is not set yet, stall the iteration on the power trace till there is a target set.
                 self.reset()
-                time.sleep(1)
+                self.iteration = yield Stall(self)
                         
-            elif self.currState == "Find":
-                self.find()
-
             else:
-                self.bonito()
+                # Nodes with links to many neighbours switch links whenever they are free of the current one
+                if self.link_scheduler is not None and self.currState == "Find":
+                    if self._link_chosen: self._link_chosen = False
+                    else: self.select_link()
+
+                if self.currState == "Find": yield from self.find()
+                else: yield from self.bonito()
 
         # Iteration on the power trace completed. Marks the end of simulation for the current node. Reset it and change state to Find for GUI purposes.
         self.reset()
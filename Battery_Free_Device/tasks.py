@@ -1,39 +1,20 @@
 '''
-Define tasks to be performed by each node here.
-The number of functions to be defined is equal to the no. of nodes existing in the power trace.
+Define tasks to be performed by the nodes here.
+Tasks are registered with the 'task' decorator, together with the names of the nodes running them by default and the energy (in joules) and simulated time (in secs) one run of the task costs (see utils/tasking.py). Other nodes are assigned to a task by its name (args["tasks"], e.g. {"node3": "sense"}).
 The argument of the task function of a node is the 'BatteryfreeDevice' of that node itself. This is done so as to enable easy access the data being generated or stored by that node.
 '''
 
-def task0(curr_node):
-    curr_node.fp_rt_logs.write("Task 0 Completed!\n")
-    return
-
-def task1(curr_node):
-    curr_node.fp_rt_logs.write("Task 1 Completed!\n")
-    return
-
-def task2(curr_node):
-    curr_node.fp_rt_logs.write("Task 2 Completed!\n")
-    return
+from utils.eventlog import TASK
+from utils.tasking import task, tasks, task_mapping
 
-def task3(curr_node):
-    curr_node.fp_rt_logs.write("Task 3 Completed!\n")
+@task("node0", "node1", "node2", "node3", "node4", "node5")
+def log_task(curr_node):
+    curr_node.log(TASK, arg=curr_node.node_id)
     return
 
-def task4(curr_node):
-    curr_node.fp_rt_logs.write("Task 4 Completed!\n")
+@task(energy=5e-6, duration=1e-3)
+def sense(curr_node):
+    # Data ferrying: takes a reading and queues it as a packet for the sink of the network
+    curr_node.log(TASK, arg=curr_node.node_id)
+    curr_node.produce()
     return
-
-def task5(curr_node):
-    curr_node.fp_rt_logs.write("Task 5 Completed!\n")
-    return
-
-task_mapping = {
-                "node0": task0, 
-                "node1": task1, 
-                "node2": task2, 
-                "node3": task3, 
-                "node4": task4, 
-                "node5": task5 
-                }
-
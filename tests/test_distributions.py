@@ -0,0 +1,73 @@
+'''
+The streaming fits of the charging time models ('fit_stream' in utils/distributions.py) against calling 'sgd_update'
+for every sample, which they replace.
+'''
+
+import numpy as np
+import pytest
+
+from utils import distributions
+from utils.distributions import NormalDistribution, ExponentialDistribution, GaussianMixtureModel
+
+
+def reference(dist, xs):
+    # Per-sample updates of the model
+    trajectory = []
+    for x in xs:
+        dist.sgd_update(x)
+        trajectory.append(dist._mp.copy())
+    return np.array(trajectory)
+
+
+def charging_times(seed, n=3000):
+    rng = np.random.default_rng(seed)
+    return np.abs(np.concatenate((rng.normal(0.15, 0.03, n // 2), rng.normal(0.3, 0.05, n - n // 2))))
+
+
+def fit_both(make, xs, seed):
+    # Same model and rng for 'fit_stream' and the reference
+    streamed, expected = make(), make()
+    streamed.rng, expected.rng = np.random.default_rng(seed), np.random.default_rng(seed)
+    return streamed.fit_stream(xs), reference(expected, xs), streamed, expected
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_exponential_matches_reference(seed):
+    # eta=0.5 on long charging times hits the singularity (random restarts) every few samples
+    for eta, xs in ((0.01, charging_times(seed)), (0.5, np.random.default_rng(seed).exponential(10.0, 3000))):
+        trajectory, expected, streamed, _ = fit_both(lambda: ExponentialDistribution(np.array([10.0]), eta), xs, seed)
+        assert np.array_equal(trajectory, expected)
+        assert np.array_equal(streamed._mp, expected[-1])
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_gmm_matches_reference(seed):
+    trajectory, expected, streamed, _ = fit_both(GaussianMixtureModel, charging_times(seed), seed)
+    assert np.array_equal(trajectory, expected)
+    assert np.array_equal(streamed._mp, expected[-1])
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_normal_matches_reference(seed):
+    trajectory, expected, _, _ = fit_both(NormalDistribution, charging_times(seed), seed)
+    assert np.allclose(trajectory, expected, rtol=1e-10, atol=0)
+
+
+def test_scan_kernels_on_arrays():
+    # The compiled kernels get numpy arrays instead of python lists
+    xs = charging_times(0)
+    rates = np.zeros(len(xs))
+    assert distributions._exp_scan(xs, 0, 10.0, 0.01, rates) == (len(xs), rates[-1])
+    assert np.array_equal(rates[:, None], ExponentialDistribution().fit_stream(xs))
+
+    mp = GaussianMixtureModel()._mp
+    out = np.zeros(len(xs) * mp.size)
+    distributions._gmm_scan(xs, 0.001, mp[:, 0].copy(), mp[:, 1].copy(), mp[:, 2].copy(), np.zeros(len(mp)), out)
+    assert np.array_equal(out.reshape(len(xs), *mp.shape), GaussianMixtureModel().fit_stream(xs))
+
+
+def test_empty_stream():
+    for dist in (NormalDistribution(), ExponentialDistribution(), GaussianMixtureModel()):
+        params = dist._mp.copy()
+        assert len(dist.fit_stream([])) == 0
+        assert np.array_equal(dist._mp, params)
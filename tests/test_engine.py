@@ -0,0 +1,89 @@
+'''
+The vectorized charging engine ('utils.engine') and the run-length engine ('utils.rle') against the per-sample sleep
+loop they replace. Both have to match it bit for bit.
+'''
+
+import numpy as np
+import pytest
+
+from utils import engine, rle
+
+Ts = 1e-5
+E_ON = 0.5 * 17e-6 * (3.0**2 - 2.4**2)     # Wake-up threshold of the default node
+E_MAX = 0.5 * 17e-6 * (3.2**2 - 2.4**2)    # Clamp of the default node
+
+
+def reference(pwr, Ts, start, stop, estored, e_on, e_max, sleep_till):
+    # Per-sample sleep loop of 'BatteryfreeDevice' before the vectorized engine
+    it = start
+    latest_tchrg = 0.0
+    while (it < stop) and ((estored < e_on) or (it < sleep_till)):
+        if estored < e_max: estored += Ts * pwr[it]
+        if estored < e_on: latest_tchrg += Ts
+        it += 1
+    return it, estored, latest_tchrg
+
+
+def random_trace(rng, length, negative=False):
+    # Piecewise constant power (runs of zeros, weak and strong light), optionally with negative runs
+    runs = []
+    while sum(len(run) for run in runs) < length:
+        kind = rng.integers(4 if negative else 3)
+        value = (0.0, rng.uniform(0, 5e-4), rng.uniform(1e-3, 2e-2), -rng.uniform(0, 1e-3))[kind]
+        runs.append(np.full(int(rng.integers(1, 400)), value))
+    return np.concatenate(runs)[:length]
+
+
+def random_case(rng, negative=False):
+    length = int(rng.integers(1, 3000))
+    pwr = random_trace(rng, length, negative)
+    start = int(rng.integers(0, length))
+    stop = int(rng.integers(start, length + 1))
+    estored = float(rng.choice([0.0, rng.uniform(0, E_ON), rng.uniform(E_ON, E_MAX * 1.1)]))
+    sleep_till = int(rng.integers(start, stop + 100))
+    return pwr, start, stop, estored, sleep_till
+
+
+def check(charge_until, pwr, trace, start, stop, estored, sleep_till):
+    it, e, tchrg = reference(pwr, Ts, start, stop, estored, E_ON, E_MAX, sleep_till)
+    got_it, got_e, n_uncharged = charge_until(trace, Ts, start, stop, estored, E_ON, E_MAX, sleep_till)
+    assert (got_it, got_e, engine.repeat_add(0.0, Ts, n_uncharged)) == (it, e, tchrg)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_repeat_add(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(50):
+        x = float(rng.choice([0.0, rng.uniform(0, 1e-3), rng.uniform(0, 10)]))
+        step = float(rng.choice([Ts, rng.uniform(0, 1e-6), rng.uniform(0, 1)]))
+        n = int(rng.integers(0, 2000))
+
+        expected = x
+        for _ in range(n): expected += step
+        assert engine.repeat_add(x, step, n) == expected
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("negative", [False, True])
+def test_engine_matches_reference(seed, negative):
+    rng = np.random.default_rng(seed)
+    for _ in range(100):
+        pwr, start, stop, estored, sleep_till = random_case(rng, negative)
+        check(lambda *a: engine.charge_until(*a, block_size=int(rng.integers(1, 64)), max_block_size=256), pwr, pwr, start, stop, estored, sleep_till)
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("negative", [False, True])
+def test_rle_matches_reference(seed, negative):
+    rng = np.random.default_rng(100 + seed)
+    for _ in range(100):
+        pwr, start, stop, estored, sleep_till = random_case(rng, negative)
+        trace = rle.RunLengthDataset(*rle.compact(pwr), len(pwr))
+        check(rle.charge_until, pwr, trace, start, stop, estored, sleep_till)
+
+
+def test_rle_expands_to_trace():
+    pwr = random_trace(np.random.default_rng(0), 5000, negative=True)
+    trace = rle.RunLengthDataset(*rle.compact(pwr, block_size=700), len(pwr))
+    assert np.array_equal(trace[:], pwr)
+    assert np.array_equal(trace[123:4567], pwr[123:4567])
@@ -0,0 +1,24 @@
+'''
+The table of optimized scales of 'Find' ('utils.find'): tables are parsed once per path, and parsed again after
+'utils.opt_table' rewrote the file.
+'''
+
+import numpy as np
+
+from utils import find, opt_table
+
+
+def table(scale):
+    return {t_chr: (scale, 100.0) for t_chr in range(10, 210, 10)}
+
+
+def test_rewritten_table_is_parsed_again(tmp_path):
+    path = str(tmp_path / "opt_scale.csv")
+
+    opt_table.write_table(path, table(0.1))
+    first = find.load_table(path)
+    assert np.allclose(first, 0.1)
+    assert find.load_table(path) is first
+
+    opt_table.write_table(path, table(0.2))
+    assert np.allclose(find.load_table(path), 0.2)
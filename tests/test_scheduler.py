@@ -0,0 +1,90 @@
+'''
+The simulation kernels ('utils.scheduler'): runs of the discrete-event kernel with the same seed give the same results,
+and the thread driver gives the same connection counts up to the order of nodes at the same iteration.
+'''
+
+import os
+import time
+import shutil
+
+import pytest
+
+from utils import simulation
+from utils.scheduler import Scheduler, Until
+from utils.synth import SyntheticTraces, OnOffMarkov
+
+UTILS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "utils")
+
+
+@pytest.fixture
+def abs_path(tmp_path):
+    # Folder layout 'simulate' expects under args["abs_path"]
+    root = tmp_path / "battery-free-network-simulator"
+    (root / "logs").mkdir(parents=True)
+    (root / "utils").mkdir()
+    shutil.copy(os.path.join(UTILS, "opt_scale.csv"), root / "utils")
+    return str(tmp_path) + "/"
+
+
+def simulate(abs_path, seed, kernel="des", sim_time=0.2):
+    """Simulates two pairs of nodes on synthetic on/off traces.
+
+    Returns:
+        (dict): wakeups, connections and connection intervals per node name
+    """
+
+    traces = SyntheticTraces(OnOffMarkov(), 4, int(60 * sim_time * 1e5), seed=seed)
+    args = {
+        "abs_path": abs_path, "trace_file": "pwr_synth.h5", "traces": traces, "seed": seed, "run_name": f"{kernel}{seed}",
+        "slot_length": 1e-5, "target_probability": 0.99, "max_offset": 0.000848, "sim_time": sim_time,
+        "capacity": 17e-6, "von": 3.0, "voff": 2.4, "vmax": 3.2, "show_GUI": False, "create_plots": False,
+        "pairs": [["node0", "node1"], ["node2", "node3"]], "kernel": kernel, "timeout": 600,
+    }
+    summary = simulation.simulate(args)
+    return {name: (results["wakeups"], results["connections"], list(simulation.nodes[name].conn_ints)) for name, results in summary.items()}
+
+
+def test_scheduler_order():
+    # Events run in order of iteration, events of the same iteration in order of insertion
+    scheduler = Scheduler()
+    trace = []
+
+    def node(name, wakeups):
+        for iteration in wakeups:
+            yield Until(iteration)
+            trace.append((scheduler.now, name))
+
+    scheduler.spawn(node("a", [5, 10, 10]))
+    scheduler.spawn(node("b", [3, 10, 12]))
+    scheduler.run()
+
+    assert trace == [(3, "b"), (5, "a"), (10, "b"), (10, "a"), (10, "a"), (12, "b")]
+
+
+@pytest.mark.parametrize("seed", [1, 2])
+def test_des_deterministic(abs_path, seed):
+    first = simulate(abs_path, seed)
+    assert any(connections for _, connections, _ in first.values())
+    assert simulate(abs_path, seed) == first
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_threads_match_des(abs_path, seed):
+    des = simulate(abs_path, seed, "des")
+    threads = simulate(abs_path, seed, "threads")
+
+    for name, (wakeups, connections, _) in des.items():
+        thread_wakeups, thread_connections, _ = threads[name]
+        assert abs(thread_connections - connections) <= max(2, 0.2 * connections), name
+        assert abs(thread_wakeups - wakeups) <= max(5, 0.2 * wakeups), name
+
+
+@pytest.mark.parametrize("kernel", ["des", "threads"])
+def test_node_error_ends_simulation(abs_path, kernel):
+    # Without opt_scale.csv the first Find call of every node fails
+    os.remove(abs_path + "battery-free-network-simulator/utils/opt_scale.csv")
+
+    start = time.time()
+    with pytest.raises(FileNotFoundError):
+        simulate(abs_path, 1, kernel)
+    assert time.time() - start < 60
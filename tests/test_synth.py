@@ -0,0 +1,49 @@
+'''
+Synthetic traces ('utils.synth'): the lazily generated 'SyntheticTraces' give the samples of the process run block by
+block, in whatever order the nodes read them, and the vectorized layout of the runs keeps the statistics of the runs.
+'''
+
+import numpy as np
+import pytest
+
+from utils import synth
+
+
+def sequential(process, n_nodes, n_samples, block_length, seed):
+    # All the blocks of the process, in order
+    process.reset(n_nodes, np.random.default_rng(seed))
+    return np.concatenate([process.next(min(n_samples, start + block_length) - start) for start in range(0, n_samples, block_length)], axis=1)
+
+
+@pytest.mark.parametrize("make", [
+    lambda: synth.OnOffMarkov(p_on=1e-3, p_off=1e-3, noise=0.1),
+    lambda: synth.ChargingTimeProcess("gmm"),
+    lambda: synth.Correlated(synth.OnOffMarkov(), 0.3, hold=7),
+])
+def test_lazy_traces_match_sequential(make):
+    n_nodes, n_samples = 5, 50_000
+    traces = synth.SyntheticTraces(make(), n_nodes, n_samples, seed=4, block_bytes=8 * n_nodes * 3000, cache_blocks=2)
+    expected = sequential(make(), n_nodes, n_samples, traces.block_length, 4)
+
+    # Reads at random, so that dropped blocks are generated again
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        i = int(rng.integers(n_nodes))
+        start = int(rng.integers(n_samples))
+        stop = int(rng.integers(start, n_samples + 1))
+        assert np.array_equal(traces[f"node{i}"][start:stop], expected[i, start:stop])
+
+    assert traces["node2"][n_samples - 1] == expected[2, -1]
+    assert len(traces._blocks) <= 2
+
+
+@pytest.mark.parametrize("mean_run", [None, 1e9])
+def test_markov_runs(mean_run):
+    # mean_run=1e9 draws too few runs at a time, so every block takes many rounds
+    process = synth.OnOffMarkov(p_on=1e-2, p_off=2e-2)
+    if mean_run: process.mean_run = mean_run
+    process.reset(200, np.random.default_rng(0))
+    on = np.concatenate([process.next(length) for length in (1, 7, 5000, 30000, 1, 15000)], axis=1) > 0
+
+    assert on.mean() == pytest.approx(1 / 3, rel=0.02)
+    assert (np.diff(on, axis=1)).mean() == pytest.approx(2 / (1 / 1e-2 + 1 / 2e-2), rel=0.02)
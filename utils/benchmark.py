@@ -0,0 +1,325 @@
+'''
+Benchmarks of the simulator on synthetic traces (no recorded data needed, see utils/synth.py).
+
+    sleep.numpy                 samples/s of the sleep cycle of a 'BatteryfreeDevice' (vectorized charging engine)
+    find                        latency of a 'Find' call
+    ijcdf.<model>-<model>       latency of 'inverse_joint_cdf' for every pair of charging time models
+    fit.<model>                 samples/s of 'fit_stream' of every charging time model (compiled with numba if installed)
+    cached.<pattern>            samples/s read from a 'CachedDataset', sequentially (single samples and blocks) and at random
+    model_cdf.n<nodes>.s<slots> time of 'Model.cdf' for numbers of nodes and slots
+    scaling.n<nodes>            simulated secs per wall-clock sec of a whole simulation of 2 to N nodes
+    memory.per_node             bytes allocated per node of a large population (node object, row of the node store,
+                                awake status and packet buffer, see utils/nodestore.py)
+
+Every measurement is repeated and the best repetition is kept. The results are written to a json file, and compared
+with the results of an earlier run (e.g. of the main branch) to catch performance regressions:
+
+    python -m utils.benchmark --out bench.json [--baseline main.json] [--tolerance 0.2] [--only sleep find] [--quick]
+
+The command exits with status 1 if any benchmark got slower than the baseline by more than the tolerance.
+'''
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import contextlib
+from itertools import combinations_with_replacement
+
+import h5py
+import numpy as np
+
+from utils import synth
+from utils.utils import CachedDataset
+from utils.eventlog import EventLog
+from utils.find import Find
+from utils.model import Model
+from utils.distributions import NormalDistribution, ExponentialDistribution, GaussianMixtureModel, inverse_joint_cdf
+
+_opt_scale_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "opt_scale.csv")
+
+_model_map = {"norm": NormalDistribution, "exp": ExponentialDistribution, "gmm": GaussianMixtureModel}
+
+# Node parameters of the benchmarks (defaults of the command line GUI)
+_node_params = dict(capacity=17e-6, von=3.0, voff=2.4, vmax=3.2, Ts=1e-5, slot_length=1e-5, max_offset=0.000848, target_probability=0.99)
+
+# Sizes of the benchmarks, full and quick (--quick)
+_sizes = {
+    False: dict(repeat=5, sleep_samples=20_000_000, calls=2000, read_samples=2_000_000, model_nodes=(2, 4, 8), model_slots=(10_000, 100_000), max_nodes=32, sim_secs=30.0, memory_nodes=10_000, fit_samples=1_000_000),
+    True: dict(repeat=3, sleep_samples=2_000_000, calls=200, read_samples=200_000, model_nodes=(2, 4), model_slots=(10_000,), max_nodes=8, sim_secs=5.0, memory_nodes=1000, fit_samples=100_000),
+}
+
+# Registered benchmarks, in the order they are run
+benchmarks = {}
+
+
+def benchmark(name):
+    """Registers a benchmark. The benchmark takes the sizes (see '_sizes') and the directory for temporary files, and
+    returns its results as a dict of result name -> (value, unit, whether higher values are better)."""
+
+    def register(fn):
+        benchmarks[name] = fn
+        return fn
+    return register
+
+
+def best_of(fn, repeat):
+    """Shortest wall-clock secs of 'repeat' calls of fn."""
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+@benchmark("sleep")
+def bench_sleep(sizes, tmp_dir):
+    # Import here, the node module pulls in the tasks of the nodes
+    from Battery_Free_Device.battery_free_device import BatteryfreeDevice
+
+    n = sizes["sleep_samples"]
+    traces = synth.SyntheticTraces(synth.OnOffMarkov(p_on=2e-5, p_off=2e-5), 1, n, seed=0)
+    evlog = EventLog(os.path.join(tmp_dir, "sleep_events.npy"))
+
+    node = BatteryfreeDevice("node0", opt_scale_path=_opt_scale_path, times_len=n, **_node_params)
+    with contextlib.redirect_stdout(io.StringIO()):
+        node.setup({"node0": traces["node0"]}, {"node0": NormalDistribution()}, {"node0": node}, evlog, {"node0": threading.Event()})
+
+    def run():
+        node.iteration = 0
+        while node.iteration < n:
+            node.reset()
+            for _ in node.sleep(): pass
+
+    run() # Warms up the engine
+    results = {"sleep.numpy": (n / best_of(run, sizes["repeat"]), "samples/s", True)}
+
+    evlog.close()
+    return results
+
+
+@benchmark("find")
+def bench_find(sizes, tmp_dir):
+    rng = np.random.default_rng(0)
+    t_chrs = rng.integers(10, 2500, sizes["calls"])
+    Find(_opt_scale_path, 100, rng=rng) # Parses the table of optimized scales
+
+    def run():
+        for t_chr in t_chrs: Find(_opt_scale_path, int(t_chr), rng=rng)
+
+    return {"find": (best_of(run, sizes["repeat"]) / len(t_chrs), "s/call", False)}
+
+
+@benchmark("ijcdf")
+def bench_inverse_joint_cdf(sizes, tmp_dir):
+    n_calls = max(1, sizes["calls"] // 10)
+
+    results = {}
+    for model1, model2 in combinations_with_replacement(sorted(_model_map), 2):
+        dists = (_model_map[model1](), _model_map[model2]())
+        elapsed = best_of(lambda: [inverse_joint_cdf(dists, _node_params["target_probability"]) for _ in range(n_calls)], sizes["repeat"])
+        results[f"ijcdf.{model1}-{model2}"] = (elapsed / n_calls, "s/call", False)
+    return results
+
+
+@benchmark("fit")
+def bench_fit_stream(sizes, tmp_dir):
+    xs = np.abs(np.random.default_rng(0).normal(0.15, 0.05, sizes["fit_samples"]))
+    _model_map["exp"]().fit_stream(xs[:10]) # Compiles the scan kernels (numba)
+    _model_map["gmm"]().fit_stream(xs[:10])
+
+    results = {}
+    for name, model in sorted(_model_map.items()):
+        results[f"fit.{name}"] = (len(xs) / best_of(lambda: model().fit_stream(xs), sizes["repeat"]), "samples/s", True)
+    return results
+
+
+@benchmark("cached")
+def bench_cached_dataset(sizes, tmp_dir):
+    n = sizes["read_samples"]
+    path = os.path.join(tmp_dir, "cached.h5")
+    synth.write_h5(path, synth.OnOffMarkov(noise=0.1), 1, 4 * n, seed=0)
+
+    results = {}
+    with h5py.File(path, "r") as hf:
+        dataset = hf["data/node0"]
+        idx = np.random.default_rng(0).integers(0, len(dataset), n // 100).tolist()
+        block = 10_000
+
+        def sequential():
+            ds = CachedDataset(dataset, cache_size=1 << 20)
+            for i in range(n): ds[i]
+
+        def blocks():
+            ds = CachedDataset(dataset, cache_size=1 << 20)
+            for i in range(0, 4 * n, block): ds[i : i + block]
+
+        def random():
+            ds = CachedDataset(dataset, cache_size=1 << 16)
+            for i in idx: ds[i]
+
+        results["cached.sequential"] = (n / best_of(sequential, sizes["repeat"]), "samples/s", True)
+        results["cached.blocks"] = (4 * n / best_of(blocks, sizes["repeat"]), "samples/s", True)
+        results["cached.random"] = (len(idx) / best_of(random, sizes["repeat"]), "samples/s", True)
+    return results
+
+
+@benchmark("model_cdf")
+def bench_model_cdf(sizes, tmp_dir):
+    results = {}
+    for n_nodes in sizes["model_nodes"]:
+        for n_slots in sizes["model_slots"]:
+            model = Model(0.01, "Geometric", 100, n_nodes=n_nodes, offset=0, n_slots=n_slots, n_jobs=1)
+            results[f"model_cdf.n{n_nodes}.s{n_slots}"] = (best_of(model.cdf, sizes["repeat"]), "s", False)
+    return results
+
+
+def _simulation_root(tmp_dir):
+    # Directory layout 'simulate' expects below 'abs_path' (logs and the table of optimized scales)
+    root = os.path.join(tmp_dir, "battery-free-network-simulator")
+    os.makedirs(os.path.join(root, "logs"), exist_ok=True)
+    os.makedirs(os.path.join(root, "utils"), exist_ok=True)
+    shutil.copy(_opt_scale_path, os.path.join(root, "utils", "opt_scale.csv"))
+    return tmp_dir + os.sep
+
+
+@benchmark("scaling")
+def bench_scaling(sizes, tmp_dir):
+    from utils.simulation import simulate
+
+    abs_path = _simulation_root(tmp_dir)
+    n_samples = int(sizes["sim_secs"] / _node_params["Ts"])
+
+    results = {}
+    n_nodes = 2
+    while n_nodes <= sizes["max_nodes"]:
+        traces = synth.SyntheticTraces(synth.OnOffMarkov(), n_nodes, n_samples, seed=0)
+        pairs = [[f"node{i}", f"node{i + 1}"] for i in range(0, n_nodes, 2)]
+
+        def run():
+            args = dict(_node_params, abs_path=abs_path, trace_file="pwr_bench.h5", traces=traces, pairs=pairs, seed=1,
+                        sim_time=sizes["sim_secs"] / 60, show_GUI=False, create_plots=False, timeout=None, log_verbosity=0)
+            with contextlib.redirect_stdout(io.StringIO()): simulate(args)
+
+        results[f"scaling.n{n_nodes}"] = (sizes["sim_secs"] / best_of(run, max(1, sizes["repeat"] // 2)), "sim s/s", True)
+        n_nodes *= 2
+    return results
+
+
+@benchmark("memory")
+def bench_memory(sizes, tmp_dir):
+    from Battery_Free_Device.battery_free_device import BatteryfreeDevice
+    from utils.nodestore import NodeStore
+    from utils.scheduler import Scheduler
+
+    n = sizes["memory_nodes"]
+    names = [f"node{i}" for i in range(n)]
+    scheduler = Scheduler()
+    evlog = EventLog(os.path.join(tmp_dir, "memory_events.npy"))
+    pwr = dict.fromkeys(names, np.zeros((1,)))
+    dists = dict.fromkeys(names)
+
+    # Nodes as set up by 'utils.simulation.simulate' for the discrete-event kernel, without traces and models
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = NodeStore(n)
+    nodes = {name: BatteryfreeDevice(name, opt_scale_path=_opt_scale_path, times_len=1, node_store=store, **_node_params) for name in names}
+    events = {name: scheduler.event() for name in names}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for node in nodes.values(): node.setup(pwr, dists, nodes, evlog, events)
+    per_node = (tracemalloc.get_traced_memory()[0] - before) / n
+    tracemalloc.stop()
+
+    evlog.close()
+    return {"memory.per_node": (per_node, "bytes", False)}
+
+
+def run_benchmarks(names=None, quick=False):
+    """Runs benchmarks.
+
+    Args:
+        names (list): benchmarks to run (default: all, see 'benchmarks')
+        quick (bool): smaller sizes, for a fast check
+
+    Returns:
+        (dict): metadata of the run ('meta') and the results ('results', result name -> {"value", "unit", "higher_is_better"})
+    """
+
+    sizes = _sizes[quick]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in names or list(benchmarks):
+            if name not in benchmarks: raise ValueError(f"Unknown benchmark '{name}'")
+            for key, (value, unit, higher_is_better) in benchmarks[name](sizes, tmp_dir).items():
+                results[key] = {"value": float(value), "unit": unit, "higher_is_better": higher_is_better}
+                print(f"{key:<28}{value:>14.4g} {unit}")
+
+    meta = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "quick": quick,
+    }
+    return {"meta": meta, "results": results}
+
+
+def compare(current, baseline, tolerance=0.2):
+    """Compares the results of two runs of the benchmarks.
+
+    Args:
+        current (dict): results of the current run (see 'run_benchmarks')
+        baseline (dict): results of the baseline run
+        tolerance (float): relative slowdown tolerated before a result counts as regression
+
+    Returns:
+        (list): one row (dict) per result of both runs, with the values, the speedup over the baseline (> 1 is faster) and whether it regressed
+    """
+
+    rows = []
+    for key, result in current["results"].items():
+        base = baseline["results"].get(key)
+        if base is None: continue
+
+        value, base_value = result["value"], base["value"]
+        if value <= 0 or base_value <= 0: speedup = float("nan")
+        else: speedup = value / base_value if result["higher_is_better"] else base_value / value
+
+        rows.append({"name": key, "baseline": base_value, "current": value, "unit": result["unit"], "speedup": speedup, "regression": speedup < 1 - tolerance})
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the simulator on synthetic traces")
+    parser.add_argument("--out", default="bench.json", help="json file the results are written to")
+    parser.add_argument("--baseline", default=None, help="json file of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown tolerated before a result counts as regression")
+    parser.add_argument("--only", nargs="+", default=None, choices=list(benchmarks), help="benchmarks to run (default: all)")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes, for a fast check")
+    cli_args = parser.parse_args()
+
+    current = run_benchmarks(cli_args.only, cli_args.quick)
+    with open(cli_args.out, "w") as fp: json.dump(current, fp, indent=2)
+    print(f"Results written to {os.path.abspath(cli_args.out)}")
+
+    if cli_args.baseline:
+        with open(cli_args.baseline) as fp: baseline = json.load(fp)
+
+        rows = compare(current, baseline, cli_args.tolerance)
+        for row in rows:
+            flag = "  REGRESSION" if row["regression"] else ""
+            print(f"{row['name']:<28}{row['baseline']:>12.4g} -> {row['current']:<12.4g}{row['unit']:<10}x{row['speedup']:.2f}{flag}")
+
+        n_regressions = sum(row["regression"] for row in rows)
+        print(f"{n_regressions} regression(s) out of {len(rows)} results (tolerance {cli_args.tolerance:.0%})")
+        if n_regressions: sys.exit(1)
@@ -55,3 +55,65 @@ def bisection(fn, a: float, b: float, tol: float = 1e-3, max_iter: int = 100, cr
         else:
             b = c
     raise RuntimeError("bisection did not converge")
+
+
+def newton_bisection(fn, a: float, b: float, xtol: float = 1e-9, ftol: float = 1e-9, max_iter: int = 100):
+    """Finds the root of a function in the given interval using Newton's method safeguarded by bisection.
+
+    Newton steps are taken whenever they stay inside the current bracket and shrink it fast enough. Otherwise the
+    bracket is bisected. Converges quadratically close to the root, but never leaves the bracket.
+
+    Args:
+        fn: target function, returns a tuple of the value and the derivative of the function
+        a: lower interval bracket
+        b: upper interval bracket
+        xtol: required (relative) tolerance of the solution for convergence
+        ftol: required absolute tolerance of the function value for convergence
+        max_iter: maximum number of iterations
+
+    Returns:
+        Number of iterations and solution
+    """
+    fa, dfa = fn(a)
+    fb, dfb = fn(b)
+
+    if abs(fb) < ftol:
+        return 0, b
+    if abs(fa) < ftol:
+        return 0, a
+
+    if a > b:
+        raise ValueError("a must be less than b")
+
+    if fa * fb > 0:
+        raise ValueError("f(a) and f(b) must have different signs")
+
+    # Orient the bracket so that fn(lo) < 0 < fn(hi)
+    lo, hi = (a, b) if fa < 0 else (b, a)
+
+    # Start from the bracket end closer to the root
+    x, fx, dfx = (a, fa, dfa) if abs(fa) < abs(fb) else (b, fb, dfb)
+    dx_old = abs(b - a)
+    dx = dx_old
+
+    for it in range(1, max_iter):
+        if ((x - hi) * dfx - fx) * ((x - lo) * dfx - fx) > 0 or abs(2 * fx) > abs(dx_old * dfx):
+            dx_old = dx
+            dx = (hi - lo) / 2
+            x = lo + dx
+        else:
+            dx_old = dx
+            dx = fx / dfx
+            x = x - dx
+
+        if abs(dx) < xtol * max(1.0, abs(x)):
+            return it, x
+
+        fx, dfx = fn(x)
+        if abs(fx) < ftol:
+            return it, x
+        if fx < 0:
+            lo = x
+        else:
+            hi = x
+    raise RuntimeError("newton bisection did not converge")
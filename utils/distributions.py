@@ -1,16 +1,142 @@
+import math
 import numpy as np
-from scipy.stats import expon
 from scipy.stats import norm
+from scipy.special import ndtr, ndtri
+from scipy.signal import lfilter, fftconvolve
+from statistics import NormalDist
 import warnings
+import threading
+from collections import OrderedDict
 
-from utils.bisection import bisection
+from utils.bisection import bisection, newton_bisection
 from utils.bisection import crit_lt, crit_abs, crit_gt
+from utils import profiling
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+_SQRT2 = math.sqrt(2.0)
+_SQRT2PI = math.sqrt(2.0 * math.pi)
+
+# Lean replacements of scipy.stats.norm/expon. Scalars are evaluated with the math module, which avoids the argument
+# validation of scipy.stats (~50-100 us per call). Arrays use the ufuncs of scipy.special that scipy.stats wraps. Both
+# agree with scipy.stats within 1e-15 (absolute) for cdf values and 1e-12 (relative) for pdf values and quantiles.
+
+def _sqrt(var):
+    return math.sqrt(var) if var >= 0 else math.nan
+
+
+def norm_cdf(x, loc: float, scale: float):
+    if hasattr(x, "__len__"):
+        return ndtr((np.asarray(x) - loc) / scale)
+    return 0.5 * math.erfc((loc - x) / (scale * _SQRT2))
+
+
+def norm_pdf(x, loc: float, scale: float):
+    if hasattr(x, "__len__"):
+        z = (np.asarray(x) - loc) / scale
+        return np.exp(-0.5 * z * z) / (scale * _SQRT2PI)
+    z = (x - loc) / scale
+    return math.exp(-0.5 * z * z) / (scale * _SQRT2PI)
+
+
+def norm_ppf(p, loc: float, scale: float):
+    if hasattr(p, "__len__"):
+        return loc + scale * ndtri(np.asarray(p))
+    if 0 < p < 1 and scale > 0:
+        return NormalDist(loc, scale).inv_cdf(p)
+    return norm.ppf(p, loc=loc, scale=scale)
+
+
+def expon_cdf(x, rate: float):
+    if hasattr(x, "__len__"):
+        x = np.asarray(x)
+        return np.where(x > 0, -np.expm1(-rate * np.maximum(x, 0)), 0.0)
+    return -math.expm1(-rate * x) if x > 0 else 0.0
+
+
+def expon_pdf(x, rate: float):
+    if hasattr(x, "__len__"):
+        x = np.asarray(x)
+        return np.where(x >= 0, rate * np.exp(-rate * np.maximum(x, 0)), 0.0)
+    return rate * math.exp(-rate * x) if x >= 0 else 0.0
+
+
+def expon_ppf(p, rate: float):
+    if hasattr(p, "__len__"):
+        return -np.log1p(-np.asarray(p)) / rate
+    if p >= 1: return math.inf
+    return -math.log1p(-p) / rate
+
+
+# Scan kernels of the 'fit_stream' recursions that have no closed form. They are plain loops over scalars, compiled
+# with numba if it is installed and run as python loops (on python lists, which python indexes faster than numpy
+# arrays) otherwise. Both give the same trajectories as calling 'sgd_update' for every sample. The outputs are flat.
+
+def _exp_scan(xs, start, rate, eta, out):
+    """Rate of the exponential distribution after every sample of xs[start:] (written to out). Stops at the first
+    sample that hits the singularity, whose random restart needs the rng of the distribution.
+
+    Returns:
+        (tuple): index of the sample at the singularity (len(xs) if there is none) and the rate before it
+    """
+
+    for i in range(start, len(xs)):
+        d = rate - rate * rate * xs[i]
+        if (rate + eta * d) < 1e-9: return i, rate
+        rate = rate + eta * d
+        out[i] = rate
+    return len(xs), rate
+
+
+def _gmm_scan(xs, eta, weights, means, covs, pdfs, out):
+    """Weights, means and variances of the K components of a Gaussian mixture after every sample of xs, written to
+    out[(i * K + k) * 3 + j]. weights, means and covs are updated in place, pdfs is scratch space of length K."""
+
+    K = len(weights)
+    for i in range(len(xs)):
+        x = xs[i]
+        div = 0.0
+        for k in range(K):
+            sd = math.sqrt(max(1e-6, covs[k]))
+            z = (x - means[k]) / sd
+            pdfs[k] = weights[k] * (math.exp(-0.5 * z * z) / (sd * _SQRT2PI))
+            div += pdfs[k]
+
+        for k in range(K):
+            resp = pdfs[k] / div if div > 0 else 0.0
+            diff = x - means[k]
+            d0 = resp - weights[k]
+            d1 = 1 / weights[k] * resp * diff
+            d2 = 1 / weights[k] * resp * (diff * diff - covs[k])
+            weights[k] = weights[k] + eta * d0
+            means[k] = means[k] + eta * d1
+            covs[k] = covs[k] + eta * d2
+
+            j = (i * K + k) * 3
+            out[j] = weights[k]
+            out[j + 1] = means[k]
+            out[j + 2] = covs[k]
+
+
+if njit is not None:
+    _exp_scan = njit(cache=True, nogil=True)(_exp_scan)
+    _gmm_scan = njit(cache=True, nogil=True)(_gmm_scan)
+
+
+def _scan_array(a):
+    """Input or output of a scan kernel: a numpy array (copy) for the compiled kernels, a python list otherwise."""
+    return np.array(a, dtype=np.float64) if njit is not None else np.asarray(a, dtype=np.float64).tolist()
 
 
 class ProbabilityDistribution(object):
     def __init__(self, model_parameters, eta: float):
         self._mp = model_parameters
         self._eta = eta
+        self.rng = np.random # random number generator of the random restarts (np.random.Generator of the node, global state by default)
 
     @property
     def nparams(self):
@@ -20,9 +146,18 @@ class ProbabilityDistribution(object):
         """Cumulative density function."""
         raise NotImplementedError()
 
+    def pdf(self, x):
+        """Probability density function."""
+        raise NotImplementedError()
+
     def ppf(self, p, **kwargs):
         raise NotImplementedError()
 
+    def ppf_bracket(self, p):
+        """Interval that contains the quantile for probability p. Cheaper than 'ppf' for distributions without closed-form quantiles."""
+        x = self.ppf(p)
+        return x, x
+
     def dll(self, p, **kwargs):
         """Derivative of the log likelihood."""
         raise NotImplementedError()
@@ -31,16 +166,34 @@ class ProbabilityDistribution(object):
         """Update model parameters using stochastic gradient descent."""
         self._mp = self._mp - self._eta * -self.dll(x)
 
+    def fit_stream(self, xs):
+        """Runs 'sgd_update' for every sample of xs (in order) and leaves the model with the final parameters.
+
+        Args:
+            xs: one-dimensional array of samples (e.g. charging times)
+
+        Returns:
+            np.ndarray: parameter trajectory, shape (len(xs),) + parameter shape. Row i holds the parameters after the update with xs[i].
+        """
+        trajectory = np.empty((len(xs),) + self._mp.shape)
+        for i, x in enumerate(xs):
+            self.sgd_update(x)
+            trajectory[i] = self._mp
+        return trajectory
+
 
 class ExponentialDistribution(ProbabilityDistribution):
     def __init__(self, model_parameters: np.ndarray = np.array([10.0]), eta: float = 0.01):
         super().__init__(model_parameters, eta)
 
     def cdf(self, x):
-        return expon.cdf(x, scale=1.0 / self._mp[0])
+        return expon_cdf(x, float(self._mp[0]))
+
+    def pdf(self, x):
+        return expon_pdf(x, float(self._mp[0]))
 
     def ppf(self, p, **kwargs):
-        return expon.ppf(p, scale=1.0 / self._mp[0])
+        return expon_ppf(p, float(self._mp[0]))
 
     def dll(self, x):
         """Natural gradient descent. Multiply original gradient by -1/F^-1 (Fisher inf matrix).
@@ -52,19 +205,43 @@ class ExponentialDistribution(ProbabilityDistribution):
         d = self._mp - np.power(self._mp, 2) * x
         if (self._mp + self._eta * d) < 1e-9:
             # warnings.warn("exponential hit singularity")
-            return (-self._mp + np.random.uniform(1e-9, self._mp)) / self._eta
+            return (-self._mp + self.rng.uniform(1e-9, self._mp)) / self._eta
         return d
 
+    def fit_stream(self, xs):
+        """Same recursion as 'sgd_update' (including the random restart at the singularity), run by '_exp_scan'. Gives
+        the same trajectory as calling 'sgd_update' for every sample."""
+        xs = np.asarray(xs, dtype=np.float64)
+        n = len(xs)
+        if n == 0: return np.empty((0, 1))
+
+        xs, out = _scan_array(xs), _scan_array(np.zeros(n))
+        eta = self._eta
+        i, rate = _exp_scan(xs, 0, float(self._mp[0]), eta, out)
+        while i < n:
+            # Random restart, needs the rng of the distribution and is done here
+            d = (-rate + self.rng.uniform(1e-9, rate)) / eta
+            rate = rate + eta * d
+            out[i] = rate
+            i, rate = _exp_scan(xs, i + 1, rate, eta, out)
+
+        trajectory = np.asarray(out, dtype=np.float64).reshape(n, 1)
+        self._mp = trajectory[-1].copy()
+        return trajectory
+
 
 class NormalDistribution(ProbabilityDistribution):
     def __init__(self, model_parameters: np.ndarray = np.array([1.0, 1e-4]), eta: float = 0.01):
         super().__init__(model_parameters, eta)
 
     def cdf(self, x):
-        return norm.cdf(x, loc=self._mp[0], scale=np.sqrt(self._mp[1]))
+        return norm_cdf(x, float(self._mp[0]), _sqrt(self._mp[1]))
+
+    def pdf(self, x):
+        return norm_pdf(x, float(self._mp[0]), _sqrt(self._mp[1]))
 
     def ppf(self, p, **kwargs):
-        return norm.ppf(p, loc=self._mp[0], scale=np.sqrt(self._mp[1]))
+        return norm_ppf(p, float(self._mp[0]), _sqrt(self._mp[1]))
 
     def dll(self, x):
         """Derivative of MLE of normal distribution according to Titterington"""
@@ -73,31 +250,58 @@ class NormalDistribution(ProbabilityDistribution):
         d[1] = np.power(x - self._mp[0], 2) - self._mp[1]
         return d
 
+    def fit_stream(self, xs):
+        """Vectorized version of the Titterington recursion. Mean and variance updates are first order linear filters
+        (m <- (1 - eta) m + eta x), so both are evaluated with 'scipy.signal.lfilter'. Agrees with calling 'sgd_update'
+        for every sample up to floating point rounding (relative differences in the order of 1e-12).
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        if len(xs) == 0: return np.empty((0, 2))
+
+        b, a = [self._eta], [1.0, -(1.0 - self._eta)]
+        mean0, var0 = float(self._mp[0]), float(self._mp[1])
+
+        means = lfilter(b, a, xs, zi=[(1.0 - self._eta) * mean0])[0]
+        prev_means = np.concatenate(([mean0], means[:-1]))
+        variances = lfilter(b, a, np.power(xs - prev_means, 2), zi=[(1.0 - self._eta) * var0])[0]
+
+        trajectory = np.stack((means, variances), axis=1)
+        self._mp = trajectory[-1].copy()
+        return trajectory
+
 
 class GaussianMixtureModel(ProbabilityDistribution):
     def __init__(self, model_parameters: np.ndarray = np.array([[0.95, 0.15, 1e-4], [0.05, 0.3, 1e-4]]), eta: float = 0.001):
         super().__init__(model_parameters, eta)
 
+    def _components(self):
+        """Weight, mean and standard deviation of every component as python floats."""
+        return [(float(w), float(mu), _sqrt(var)) for w, mu, var in self._mp]
+
     def cdf(self, x):
-        parts = [self._mp[k][0] * norm.cdf(x, loc=self._mp[k][1], scale=np.sqrt(self._mp[k][2])) for k in range(self._mp.shape[0])]
+        parts = [w * norm_cdf(x, mu, sd) for w, mu, sd in self._components()]
         if hasattr(x, "__len__"):
             return np.sum(parts, axis=0)
         else:
-            return np.sum(parts)
+            return sum(parts)
+
+    def pdf(self, x):
+        parts = [w * norm_pdf(x, mu, sd) for w, mu, sd in self._components()]
+        if hasattr(x, "__len__"):
+            return np.sum(parts, axis=0)
+        else:
+            return sum(parts)
+
+    def ppf_bracket(self, p):
+        """The quantile of the mixture lies between the smallest and the largest quantile of its components."""
+        quantiles = [norm_ppf(p, mu, sd) for _, mu, sd in self._components()]
+        return min(quantiles), max(quantiles)
 
     def ppf(self, p, bound_type: str = None):
         def fn_obj(x):
             return self.cdf(x) - p
 
-        a = min(
-            norm.ppf(p, loc=self._mp[0][1], scale=np.sqrt(self._mp[0][2])),
-            norm.ppf(p, loc=self._mp[1][1], scale=np.sqrt(self._mp[1][2])),
-        )
-
-        b = max(
-            norm.ppf(p, loc=self._mp[0][1], scale=np.sqrt(self._mp[0][2])),
-            norm.ppf(p, loc=self._mp[1][1], scale=np.sqrt(self._mp[1][2])),
-        )
+        a, b = self.ppf_bracket(p)
 
         if bound_type is None:
             crit = crit_abs
@@ -120,8 +324,8 @@ class GaussianMixtureModel(ProbabilityDistribution):
         """'Responsibilities' of individual components."""
         K = self._mp.shape[0]
         covs = [max(1e-6, self._mp[k, 2]) for k in range(K)]
-        scaled_pdfs = [self._mp[k, 0] * norm.pdf(x, loc=self._mp[k, 1], scale=np.sqrt(covs[k])) for k in range(K)]
-        div = np.sum(scaled_pdfs)
+        scaled_pdfs = [float(self._mp[k, 0]) * norm_pdf(x, float(self._mp[k, 1]), math.sqrt(covs[k])) for k in range(K)]
+        div = sum(scaled_pdfs)
         if div <= 0:
             # warnings.warn("sample outside of distribution")
             return np.zeros((K,))
@@ -129,40 +333,174 @@ class GaussianMixtureModel(ProbabilityDistribution):
 
     def dll(self, x):
         """Derivative of log likelihood according to Titterington et. al. (1984)"""
-        K = self._mp.shape[0]
         d = np.empty_like(self._mp)
         resps = self.responsibilites(x)
-        for k in range(K):
-            d[k, 0] = resps[k] - self._mp[k, 0]
-            d[k, 1] = 1 / self._mp[k, 0] * resps[k] * (x - self._mp[k, 1])
-            d[k, 2] = 1 / self._mp[k, 0] * resps[k] * (np.power(x - self._mp[k, 1], 2) - self._mp[k, 2])
+        weights, means, covs = self._mp[:, 0], self._mp[:, 1], self._mp[:, 2]
+        d[:, 0] = resps - weights
+        d[:, 1] = 1 / weights * resps * (x - means)
+        d[:, 2] = 1 / weights * resps * (np.power(x - means, 2) - covs)
         return d
 
+    def fit_stream(self, xs):
+        """Same recursion as 'sgd_update', run by '_gmm_scan'. Gives the same trajectory as calling 'sgd_update' for every sample."""
+        xs = np.asarray(xs, dtype=np.float64)
+        n, K = len(xs), self._mp.shape[0]
+        if n == 0: return np.empty((0, K, 3))
+
+        weights, means, covs = (_scan_array(self._mp[:, j]) for j in range(3))
+        out = _scan_array(np.zeros(n * K * 3))
+        _gmm_scan(_scan_array(xs), self._eta, weights, means, covs, _scan_array(np.zeros(K)), out)
+
+        trajectory = np.asarray(out, dtype=np.float64).reshape(n, K, 3)
+        self._mp = trajectory[-1].copy()
+        return trajectory
 
-def inverse_joint_cdf(dists: tuple, p: float = 0.99):
-    """Computes the inverse joint cdf of two independent probability distributions using bisection method.
+
+class Geometric(object):
+    """Geometric distribution of the random delay (in slots) that 'Find' adds to every charging cycle. P(k) = p (1-p)^k
+    for k = 0, 1, 2, ... Used by 'utils.model' to compute the optimized scales of 'Find'.
+
+    Args:
+        p (float): success probability (the 'scale' optimized by 'utils.find.optimize_scale')
+        tail (float): probability mass of the tail beyond which the pmf is truncated
+    """
+
+    def __init__(self, p: float, tail: float = 1e-12):
+        if not 0 < p <= 1:
+            raise ValueError("p must be in (0, 1]")
+        self.p = float(p)
+        self.tail = tail
+
+    def max_support(self):
+        """Largest delay of the truncated pmf."""
+        if self.p == 1: return 0
+        return int(math.ceil(math.log(self.tail) / math.log1p(-self.p)))
+
+    def min_support(self):
+        """Smallest possible delay."""
+        return 0
+
+    def pmf(self):
+        k = np.arange(self.max_support() + 1)
+        return self.p * np.power(1.0 - self.p, k)
+
+    def pmf_nsum(self, n: int):
+        """Generator of the pmfs of the sum of 1, 2, ..., n independent delays. Element k of the i-th pmf is the
+        probability that i delays add up to k slots."""
+        for offset, pmf_sum in self.pmf_nsum_trimmed(n):
+            yield np.concatenate((np.zeros(offset), pmf_sum))
+
+    def pmf_nsum_trimmed(self, n: int, eps: float = 1e-18):
+        """Same as 'pmf_nsum', but yields (offset, pmf) with the values below eps cut off at both ends. Element k of
+        the pmf is the probability that the delays add up to offset + k slots.
+
+        Every pmf is the convolution of the previous one with the pmf of one delay, computed with FFTs. The sum of i
+        delays only has a width of O(sqrt(i)) above eps, so trimming keeps the convolutions short. The round-off of
+        the FFT (~1e-16 of the peak) can make single values slightly negative, they are clipped at 0."""
+        pmf = self.pmf()
+        offset, pmf_sum = 0, pmf
+        for _ in range(n):
+            yield offset, pmf_sum
+            pmf_sum = fftconvolve(pmf_sum, pmf)
+            np.maximum(pmf_sum, 0.0, out=pmf_sum)
+
+            above = np.flatnonzero(pmf_sum >= eps)
+            first, last = (above[0], above[-1]) if len(above) else (0, 0)
+            offset += first
+            pmf_sum = pmf_sum[first : last + 1]
+
+    def expectation(self):
+        return (1.0 - self.p) / self.p
+
+    @staticmethod
+    def get_scale_range(t_chr: int):
+        """Bounds of the scale searched by the optimizer for a charging time (in slots). The optimized scales fall
+        roughly with 1/sqrt(t_chr) (see opt_scale.csv), the bounds leave a factor of about 5 on both sides."""
+        t_chr = max(int(t_chr), 1)
+        return 0.1 / math.sqrt(t_chr), min(0.999, 4.0 / math.sqrt(t_chr))
+
+
+class IntervalCache(object):
+    """LRU cache of connection intervals, keyed on the quantized model parameters of both distributions and the target probability.
+
+    Parameters are quantized to a number of significant digits, so that model pairs that only differ below that
+    precision share one connection interval (the one computed for the pair seen first). Thread-safe, the cache is
+    shared by the node threads of the thread-per-node driver.
+
+    Args:
+        digits: number of significant digits of the model parameters used in the key
+        maxsize: maximum number of cached connection intervals
+    """
+
+    def __init__(self, digits: int = 6, maxsize: int = 4096):
+        self.digits = digits
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, dists: tuple, p: float):
+        return (p,) + tuple((type(dist).__name__,) + tuple(float(f"{v:.{self.digits}g}") for v in np.ravel(dist._mp)) for dist in dists)
+
+    def get(self, key):
+        with self._lock:
+            res = self._entries.get(key)
+            if res is not None:
+                self._entries.move_to_end(key)
+            return res
+
+    def put(self, key, res):
+        with self._lock:
+            self._entries[key] = res
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+def inverse_joint_cdf(dists: tuple, p: float = 0.99, cache: IntervalCache = None):
+    """Computes the inverse joint cdf of two independent probability distributions.
+
+    Pairs of exponential distributions with the same rate are solved in closed form. All other pairs are solved with
+    Newton's method on the analytic joint pdf, safeguarded by bisection.
 
     Args:
         dists: two probability distributions
         p: target probability
+        cache: optional cache of connection intervals for unchanged pairs of models
     """
 
+    if cache is not None:
+        key = cache.key(dists, p)
+        res = cache.get(key)
+        if res is None:
+            res = _inverse_joint_cdf(dists, p)
+            cache.put(key, res)
+        return res
+
+    return _inverse_joint_cdf(dists, p)
+
+
+def _inverse_joint_cdf(dists: tuple, p: float):
+    if isinstance(dists[0], ExponentialDistribution) and isinstance(dists[1], ExponentialDistribution) and dists[0]._mp[0] == dists[1]._mp[0]:
+        # (1 - exp(-rate * x))^2 = p
+        return -np.log(1 - np.sqrt(p)) / dists[0]._mp[0]
+
     def objective_function(x):
         cdfs = [dists[i].cdf(x) for i in range(2)]
-        return cdfs[0] * cdfs[1] - p
+        pdfs = [dists[i].pdf(x) for i in range(2)]
+        return cdfs[0] * cdfs[1] - p, pdfs[0] * cdfs[1] + cdfs[0] * pdfs[1]
 
-    # Lower search interval bracket
-    a = max([dists[i].ppf(p, bound_type="lower") for i in range(2)])
+    # Lower search interval bracket (both cdfs at most p)
+    a = max([dists[i].ppf_bracket(p)[0] for i in range(2)])
 
     q = np.sqrt(p)
-    # Upper search interval bracket
-    b = max([dists[i].ppf(q, bound_type="upper") for i in range(2)])
+    # Upper search interval bracket (both cdfs at least sqrt(p))
+    b = max([dists[i].ppf_bracket(q)[1] for i in range(2)])
 
     try:
-        _, res = bisection(objective_function, a, b)
+        iterations, res = newton_bisection(objective_function, a, b)
     except ValueError:
         return b
     except RuntimeError:
-        warnings.warn("Bisection did not converge")
+        warnings.warn("Newton bisection did not converge")
         return b
+    if profiling.active: profiling.active.count("ijcdf_iterations", iterations)
     return res
@@ -0,0 +1,173 @@
+'''
+Vectorized charging engine for the battery-free devices.
+
+The reference behaviour is the per-sample sleep loop of 'BatteryfreeDevice':
+
+    while (iteration < stop) and ((estored < e_on) or (iteration < sleep_till)):
+        if estored < e_max: estored += Ts * pwr[iteration]
+        if estored < e_on: latest_tchrg += Ts
+        iteration += 1
+
+The functions in this module reproduce that loop bit for bit, but work on whole blocks of the power trace using
+prefix sums and 'searchsorted' instead of visiting every sample from Python.
+'''
+
+import math
+import numpy as np
+
+_MANTISSA_UNITS = 2**53 # Number of ulps in a binade of a double
+
+
+def repeat_add(x, step, n):
+    """Adds 'step' to 'x' n times, rounding after every addition exactly like 'for _ in range(n): x += step' would.
+
+    Inside a binade of 'x' every addition rounds to the same multiple of the ulp, so all additions that do not
+    leave the binade are applied at once. Runs in O(number of binades crossed) instead of O(n).
+
+    Args:
+        x (float): start value
+        step (float): value added at every step (must not be negative)
+        n (int): number of additions
+
+    Returns:
+        (float): value of x after n additions
+    """
+
+    x = float(x)
+    step = float(step)
+    n = int(n)
+
+    if step < 0: raise ValueError("step must not be negative")
+    if step == 0 or n <= 0: return x
+
+    while n > 0:
+        if x < step:
+            # Small start values (e.g. 0) are not on the grid of the binade of 'step'
+            x += step
+            n -= 1
+            continue
+
+        e = math.frexp(x)[1]
+        ulp = math.ldexp(1.0, e - 53)
+
+        units = step / ulp
+        q = math.floor(units)
+        r = units - q
+
+        if r > 0.5: inc = q + 1
+        elif r < 0.5: inc = q
+        else:
+            # Ties are rounded to even, which depends on the current value
+            x += step
+            n -= 1
+            continue
+
+        if inc == 0: return x # Step is below half an ulp, x does not change anymore
+
+        units_x = int(x / ulp)
+        k = min(n, (_MANTISSA_UNITS - 1 - units_x) // inc)
+
+        if k == 0:
+            # Next addition leaves the binade and has to be rounded on the coarser grid
+            x += step
+            n -= 1
+        else:
+            x = (units_x + k * inc) * ulp
+            n -= k
+
+    return x
+
+
+def _scan_samples(energy, estored, e_on, e_max, j_min):
+    """Reference per-sample loop over a block of harvested energy values. Used for blocks with negative values, where
+    the stored energy is not monotonic and prefix sums cannot be searched.
+
+    Returns:
+        (tuple): number of consumed samples, stored energy, number of consumed samples that left the node uncharged and
+                 whether the wake-up condition was met inside the block
+    """
+
+    n_uncharged = 0
+    for j in range(len(energy)):
+        if estored >= e_on and j >= j_min: return j, estored, n_uncharged, True
+        if estored < e_max: estored += float(energy[j])
+        if estored < e_on: n_uncharged += 1
+
+    done = estored >= e_on and len(energy) >= j_min
+    return len(energy), estored, n_uncharged, done
+
+
+def charge_until(pwr, Ts, start, stop, estored, e_on, e_max, sleep_till, block_size=4096, max_block_size=1 << 20):
+    """Advances a sleeping node along its power trace until it is charged and 'sleep_till' is reached, or until 'stop'.
+
+    The trace is read in blocks that start small (most charging cycles are short) and double up to 'max_block_size'.
+    For every block the running stored energy is computed with a prefix sum that starts at the current stored energy,
+    which rounds exactly like the sequential additions of the reference loop. The first sample above the wake-up
+    threshold and the first sample above the clamp ('e_max') are then found with 'searchsorted'.
+
+    Args:
+        pwr:                indexable power trace (numpy array, h5py dataset or 'CachedDataset'), sliced in blocks
+        Ts (float):         length of a simulation time step (in secs)
+        start (int):        first iteration to harvest
+        stop (int):         iteration at which the trace ends
+        estored (float):    energy stored at 'start'
+        e_on (float):       wake-up energy threshold
+        e_max (float):      energy above which no more energy is harvested
+        sleep_till (int):   iteration before which the node does not wake up, even if it is charged
+        block_size (int):   size of the first block read from the trace
+        max_block_size (int): maximum size of a block read from the trace
+
+    Returns:
+        (tuple): iteration at which the node wakes up, stored energy at that iteration and the number of harvested
+                 samples after which the node was still below the wake-up threshold (i.e. charging time in slots)
+    """
+
+    it = int(start)
+    estored = float(estored)
+    n_uncharged = 0
+
+    while it < stop:
+        if estored >= e_on and it >= sleep_till: break
+
+        if estored >= e_max:
+            # Clamped: the stored energy does not change anymore, no need to look at the trace
+            if estored >= e_on:
+                it = max(it, min(stop, sleep_till))
+            else:
+                n_uncharged += stop - it
+                it = stop
+            break
+
+        hi = min(stop, it + block_size)
+        energy = Ts * np.asarray(pwr[it:hi], dtype=np.float64)
+        j_min = sleep_till - it
+
+        if energy.size and energy.min() < 0:
+            n, estored, n_unch, done = _scan_samples(energy, estored, e_on, e_max, j_min)
+            n_uncharged += n_unch
+            it += n
+            if done: break
+        else:
+            cum = np.empty(energy.size + 1)
+            cum[0] = estored
+            cum[1:] = energy
+            np.cumsum(cum, out=cum)
+
+            n = energy.size
+            j_max = int(np.searchsorted(cum, e_max, side="left")) # Samples until the clamp is reached
+            j_on = int(np.searchsorted(cum, e_on, side="left"))   # Samples until the node is charged
+            if j_on > j_max: j_on = math.inf                     # Threshold above the clamp, never charged
+
+            j_exit = max(j_on, j_min, 0)
+            done = j_exit <= n
+            j_end = j_exit if done else n
+
+            n_uncharged += max(0, min(j_end, j_on - 1))
+            estored = float(cum[min(j_end, j_max)])
+            it += j_end
+
+            if done: break
+
+        block_size = min(2 * block_size, max_block_size)
+
+    return it, estored, n_uncharged
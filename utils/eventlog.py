@@ -0,0 +1,242 @@
+'''
+Structured event log of the simulation.
+
+Every state transition of a node is stored as one compact numeric record (iteration, node id, event code, peer, arg,
+value) in a preallocated numpy buffer, which is flushed in bulk to a '.npy', '.h5' or '.parquet' file. The old text
+runtime logs can be rendered from the records when needed:
+
+    python -m utils.eventlog <events file> [--out <directory>]
+'''
+
+import os
+import argparse
+import threading
+import numpy as np
+import h5py
+
+EVENT_DTYPE = np.dtype([
+    ("iteration", "<i8"),   # iteration of the node when the event happened
+    ("node", "<i4"),        # id of the node
+    ("code", "<i2"),        # event code (see below)
+    ("peer", "<i4"),        # id of the target node (-1 if not applicable)
+    ("arg", "<i8"),         # integer argument of the event (e.g. iteration till which the node sleeps)
+    ("value", "<f8"),       # floating point argument of the event (e.g. sleep time in secs)
+])
+
+# Event codes
+STARTED = 0             # value: wall-clock time
+SLEEP_CHARGE = 1        # set to sleep for charging
+SLEEP_FIND = 2          # arg: sleep till iteration, value: sleep time (in secs)
+WAIT_FIND = 3           # arg: wait till iteration, value: max offset (in secs)
+RESET_FIND = 4
+WAIT_BONITO = 5         # arg: wait till iteration, value: max offset (in secs)
+CONNECTED = 6           # peer: target node, arg: connection no.
+SLEEP_BONITO = 7        # arg: sleep till iteration, value: connection interval (in secs)
+HANDSHAKE_FAILED = 8
+LOST = 9                # peer: target node
+WOKE = 10
+WOKE_CHARGED = 11       # value: charging time (in secs)
+WAITING_FIND = 12       # arg: number of iterations waited
+WAITING_BONITO = 13     # arg: number of iterations waited
+TASK = 14               # arg: task no.
+TASK_SKIPPED = 15       # value: energy the task needed (in joules)
+FERRIED = 16            # peer: target node, arg: no. of packets handed over
+DELIVERED = 17          # peer: node the packet came from, arg: no. of hops, value: end-to-end latency (in secs)
+DROPPED = 18            # arg: no. of packets in the buffer
+
+CODE_NAMES = {code: name for name, code in globals().items() if name.isupper() and isinstance(code, int) and name != "EVENT_DTYPE"}
+
+# Verbosity levels
+QUIET = 0       # state transitions only, no waiting records
+SUMMARY = 1     # one waiting record per wait cycle, holding the number of iterations waited
+PER_SAMPLE = 2  # one waiting record per iteration waited (like the old text logs)
+
+
+class EventLog(object):
+    """Buffered writer of event records. Thread-safe, so one log can be shared by all the nodes of a simulation.
+
+    Args:
+        path (str): output file, the format is chosen by the extension ('.npy', '.h5'/'.hdf5' or '.parquet')
+        capacity (int): number of records buffered in memory before they are flushed to the file
+        verbosity (int): QUIET, SUMMARY or PER_SAMPLE (see above)
+    """
+
+    def __init__(self, path, capacity=65536, verbosity=SUMMARY):
+        self.path = path
+        self.verbosity = verbosity
+        self.n_events = 0
+
+        self._buf = np.empty((capacity,), dtype=EVENT_DTYPE)
+        self._n = 0
+        self._lock = threading.Lock()
+        self._writer = _writer(path)
+        self._closed = False
+
+    def append(self, iteration, node, code, peer=-1, arg=0, value=0.0):
+        with self._lock:
+            if self._closed: return # Nodes that did not stop in time after the end of the simulation
+            if self._n == len(self._buf): self._flush()
+            self._buf[self._n] = (iteration, node, code, peer, arg, value)
+            self._n += 1
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._n == 0: return
+        self._writer.write(self._buf[:self._n])
+        self.n_events += self._n
+        self._n = 0
+
+    def close(self):
+        with self._lock:
+            if self._closed: return
+            self._flush()
+            self._writer.close()
+            self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _writer(path):
+    ext = os.path.splitext(path)[1]
+    if ext == ".npy": return _NpyWriter(path)
+    if ext in (".h5", ".hdf5"): return _H5Writer(path)
+    if ext == ".parquet": return _ParquetWriter(path)
+    raise ValueError(f"Unknown event log format '{ext}'")
+
+
+class _NpyWriter(object):
+    """Appends the raw records to a '.part' file and converts it into a '.npy' file on close."""
+
+    def __init__(self, path):
+        self.path = path
+        self._part = path + ".part"
+        self._fp = open(self._part, "wb")
+
+    def write(self, records):
+        records.tofile(self._fp)
+
+    def close(self):
+        self._fp.close()
+        raw = np.memmap(self._part, dtype=EVENT_DTYPE, mode="r") if os.path.getsize(self._part) else np.empty((0,), dtype=EVENT_DTYPE)
+        out = np.lib.format.open_memmap(self.path, mode="w+", dtype=EVENT_DTYPE, shape=raw.shape)
+        block = 1 << 20
+        for i in range(0, len(raw), block):
+            out[i : i + block] = raw[i : i + block]
+        out.flush()
+        del out, raw
+        os.remove(self._part)
+
+
+class _H5Writer(object):
+    """Appends the records to a resizable 'events' dataset."""
+
+    def __init__(self, path):
+        self._hf = h5py.File(path, "w")
+        self._ds = self._hf.create_dataset("events", shape=(0,), maxshape=(None,), dtype=EVENT_DTYPE, chunks=(65536,))
+        for code, name in CODE_NAMES.items(): self._ds.attrs[name] = code
+
+    def write(self, records):
+        n = len(self._ds)
+        self._ds.resize((n + len(records),))
+        self._ds[n:] = records
+
+    def close(self):
+        self._hf.close()
+
+
+class _ParquetWriter(object):
+    """Writes every flush as one row group (needs pyarrow)."""
+
+    def __init__(self, path):
+        import pyarrow
+        import pyarrow.parquet
+
+        self._pa = pyarrow
+        self._schema = pyarrow.schema([(name, pyarrow.from_numpy_dtype(EVENT_DTYPE[name])) for name in EVENT_DTYPE.names])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+
+    def write(self, records):
+        table = self._pa.Table.from_arrays([self._pa.array(records[name]) for name in EVENT_DTYPE.names], schema=self._schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        self._writer.close()
+
+
+def read_events(path):
+    """Reads all the records of an event log file.
+
+    Args:
+        path (str): '.npy', '.h5'/'.hdf5' or '.parquet' event log
+
+    Returns:
+        np.ndarray: structured array of records (EVENT_DTYPE)
+    """
+
+    ext = os.path.splitext(path)[1]
+    if ext == ".npy": return np.load(path, mmap_mode="r")
+    if ext in (".h5", ".hdf5"):
+        with h5py.File(path, "r") as hf: return hf["events"][:]
+    if ext == ".parquet":
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(path)
+        events = np.empty((table.num_rows,), dtype=EVENT_DTYPE)
+        for name in EVENT_DTYPE.names: events[name] = table.column(name).to_numpy()
+        return events
+    raise ValueError(f"Unknown event log format '{ext}'")
+
+
+def render_text(events, node):
+    """Renders the records of one node in the format of the old text runtime logs.
+
+    Args:
+        events (np.ndarray): structured array of records (EVENT_DTYPE)
+        node (int): id of the node
+
+    Returns:
+        generator: lines of the runtime log (with trailing newline)
+    """
+
+    name = f"node{node}"
+    peer_name = lambda peer: f"node{peer}" if peer >= 0 else "None"
+    for iteration, _, code, peer, arg, value in events[events["node"] == node].tolist():
+        if code == STARTED: yield f"{name} started at {value: .6f}!\n"
+        elif code == SLEEP_CHARGE: yield f"Iteration {iteration}: {name} set to sleep for charging\n"
+        elif code == SLEEP_FIND: yield f"Iteration {iteration}: {name} set to sleep by Find till {arg} ({value: .6f}s)\n"
+        elif code == WAIT_FIND: yield f"Iteration {iteration}: {name} waiting for Find discovery till {arg} ({value}s)\n"
+        elif code == RESET_FIND: yield f"Iteration {iteration}: {name} reset by Find\n"
+        elif code == WAIT_BONITO: yield f"Iteration {iteration}: {name} waiting for Bonito discovery till {arg} ({value}s)\n"
+        elif code == CONNECTED: yield f"Iteration {iteration} :{arg} - Connected to {peer_name(peer)}!\n"
+        elif code == SLEEP_BONITO: yield f"Iteration {iteration}: {name} reset and set to sleep by Bonito till {arg} ({value}s)\n"
+        elif code == HANDSHAKE_FAILED: yield "Barrier Broken Error\n"
+        elif code == LOST: yield f"Iteration {iteration}: Connection with {peer_name(peer)} lost! {name} reset by Bonito\n"
+        elif code == WOKE: yield f"Iteration {iteration}: {name} woke up!\n"
+        elif code == WOKE_CHARGED: yield f"Iteration {iteration}: {name} woke up! Charging time: {value: .6f}s\n"
+        elif code == WAITING_FIND: yield "Find - Waiting for Discovery\n" * arg
+        elif code == WAITING_BONITO: yield "Bonito - Waiting for Discovery\n" * arg
+        elif code == TASK: yield f"Task {arg} Completed!\n"
+        elif code == TASK_SKIPPED: yield f"Iteration {iteration}: {name} skipped its task (needs {value:.3e}J)\n"
+        elif code == FERRIED: yield f"Iteration {iteration}: {name} handed {arg} packet(s) to {peer_name(peer)}\n"
+        elif code == DELIVERED: yield f"Iteration {iteration}: {name} received a packet from {peer_name(peer)} after {arg} hop(s) ({value: .6f}s)\n"
+        elif code == DROPPED: yield f"Iteration {iteration}: {name} dropped a packet (buffer full, {arg} packets)\n"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render the text runtime logs of the nodes from an event log")
+    parser.add_argument("path", help="event log file (.npy, .h5 or .parquet)")
+    parser.add_argument("--out", default=None, help="output directory (default: directory of the event log)")
+    cli_args = parser.parse_args()
+
+    events = read_events(cli_args.path)
+    out_dir = cli_args.out or os.path.dirname(os.path.abspath(cli_args.path))
+
+    for node in np.unique(events["node"]).tolist():
+        with open(os.path.join(out_dir, f"runtime_logs_node{node}.txt"), "w") as fp:
+            fp.writelines(render_text(events, node))
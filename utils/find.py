@@ -9,20 +9,34 @@ from utils.model import Model
 
 np.seterr(divide='ignore')
 
-def objective(scale, t_chr):
-    m = Model(scale, "Geometric", t_chr, n_slots=t_chr * 20000)
+_tables = {} # Optimized scale tables already parsed, keyed on the path of the csv file (dropped by 'clear_tables')
+
+def objective(scale, t_chr, n_nodes=2, n_jobs=None):
+    m = Model(scale, "Geometric", t_chr, n_nodes=n_nodes, n_slots=t_chr * 20000, n_jobs=n_jobs)
     return m.disco_latency()
 
 
-def optimize_scale(t_chr):
+def optimize_scale(t_chr, n_nodes=2, n_jobs=None, full_output=False):
+    """Optimizes the scale of the geometric distro of 'Find' for the given charging time
+
+    Args:
+        t_chr (int): charging time (in slots)
+        n_nodes (int): number of nodes in the clique
+        n_jobs (int): number of processes per evaluation of the objective (see 'utils.model.Model')
+        full_output (bool): also return the discovery latency of the optimized scale
+
+    Returns:
+        float or tuple: optimized scale (and discovery latency in slots)
+    """
     scale_range = distributions.Geometric.get_scale_range(t_chr)
     res = minimize_scalar(
         objective,
         bounds=scale_range,
         method="bounded",
-        args=(t_chr),
+        args=(t_chr, n_nodes, n_jobs),
     )
 
+    if full_output: return res.x, res.fun
     return res.x
 
 def process_csv(path: str):
@@ -43,16 +57,43 @@ def process_csv(path: str):
 
     return table
 
-def lookup_scale(t_chr: int, table: np.ndarray):
+def load_table(path: str):
+    """Return the optimized scales of the csv file. The csv file is only parsed on the first call for every path, till the table is dropped with 'clear_tables' (done by 'utils.opt_table.write_table' when it rewrites the file).
+
+    Args:
+        path (str): absolute path to the optimized scales csv file
+
+    Returns:
+        np.ndarray: optimized scales of geometric distro
+    """
+    table = _tables.get(path)
+    if table is None:
+        table = process_csv(path)
+        _tables[path] = table
+
+    return table
+
+def clear_tables(path: str = None):
+    """Drops the parsed table of a csv file (default: of all files), so the next 'load_table' parses it again.
+
+    Args:
+        path (str): path of the optimized scales csv file
+    """
+    if path is None: _tables.clear()
+    else: _tables.pop(path, None)
+
+def lookup_scale(t_chr, table: np.ndarray):
     """Returns the optimized scale for the given charging time
 
     Args:
-        t_chr (int): Latest charging time (in slots)
+        t_chr (int or np.ndarray): Latest charging time (in slots), or an array of charging times
         table (np.ndarray): Table with optimized scale of geometric distro
 
     Returns:
-        float: optimized scale
+        float or np.ndarray: optimized scale (one per charging time for array input)
     """
+    if np.ndim(t_chr) > 0: return _lookup_scales(np.asarray(t_chr), table)
+
     if t_chr < 10: return table[0]
     elif t_chr >= 2560: return table[255]
 
@@ -63,38 +104,68 @@ def lookup_scale(t_chr: int, table: np.ndarray):
 
     return val_low + frac * (val_high - val_low)
 
-def geometric_itf_sample(p: float):
+def _lookup_scales(t_chr: np.ndarray, table: np.ndarray):
+    """Vectorized version of 'lookup_scale' for an array of charging times"""
+    t_chr = t_chr.astype(np.float64)
+    scales = np.empty(t_chr.shape)
+
+    below = t_chr < 10
+    above = t_chr >= 2560
+    inside = ~(below | above)
+
+    scales[below] = table[0]
+    scales[above] = table[255]
+
+    t_in = t_chr[inside]
+    val_low = table[(t_in/10 - 1).astype(int)].astype(np.float64)
+    val_high = table[(t_in/10).astype(int)].astype(np.float64)
+    frac = (t_in % 10)/10
+    scales[inside] = val_low + frac * (val_high - val_low)
+
+    return scales
+
+def geometric_itf_sample(p, size=None, rng=None):
     """Return the delay value sampled from geometric distro
 
     Args:
-        p (float): optimized scale for geometric distro
+        p (float or np.ndarray): optimized scale for geometric distro
+        size (int or tuple): number of delays to sample in one go (None for a single delay)
+        rng (np.random.Generator): random number generator (None for the global numpy state)
 
     Returns:
-        int: randomly sampled delay
+        int or np.ndarray: randomly sampled delay(s)
     """
-    y = np.random.uniform()
+    if rng is None: rng = np.random
+
+    if size is not None or np.ndim(p) > 0:
+        y = rng.uniform(size=size if size is not None else np.shape(p))
+        return (np.log(1 - y)/np.log(1 - p) - 1).astype(int)
+
+    y = rng.uniform()
     res = int(math.log(1 - y)/math.log(1 - p) - 1)
     # res = int(math.log(y)/math.log(1 - p)) + 1
     # res = np.random.geometric(p)
 
     return res
 
-def Find(path: str, t_chr: int):
+def Find(path: str, t_chr, size=None, rng=None):
     """Calculate the random waiting time given the latest current charging time
 
     Args:
         path (str): absolute path to the optimized scales csv file
-        t_chr (int): Latest charging time (in slots)
+        t_chr (int or np.ndarray): Latest charging time (in slots), or an array of charging times
+        size (int or tuple): number of waiting times to sample in one go (None for a single waiting time)
+        rng (np.random.Generator): random number generator (None for the global numpy state)
 
     Returns:
-        int: waiting time (in slots)
+        int or np.ndarray: waiting time(s) (in slots)
     """
 
     # Either use the lookup table or run the optimize the scale dynamically
     
-    # Lookup table
-    table = process_csv(path)
-    wait_time = geometric_itf_sample(lookup_scale(t_chr, table))
+    # Lookup table (parsed once per csv file)
+    table = load_table(path)
+    wait_time = geometric_itf_sample(lookup_scale(t_chr, table), size, rng)
     
     # Dynamic optimization
     # wait_time = geometric_itf_sample(optimize_scale(t_chr))
@@ -1,3 +1,7 @@
+import os
+import math
+import atexit
+import hashlib
 import numpy as np
 import logging
 from typing import Union
@@ -5,6 +9,7 @@ from typing import Iterable
 import multiprocessing
 
 from itertools import combinations
+from collections import OrderedDict, deque
 import warnings
 
 import utils.distributions as dists
@@ -16,10 +21,49 @@ np.errstate(all="raise")
 warnings.simplefilter("error", RuntimeWarning)
 
 
+# Rendezvous probabilities of fewer values (slots x links) are computed in the calling process, where the overhead of
+# sending the activities to the workers is larger than the computation itself
+_min_parallel_size = 1 << 22
+
+_pool = None # Worker pool shared by all 'Model' objects (see '_get_pool')
+_pool_jobs = 0
+
+# Cache of activity probabilities (see 'p_act' and 'configure_p_act_cache')
+_p_act_cache = OrderedDict()
+_p_act_cache_size = 64
+_p_act_cache_dir = None
+_p_act_scale_digits = None
+
+
 class ThresholdException(Exception):
     pass
 
 
+def _get_pool(n_jobs: int):
+    """Returns the long-lived worker pool with n_jobs processes, created on first use. The optimizer builds dozens of
+    'Model' objects per charging time, so starting a new pool for each of them would cost more than the computation.
+    """
+    global _pool, _pool_jobs
+
+    if _pool is None or _pool_jobs != n_jobs:
+        _close_pool()
+        _pool = multiprocessing.Pool(n_jobs)
+        _pool_jobs = n_jobs
+
+    return _pool
+
+
+@atexit.register
+def _close_pool():
+    global _pool, _pool_jobs
+
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+    _pool = None
+    _pool_jobs = 0
+
+
 def expected_value(pmf: np.array):
     """Calculates expected value from pmf
 
@@ -45,28 +89,117 @@ def act2rend(activities: np.ndarray):
     Returns:
         np.ndarray: Shape (n, l) array with probability for rendezvous in n slots and l links
     """
-    node_ids = range(activities.shape[1])
-    links = list(combinations(node_ids, 2))
-    p_rendz = np.empty((activities.shape[0], len(links)))
-    for i, link in enumerate(links):
-        others = list(set(node_ids) - set(link))
-        # probability that the two 'link' nodes are active at the same time
-        p_sim_on = np.product(activities[:, link], axis=1)
-        # probability that none of the other nodes is active
-        p_no_coll = np.product(1.0 - activities[:, others], axis=1)
-        p_rendz[:, i] = p_sim_on * p_no_coll
-    return p_rendz
+    # Computed node-major (one contiguous row per node), so that gathering the members of all links is cheap
+    act = np.ascontiguousarray(np.asarray(activities, dtype=np.float64).T)
+    links = list(combinations(range(act.shape[0]), 2))
+    if not links:
+        return np.empty((act.shape[1], 0))
+    first, second = np.array(links).T
+
+    # probability that the two 'link' nodes are active at the same time
+    p_rendz = act[first] * act[second]
+    if act.shape[0] == 2:
+        return p_rendz.T # no other nodes that could collide
+
+    # log(1 - a) of every node is summed once per slot, the probability that none of the other nodes of a link is
+    # active is then the total minus the two link members. Nodes that are active for sure (a >= 1) have no logarithm,
+    # they are counted instead and any link with such a node among the others has no chance of rendezvous.
+    certain = act >= 1.0
+    log_idle = np.log1p(-np.where(certain, 0.0, act))
+    log_idle_others = log_idle.sum(axis=0) - log_idle[first]
+    log_idle_others -= log_idle[second]
+
+    # probability that none of the other nodes is active
+    p_rendz *= np.exp(log_idle_others, out=log_idle_others)
+    if certain.any():
+        certain_others = certain.sum(axis=0) - certain[first].astype(np.int64) - certain[second]
+        p_rendz[certain_others > 0] = 0.0
+
+    return p_rendz.T
+
+
+def configure_p_act_cache(maxsize: int = 64, directory: str = None, scale_digits: int = None):
+    """Configures the cache of 'p_act'.
+
+    Args:
+        maxsize (int): number of activity arrays kept in memory (least recently used ones are dropped first)
+        directory (str): directory where activity arrays are also stored as .npy files, e.g. to share them between
+            the workers of 'utils.opt_table' or between runs (None: memory only)
+        scale_digits (int): number of significant digits of a grid of scales. The activity of a scale is then
+            interpolated linearly between the activities of the two neighbouring grid scales, so that the nearby
+            scales probed by the optimizer share the n-fold convolutions of the grid scales, while the objective stays
+            continuous in the scale. The interpolated activities are approximate, their error shrinks with more
+            digits (None: exact scales)
+    """
+    global _p_act_cache_size, _p_act_cache_dir, _p_act_scale_digits
+
+    _p_act_cache_size = maxsize
+    _p_act_cache_dir = directory
+    _p_act_scale_digits = scale_digits
+    _p_act_cache.clear()
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+
+
+def _p_act_path(key):
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()
+    return os.path.join(_p_act_cache_dir, f"p_act_{digest}.npy")
 
 
 def p_act(scale: float, dist_name: str, t_chr: int, n_slots: int = 100000):
     """Calculates probability of activity for given distribution and charging time
 
+    Results are cached (see 'configure_p_act_cache'), the returned array is read-only. With a grid of scales
+    ('scale_digits'), scales between grid points are interpolated from the cached activities of their neighbours.
+
     Args:
         scale (float): scale parameter for distribution.
         dist_name (str): Name of probability distribution.
         t_chr (int): charging times (int or iterable).
         n_slots (int): Number of slots.
     """
+    scale = float(scale)
+    if _p_act_scale_digits is None or scale == 0:
+        return _p_act_cached(scale, dist_name, t_chr, n_slots)
+
+    # Neighbouring scales of the grid with 'scale_digits' significant digits
+    exponent = math.floor(math.log10(abs(scale))) - (_p_act_scale_digits - 1)
+    low = round(math.floor(scale / 10.0**exponent) * 10.0**exponent, -exponent)
+    high = round(low + 10.0**exponent, -exponent)
+    weight = (scale - low) / (high - low)
+    if weight <= 1e-12: return _p_act_cached(low, dist_name, t_chr, n_slots)
+
+    p_act_arr = (1 - weight) * _p_act_cached(low, dist_name, t_chr, n_slots) + weight * _p_act_cached(high, dist_name, t_chr, n_slots)
+    p_act_arr.setflags(write=False)
+    return p_act_arr
+
+
+def _p_act_cached(scale: float, dist_name: str, t_chr: int, n_slots: int):
+    key = (dist_name.lower(), scale, int(t_chr), int(n_slots))
+    p_act_arr = _p_act_cache.get(key)
+    if p_act_arr is not None:
+        _p_act_cache.move_to_end(key)
+        return p_act_arr
+
+    if _p_act_cache_dir is not None and os.path.exists(_p_act_path(key)):
+        p_act_arr = np.load(_p_act_path(key))
+    else:
+        p_act_arr = _calc_p_act(scale, dist_name, int(t_chr), int(n_slots))
+        if _p_act_cache_dir is not None:
+            # Written to a temporary file first, so that other processes never load a partial file
+            tmp_path = _p_act_path(key) + f".{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as fp: np.save(fp, p_act_arr)
+            os.replace(tmp_path, _p_act_path(key))
+
+    p_act_arr.setflags(write=False)
+    _p_act_cache[key] = p_act_arr
+    while len(_p_act_cache) > _p_act_cache_size:
+        _p_act_cache.popitem(last=False)
+
+    return p_act_arr
+
+
+def _calc_p_act(scale: float, dist_name: str, t_chr: int, n_slots: int):
     dist_class = getattr(dists, dist_name.lower().capitalize())
     dist = dist_class(scale)
     tot_support = t_chr + dist.min_support()
@@ -76,20 +209,52 @@ def p_act(scale: float, dist_name: str, t_chr: int, n_slots: int = 100000):
     n_wkups = int(n_slots / tot_support) - 1
     logger.debug(f"Calculating {n_wkups} wakeups")
 
+    # Wakeup i only adds to the slots from i * t_chr on, so the slots before are final. The convergence window (the
+    # last 10 * tot_support final slots) is kept as per-wakeup blocks of (size, mean, sum of squared deviations), which
+    # are combined into the standard deviation of the window without revisiting the slots (Chan et al.).
+    window = 10 * tot_support
+    blocks = deque()
+    n_window = 0
+
+    if hasattr(dist, "pmf_nsum_trimmed"): pmfs = dist.pmf_nsum_trimmed(n_wkups)
+    else: pmfs = ((0, pmf_wkup) for pmf_wkup in dist.pmf_nsum(n_wkups))
+
     p_act_arr = np.zeros((n_slots,))
-    for i, pmf_wkup in enumerate(dist.pmf_nsum(n_wkups)):
-        p_act_arr[i * t_chr : i * t_chr + len(pmf_wkup)] += pmf_wkup
-        if i * t_chr > 10 * tot_support:
-            ts_end = i * t_chr
-            ts_start = int(max(0, ts_end - 10 * tot_support))
-            if np.std(p_act_arr[ts_start:ts_end]) < 1e-9:
+    for i, (offset, pmf_wkup) in enumerate(pmfs):
+        ts_end = i * t_chr
+        start = min(n_slots, ts_end + offset)
+        end = min(n_slots, start + len(pmf_wkup))
+        p_act_arr[start:end] += pmf_wkup[: end - start]
+
+        if i == 0: continue
+        block = p_act_arr[ts_end - t_chr : ts_end]
+        mean = block.mean()
+        blocks.append((len(block), mean, np.dot(block - mean, block - mean)))
+        n_window += len(block)
+        while n_window - blocks[0][0] >= window:
+            n_window -= blocks.popleft()[0]
+
+        if ts_end > window:
+            if _window_std(blocks) < 1e-9:
                 logger.debug("Probability converged! fast-forwarding...")
+                ts_start = int(max(0, ts_end - window))
                 p_act_arr[ts_start:] = p_act_arr[ts_start]
                 return p_act_arr
 
     return p_act_arr
 
 
+def _window_std(blocks):
+    n, mean, m2 = 0, 0.0, 0.0
+    for n_b, mean_b, m2_b in blocks:
+        total = n + n_b
+        delta = mean_b - mean
+        mean += delta * n_b / total
+        m2 += m2_b + delta * delta * n * n_b / total
+        n = total
+    return math.sqrt(m2 / n)
+
+
 class Model(object):
     def __init__(
         self,
@@ -199,7 +364,8 @@ class Model(object):
         Returns:
             np.ndarray: Shape (n, l) array with cdf for rendezvous in n slots and l links
         """
-        if self.n_jobs == 1:
+        n_links = self.n_nodes * (self.n_nodes - 1) // 2
+        if self.n_jobs == 1 or self._activities.shape[0] * n_links < _min_parallel_size:
             p_rendz = act2rend(self._activities)
         else:
             partition_size = self.n_slots // self.n_jobs
@@ -212,9 +378,8 @@ class Model(object):
             idx_start = (self.n_jobs - 1) * partition_size
             idx_end = self.n_slots
             args.append((self._activities[idx_start:idx_end],))
-            with multiprocessing.Pool(self.n_jobs) as p:
-                logger.debug(f"Calculating rendezvous with {self.n_jobs} jobs")
-                results = p.starmap(act2rend, args)
+            logger.debug(f"Calculating rendezvous with {self.n_jobs} jobs")
+            results = _get_pool(self.n_jobs).starmap(act2rend, args)
 
             p_rendz = np.concatenate(results, axis=0)
 
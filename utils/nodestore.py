@@ -0,0 +1,208 @@
+'''
+Struct-of-arrays store of the state of a population of nodes.
+
+The scalar state of every node (stored energy, iteration, protocol state, target, counters, thresholds) lives in one
+numpy column per quantity, one row per node, instead of in the attribute dictionaries of the node objects. Fleets of
+thousands of nodes then cost a few bytes per node and quantity, and their state can be read (e.g. summarized) with
+vectorized operations. Code that wants per-node objects gets lightweight views ('NodeView', '__slots__' only), and
+'BatteryfreeDevice' is such a view itself, with slots for its references to the traces, models and other nodes.
+'''
+
+import numpy as np
+
+from utils.utils import node_index
+
+# Protocol states of the nodes (column 'state')
+FIND = 0
+BONITO = 1
+DONE = 2
+
+STATE_NAMES = ("Find", "Bonito", "Done")
+STATE_CODES = {name: code for code, name in enumerate(STATE_NAMES)}
+
+# Columns of the store and their types
+COLUMNS = {
+    "node_id": np.int64,                # integer id of the node (e.g. 12 for 'node12')
+    "iteration": np.int64,              # current iteration on the power trace
+    "estored": np.float64,              # stored energy (above the turn-off threshold)
+    "energy_per_cycle": np.float64,     # energy threshold to wake up
+    "max_energy_per_cycle": np.float64, # max energy limit
+    "state": np.int8,                   # FIND, BONITO or DONE
+    "target": np.int64,                 # row of the target node, -1 if none
+    "target_is_set": np.bool_,          # whether the node has a target
+    "wake_iteration": np.int64,         # iteration at which the node wakes up from its latest sleep cycle
+    "latest_tchrg": np.float64,         # charging time of the current sleep cycle (in secs)
+    "prev_tchrg": np.float64,           # latest charging time (in secs)
+    "curr_conn_no": np.int64,           # connection no. with the current target
+    "wakeup_cnt": np.int64,             # no. of wakeups
+    "bonito_wakeup_cnt": np.int64,      # no. of wakeups in 'Bonito' state
+    "connection_success": np.int64,     # no. of successful connections
+    "latest_tchrg_flag": np.bool_,      # whether the charging time of the current sleep cycle was recorded
+    "sleep_till": np.int64,             # iteration before which the node does not wake up
+    "wait_till": np.int64,              # last iteration the node waits for its target
+    "stopped": np.bool_,                # whether the node was stopped before the end of its trace
+    "task_runs": np.int64,              # no. of runs of the task of the node
+    "task_skips": np.int64,             # no. of runs of the task skipped for lack of energy
+    "energy_used": np.float64,          # energy consumed by the task and by handing packets over (in joules)
+    "energy_drained": np.float64,       # energy left at the end of the charging cycles, drained at every reset (in joules)
+    "packets_generated": np.int64,      # no. of packets produced by the node
+    "packets_dropped": np.int64,        # no. of packets produced while the buffer was full
+    "packets_forwarded": np.int64,      # no. of packets handed over to connected nodes
+}
+
+_defaults = {"target": -1, "wake_iteration": -1}
+
+
+class NodeStore(object):
+    """Columns of the state of a population of nodes, one row per node. Rows are added with 'add' and the columns grow
+    as needed (so hold on to the store, not to its columns, while nodes are being added).
+
+    Args:
+        capacity (int): number of rows allocated upfront
+    """
+
+    def __init__(self, capacity=16):
+        self.names = []
+        self._rows = {}
+        self._capacity = max(1, int(capacity))
+        for column, dtype in COLUMNS.items():
+            setattr(self, column, np.full((self._capacity,), _defaults.get(column, 0), dtype=dtype))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._rows
+
+    def add(self, name, node_id=None):
+        """Adds a node.
+
+        Args:
+            name (str): name of the node
+            node_id (int): integer id of the node (default: trailing digits of the name, e.g. 'node12' -> 12)
+
+        Returns:
+            (int): row of the node
+        """
+
+        if name in self._rows: raise KeyError(f"Node '{name}' is already in the store")
+
+        row = len(self.names)
+        if row == self._capacity: self._grow(2 * self._capacity)
+
+        self.names.append(name)
+        self._rows[name] = row
+        self.node_id[row] = node_index(name) if node_id is None else node_id
+        return row
+
+    def _grow(self, capacity):
+        for column in COLUMNS:
+            old = getattr(self, column)
+            new = np.full((capacity,), _defaults.get(column, 0), dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, column, new)
+        self._capacity = capacity
+
+    def row(self, name):
+        """Row of a node given its name."""
+        return self._rows[name]
+
+    def view(self, key):
+        """Per-node view of a row.
+
+        Args:
+            key (int or str): row or name of the node
+
+        Returns:
+            NodeView: view of the row
+        """
+
+        return NodeView(self, self._rows[key] if isinstance(key, str) else key)
+
+    def __iter__(self):
+        return (NodeView(self, row) for row in range(len(self)))
+
+    def column(self, column):
+        """Column of all the nodes in the store (a view, without the unused rows)."""
+        return getattr(self, column)[:len(self)]
+
+    def summary(self):
+        """Results of all the nodes, computed on the columns.
+
+        Returns:
+            (dict): arrays of the no. of wakeups, no. of wakeups in 'Bonito' state, no. of successful connections and success rate, in the order of the rows
+        """
+
+        n = len(self)
+        wakeups = self.wakeup_cnt[:n]
+        bonito_wakeups = self.bonito_wakeup_cnt[:n]
+        connections = self.connection_success[:n]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            success_rate = np.where(bonito_wakeups > 0, connections / np.maximum(bonito_wakeups, 1), np.nan)
+
+        return {"wakeups": wakeups.copy(), "bonito_wakeups": bonito_wakeups.copy(), "connections": connections.copy(), "success_rate": success_rate}
+
+
+class StoreField(object):
+    """Descriptor of an attribute kept in a column of a 'NodeStore'. The owner objects have the attributes 'store' and
+    'index' (row of the object). Reads return python scalars.
+
+    Args:
+        column (str): column of the store
+    """
+
+    __slots__ = ("column",)
+
+    def __init__(self, column):
+        self.column = column
+
+    def __get__(self, obj, objtype=None):
+        if obj is None: return self
+        return getattr(obj.store, self.column).item(obj.index)
+
+    def __set__(self, obj, value):
+        getattr(obj.store, self.column)[obj.index] = value
+
+
+class StateField(StoreField):
+    """Protocol state kept as code in the column 'state', read and written as name ('Find', 'Bonito' or 'Done')."""
+
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__("state")
+
+    def __get__(self, obj, objtype=None):
+        if obj is None: return self
+        return STATE_NAMES[obj.store.state.item(obj.index)]
+
+    def __set__(self, obj, value):
+        obj.store.state[obj.index] = STATE_CODES[value]
+
+
+class NodeView(object):
+    """Lightweight per-node object of a row of a 'NodeStore', with one attribute per column.
+
+    Args:
+        store (NodeStore): store of the node
+        index (int): row of the node
+    """
+
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def name(self):
+        return self.store.names[self.index]
+
+    currState = StateField()
+
+    def __repr__(self):
+        return f"NodeView({self.name!r}, iteration={self.iteration}, state={self.currState!r}, estored={self.estored})"
+
+
+for _column in COLUMNS:
+    setattr(NodeView, _column, StoreField(_column))
@@ -0,0 +1,135 @@
+'''
+Regenerates the table of optimized scales used by 'Find' (opt_scale.csv with the columns t_chr,x_opt,y).
+
+Every charging time of the grid is optimized independently ('utils.find.optimize_scale'), so the grid is spread over a
+pool of processes. Finished charging times are appended to a checkpoint file right away, and a run that was
+interrupted continues where it stopped when it is started again with the same output file.
+
+Usage:
+    python -m utils.opt_table --out utils/opt_scale.csv [--t_chr 5 100 5] [--n_nodes 2] [--workers 64] [--cache_dir DIR]
+'''
+
+import os
+import csv
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils.find import optimize_scale, clear_tables
+from utils.model import configure_p_act_cache
+
+columns = ["t_chr", "x_opt", "y"]
+
+
+def default_grid():
+    """Charging times (in slots) of the shipped opt_scale.csv."""
+    return list(range(5, 101, 5)) + list(range(150, 2601, 50))
+
+
+def read_table(path):
+    """Reads a table of optimized scales.
+
+    Args:
+        path (str): csv file with the columns t_chr,x_opt,y
+
+    Returns:
+        (dict): optimized scale and discovery latency (in slots) per charging time
+    """
+
+    if not os.path.exists(path): return {}
+
+    with open(path, newline="") as fp:
+        return {int(row["t_chr"]): (float(row["x_opt"]), float(row["y"])) for row in csv.DictReader(fp)}
+
+
+def write_table(path, table):
+    """Writes a table of optimized scales (descending charging times, like the shipped table).
+
+    Args:
+        path (str): csv file
+        table (dict): optimized scale and discovery latency (in slots) per charging time
+    """
+
+    with open(path, "w", newline="") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(columns)
+        for t_chr in sorted(table, reverse=True):
+            writer.writerow([t_chr, *table[t_chr]])
+
+    clear_tables(path) # 'Find' parses the new table on its next call
+
+
+def _optimize(t_chr, n_nodes):
+    # One process per charging time, so the model itself runs single-process
+    x_opt, y = optimize_scale(t_chr, n_nodes=n_nodes, n_jobs=1, full_output=True)
+    return t_chr, float(x_opt), float(y)
+
+
+def generate_table(t_chrs, out_path, n_nodes=2, workers=None, checkpoint_path=None, cache_dir=None, scale_digits=None):
+    """Optimizes the scale for every charging time of the grid in parallel and writes the table.
+
+    Args:
+        t_chrs (iterable): charging times (in slots)
+        out_path (str): path of the csv table
+        n_nodes (int): number of nodes in the clique
+        workers (int): number of worker processes (default: number of cpus)
+        checkpoint_path (str): csv file of the finished charging times (default: out_path + '.ckpt'). Removed once the table is complete.
+        cache_dir (str): directory of the activity probabilities shared by the workers (see 'utils.model.configure_p_act_cache')
+        scale_digits (int): significant digits of the grid of scales the activities of the probed scales are interpolated on (approximate, see 'utils.model.configure_p_act_cache')
+
+    Returns:
+        (dict): optimized scale and discovery latency (in slots) per charging time
+    """
+
+    if checkpoint_path is None: checkpoint_path = out_path + ".ckpt"
+
+    t_chrs = sorted(set(int(t_chr) for t_chr in t_chrs))
+    done = read_table(checkpoint_path)
+    todo = [t_chr for t_chr in t_chrs if t_chr not in done]
+    if done: print(f"Resuming: {len(t_chrs) - len(todo)}/{len(t_chrs)} charging times already optimized")
+
+    new_checkpoint = not os.path.exists(checkpoint_path)
+    with open(checkpoint_path, "a", newline="") as fp, ProcessPoolExecutor(max_workers=workers, initializer=configure_p_act_cache, initargs=(64, cache_dir, scale_digits)) as executor:
+        writer = csv.writer(fp)
+        if new_checkpoint:
+            writer.writerow(columns)
+            fp.flush()
+
+        # Largest charging times first, they take the longest
+        futures = {executor.submit(_optimize, t_chr, n_nodes): t_chr for t_chr in reversed(todo)}
+        for future in as_completed(futures):
+            try:
+                t_chr, x_opt, y = future.result()
+            except Exception as e:
+                print(f"t_chr={futures[future]} failed: {e!r}")
+                continue
+
+            done[t_chr] = (x_opt, y)
+            writer.writerow([t_chr, x_opt, y])
+            fp.flush()
+            os.fsync(fp.fileno())
+            print(f"t_chr={t_chr}: x_opt={x_opt:.6f} y={y:.3f} ({len(done)}/{len(t_chrs)})")
+
+    table = {t_chr: done[t_chr] for t_chr in t_chrs if t_chr in done}
+    write_table(out_path, table)
+    if len(table) == len(t_chrs): os.remove(checkpoint_path)
+
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Regenerate the table of optimized scales of Find")
+    parser.add_argument("--out", default="opt_scale.csv", help="output csv table (t_chr,x_opt,y)")
+    parser.add_argument("--t_chr", nargs=3, type=int, default=None, metavar=("START", "STOP", "STEP"), help="grid of charging times (in slots, STOP included), default: grid of the shipped table")
+    parser.add_argument("--n_nodes", type=int, default=2, help="number of nodes in the clique")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of cpus)")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint file (default: <out>.ckpt)")
+    parser.add_argument("--cache_dir", default=None, help="directory to cache activity probabilities in (shared by workers and runs)")
+    parser.add_argument("--scale_digits", type=int, default=None, help="significant digits of the grid of scales the activities of the probed scales are interpolated on, approximate (default: exact)")
+    cli_args = parser.parse_args()
+
+    if cli_args.t_chr is None: t_chrs = default_grid()
+    else: t_chrs = np.arange(cli_args.t_chr[0], cli_args.t_chr[1] + 1, cli_args.t_chr[2]).tolist()
+
+    table = generate_table(t_chrs, cli_args.out, cli_args.n_nodes, cli_args.workers, cli_args.checkpoint, cli_args.cache_dir, cli_args.scale_digits)
+    print(f"{len(table)}/{len(t_chrs)} charging times written to {os.path.abspath(cli_args.out)}")
@@ -0,0 +1,227 @@
+'''
+Profiling of the simulation runs.
+
+The hot paths of the nodes are instrumented with per-node counters, the ones marked with * are timed as well:
+
+    sleep_samples*      samples scanned by the charging engine in 'sleep'
+    wait_samples        samples spent in 'wait'
+    find_calls*         calls of 'Find'
+    ijcdf_calls*        calls of 'inverse_joint_cdf'
+    ijcdf_iterations    iterations of the Newton bisection in 'inverse_joint_cdf'
+    sgd_updates*        calls of 'sgd_update'
+    cache_misses        blocks read by a 'CachedDataset' (cache_prefetched: blocks that had been read ahead)
+    barrier_timeouts    handshakes whose listening window ended before all the parties arrived
+
+Profiling is off unless a 'Profiler' is enabled, and the instrumented code only checks 'profiling.active' then, so
+disabled profiling costs one attribute lookup per instrumented call. Runs are profiled with args["profile"] = True
+(see 'utils.simulation.simulate', or --profile of the runner), which writes the table of the counters to 'profile.csv'
+in the output directory and prints it together with the throughput (simulated secs per wall-clock sec).
+args["profile_interval"] additionally samples the stacks of the simulation threads every 'profile_interval' secs
+('SamplingProfiler') and writes the functions the threads spent their time in to 'profile_samples.csv'.
+'''
+
+import sys
+import csv
+import time
+import threading
+from collections import Counter, defaultdict
+
+# Profiler of the current run, None while profiling is disabled
+active = None
+
+
+def enable(profiler=None):
+    """Enables profiling.
+
+    Args:
+        profiler (Profiler): profiler the counts go to (default: a new one)
+
+    Returns:
+        Profiler: the active profiler
+    """
+
+    global active
+    active = profiler if profiler is not None else Profiler()
+    return active
+
+
+def disable():
+    """Disables profiling. Returns the profiler that was active."""
+
+    global active
+    profiler, active = active, None
+    return profiler
+
+
+class Profiler(object):
+    """Per-node counters and timers of a run.
+
+    Code that does not know the node it runs for (e.g. the distributions or the datasets) counts for the current node
+    of its thread, set by the node with 'set_node' before it calls into that code.
+    """
+
+    def __init__(self):
+        self.counts = defaultdict(Counter)  # node -> counter -> count
+        self.times = defaultdict(Counter)   # node -> timer -> secs
+        self.wall_start = None
+        self.wall_end = None
+        self._local = threading.local()
+
+    def set_node(self, node):
+        """Sets the node the counts of the calling thread go to by default."""
+        self._local.node = node
+
+    @property
+    def node(self):
+        return getattr(self._local, "node", None)
+
+    def count(self, name, n=1, node=None):
+        self.counts[self.node if node is None else node][name] += n
+
+    def add_time(self, name, secs, node=None):
+        self.times[self.node if node is None else node][name] += secs
+
+    def start(self):
+        self.wall_start = time.perf_counter()
+
+    def stop(self):
+        self.wall_end = time.perf_counter()
+
+    @property
+    def wall_time(self):
+        """Wall-clock secs between 'start' and 'stop' (or now, if not stopped yet)."""
+        if self.wall_start is None: return 0.0
+        return (self.wall_end if self.wall_end is not None else time.perf_counter()) - self.wall_start
+
+    def throughput(self, sim_secs):
+        """Simulated secs per wall-clock sec.
+
+        Args:
+            sim_secs (float): simulated time of the run (in secs)
+        """
+
+        wall = self.wall_time
+        return sim_secs / wall if wall > 0 else float("nan")
+
+    def summary_table(self):
+        """Counters and timers of all nodes.
+
+        Returns:
+            (list): one row (dict) per node and counter or timer, with the keys 'node', 'name', 'count' and 'secs' (empty if not timed / not counted)
+        """
+
+        rows = []
+        for node in sorted(set(self.counts) | set(self.times), key=lambda node: (node is None, str(node))):
+            counts, times = self.counts.get(node, {}), self.times.get(node, {})
+            for name in sorted(set(counts) | set(times)):
+                rows.append({"node": node, "name": name, "count": counts.get(name, ""), "secs": times.get(name, "")})
+        return rows
+
+    def totals(self):
+        """Counters and timers summed over the nodes.
+
+        Returns:
+            (tuple): counter -> count and timer -> secs
+        """
+
+        counts, times = Counter(), Counter()
+        for node_counts in self.counts.values(): counts.update(node_counts)
+        for node_times in self.times.values(): times.update(node_times)
+        return counts, times
+
+    def format_table(self, sim_secs=None):
+        """Text table of the counters and timers summed over the nodes, with the throughput of the run if 'sim_secs' is given."""
+
+        counts, times = self.totals()
+        lines = [f"{'':<20}{'count':>14}{'secs':>12}"]
+        for name in sorted(set(counts) | set(times)):
+            secs = f"{times[name]:>12.3f}" if name in times else f"{'':>12}"
+            lines.append(f"{name:<20}{counts.get(name, ''):>14}{secs}")
+        lines.append(f"{'wall time':<20}{'':>14}{self.wall_time:>12.3f}")
+        if sim_secs is not None:
+            lines.append(f"Throughput: {self.throughput(sim_secs):.3f} simulated secs per wall-clock sec ({sim_secs:.3f} s simulated)")
+        return "\n".join(lines)
+
+    def write(self, path):
+        """Writes the summary table (see 'summary_table') to a csv file."""
+
+        with open(path, "w", newline="") as fp:
+            writer = csv.DictWriter(fp, fieldnames=["node", "name", "count", "secs"])
+            writer.writeheader()
+            writer.writerows(self.summary_table())
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of threads from a background thread, at a fixed wall-clock interval. Every sample is counted
+    for the innermost function ('self') and for all the functions on the stack ('total'), or handed to 'hook'.
+
+    Args:
+        interval (float): secs between two samples
+        threads (list): threads to sample (default: all threads except the sampling one)
+        hook (callable): called with the thread id and the innermost frame of every sampled stack instead of counting it
+    """
+
+    def __init__(self, interval=0.005, threads=None, hook=None):
+        self.interval = interval
+        self.threads = threads
+        self.hook = hook
+        self.self_counts = Counter()  # (file, line, function) of the innermost frame -> samples
+        self.total_counts = Counter() # (file, function) on the stack -> samples
+        self.n_samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None: self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            thread_ids = None if self.threads is None else {thread.ident for thread in self.threads}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (thread_ids is not None and thread_id not in thread_ids): continue
+                if self.hook is not None: self.hook(thread_id, frame)
+                else: self.record(frame)
+
+    def record(self, frame):
+        """Counts a stack given its innermost frame."""
+
+        self.n_samples += 1
+        code = frame.f_code
+        self.self_counts[(code.co_filename, frame.f_lineno, code.co_name)] += 1
+
+        seen = set()
+        while frame is not None:
+            key = (frame.f_code.co_filename, frame.f_code.co_name)
+            if key not in seen:
+                seen.add(key)
+                self.total_counts[key] += 1
+            frame = frame.f_back
+
+    def top(self, n=20):
+        """Functions the sampled threads spent the most time in.
+
+        Returns:
+            (list): (file, function, share of the samples with the function innermost, share with the function anywhere on the stack), most frequent innermost first
+        """
+
+        self_by_function = Counter()
+        for (filename, _, function), samples in self.self_counts.items(): self_by_function[(filename, function)] += samples
+
+        n_samples = max(1, self.n_samples)
+        keys = sorted(self.total_counts, key=lambda key: (-self_by_function[key], -self.total_counts[key]))[:n]
+        return [(*key, self_by_function[key] / n_samples, self.total_counts[key] / n_samples) for key in keys]
+
+    def write(self, path):
+        """Writes the sampled functions (see 'top') to a csv file."""
+
+        with open(path, "w", newline="") as fp:
+            writer = csv.writer(fp)
+            writer.writerow(["file", "function", "self", "total"])
+            writer.writerows(self.top(len(self.total_counts)))
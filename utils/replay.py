@@ -0,0 +1,108 @@
+'''
+Replays the charging times logged in a previous simulation run (event log or text runtime logs) to warm-start the charging time models of the nodes.
+
+Usage:
+    python -m utils.replay <output_dir of a previous run> [--model norm|exp|gmm]
+'''
+
+import os
+import re
+import argparse
+import numpy as np
+
+from utils.utils import node_index
+from utils import eventlog as ev
+
+from utils.distributions import NormalDistribution
+from utils.distributions import ExponentialDistribution
+from utils.distributions import GaussianMixtureModel
+
+model_map = {"norm": NormalDistribution, "exp": ExponentialDistribution, "gmm": GaussianMixtureModel}
+
+_tchrg_pattern = re.compile(r"woke up! Charging time:\s*([-+0-9.eE]+)s")
+
+
+def read_charging_times(path):
+    """Reads all the charging times logged in a runtime log file, in the order the node learned them.
+
+    Args:
+        path (str): path of a 'runtime_logs_<node>.txt' file
+
+    Returns:
+        np.ndarray: charging times (in secs)
+    """
+
+    with open(path) as fp:
+        tchrgs = [float(match.group(1)) for match in map(_tchrg_pattern.search, fp) if match]
+
+    return np.array(tchrgs, dtype=np.float64)
+
+
+def read_logged_charging_times(events, name):
+    """Reads all the charging times of a node from the records of an event log, in the order the node learned them.
+
+    Args:
+        events (np.ndarray): structured array of records (see utils.eventlog)
+        name (str): name of the node
+
+    Returns:
+        np.ndarray: charging times (in secs)
+    """
+
+    mask = (events["node"] == node_index(name)) & (events["code"] == ev.WOKE_CHARGED)
+    return np.asarray(events["value"][mask], dtype=np.float64)
+
+
+def _find_event_log(run_dir):
+    for ext in ("npy", "h5", "parquet"):
+        path = os.path.join(run_dir, f"events.{ext}")
+        if os.path.exists(path): return path
+    return None
+
+
+def warm_start(dists, run_dir):
+    """Fits the charging time models to the charging times logged by the same nodes in a previous run.
+
+    The event log of the run is used if there is one, else the text runtime logs (older runs or rendered logs).
+
+    Args:
+        dists (dict): dictionary of charging time distribution of all nodes (updated in place)
+        run_dir (str): output directory of the previous run
+
+    Returns:
+        (dict): number of charging times replayed per node
+    """
+
+    events_path = _find_event_log(run_dir)
+    events = ev.read_events(events_path) if events_path else None
+
+    n_replayed = {}
+    for name, dist in dists.items():
+        if events is not None:
+            tchrgs = read_logged_charging_times(events, name)
+            if not len(tchrgs): continue
+        else:
+            path = os.path.join(run_dir, f"runtime_logs_{name}.txt")
+            if not os.path.exists(path): continue
+            tchrgs = read_charging_times(path)
+
+        dist.fit_stream(tchrgs)
+        n_replayed[name] = len(tchrgs)
+
+    return n_replayed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit charging time models to the charging times of a previous run")
+    parser.add_argument("run_dir", help="output directory of the previous run")
+    parser.add_argument("--model", default="norm", choices=model_map.keys(), help="charging time model fitted to every node")
+    cli_args = parser.parse_args()
+
+    events_path = _find_event_log(cli_args.run_dir)
+    if events_path: names = [f"node{node}" for node in np.unique(ev.read_events(events_path)["node"]).tolist()]
+    else: names = sorted(f[len("runtime_logs_"):-len(".txt")] for f in os.listdir(cli_args.run_dir) if f.startswith("runtime_logs_"))
+    dists = {name: model_map[cli_args.model]() for name in names}
+    n_replayed = warm_start(dists, cli_args.run_dir)
+
+    for name, dist in dists.items():
+        print(f"{name}: {n_replayed.get(name, 0)} charging times -> {np.array2string(dist._mp, precision=6)}")
@@ -0,0 +1,127 @@
+'''
+Monte Carlo replications of the simulation.
+
+Every configuration is simulated R times on a pool of processes. Replication r of a configuration with seed s gives
+every node its own random number generator, spawned from np.random.SeedSequence(s, spawn_key=(r,)) (see
+'utils.simulation.simulate'), so the replications are independent of each other and every single one can be
+reproduced. The results of the nodes are aggregated over the replications into means with t-based confidence intervals.
+
+Usage:
+    python -m utils.replications --replications 30 --trace_file pwr_office.h5 --seed 7 --pairs node0:node2 [--confidence 0.95]
+
+Takes the arguments of 'utils/runner.py' (swept parameters included). The results of all runs are written to --out and
+the aggregated results to <out>_summary.csv.
+'''
+
+import os
+import csv
+import math
+import numpy as np
+from scipy.stats import t as student_t
+
+from utils.runner import build_parser, read_config, run_sweep, expand_grid
+
+metrics = ["wakeups", "bonito_wakeups", "connections", "success_rate", "delay", "delivered", "drop_rate", "throughput", "latency"]
+
+
+def confidence_interval(values, confidence=0.95):
+    """Mean of a sample with the confidence interval of the t-distribution. NaN values (e.g. undefined success rates) are ignored.
+
+    Args:
+        values (iterable): sample
+        confidence (float): confidence level
+
+    Returns:
+        (tuple): mean, lower and upper bound of the interval and the size of the sample
+    """
+
+    x = np.asarray([float(v) for v in values], dtype=np.float64)
+    x = x[~np.isnan(x)]
+    n = len(x)
+    if n == 0: return math.nan, math.nan, math.nan, 0
+
+    mean = float(x.mean())
+    if n == 1: return mean, math.nan, math.nan, 1
+
+    half_width = float(student_t.ppf(0.5 + confidence / 2, n - 1) * x.std(ddof=1) / math.sqrt(n))
+    return mean, mean - half_width, mean + half_width, n
+
+
+def aggregate(rows, group_keys, confidence=0.95):
+    """Aggregates the results of the replications.
+
+    Args:
+        rows (list): results of the runs (dict per node and run, see 'utils.runner.run_sweep')
+        group_keys (list): parameters that define a configuration (the swept ones, without 'replication')
+        confidence (float): confidence level of the intervals
+
+    Returns:
+        (list): one row (dict) per configuration and node, with the mean, the bounds of the confidence interval and the number of replications of every metric
+    """
+
+    groups = {}
+    for row in rows:
+        if row.get("error"): continue
+        key = tuple(row[k] for k in group_keys) + (row["node"],)
+        groups.setdefault(key, []).append(row)
+
+    summary = []
+    for key, group in groups.items():
+        out = dict(zip(group_keys + ["node"], key))
+        out["replications"] = len(group)
+        for metric in metrics:
+            mean, low, high, _ = confidence_interval((row[metric] for row in group), confidence)
+            out[metric] = mean
+            out[f"{metric}_ci_low"] = low
+            out[f"{metric}_ci_high"] = high
+        summary.append(out)
+
+    return summary
+
+
+def replicate(config, n_replications, out_path, workers=None, confidence=0.95):
+    """Runs every configuration of a sweep n_replications times and aggregates the results.
+
+    Args:
+        config (dict): configuration (see 'utils.runner.expand_grid')
+        n_replications (int): number of replications per configuration
+        out_path (str): csv table of the results of all runs. The aggregated results are written to <out>_summary.csv.
+        workers (int): number of worker processes (default: number of cpus)
+        confidence (float): confidence level of the intervals
+
+    Returns:
+        (list): aggregated results (see 'aggregate')
+    """
+
+    config = dict(config, replication=list(range(n_replications)))
+    rows = run_sweep(config, out_path, workers)
+
+    group_keys = [key for key in expand_grid(config)[0] if key != "replication"]
+    summary = aggregate(rows, group_keys, confidence)
+
+    columns = group_keys + ["node", "replications"] + [f"{metric}{suffix}" for metric in metrics for suffix in ("", "_ci_low", "_ci_high")]
+    with open(summary_path(out_path), "w", newline="") as fp:
+        writer = csv.DictWriter(fp, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(summary)
+
+    return summary
+
+
+def summary_path(out_path):
+    root, ext = os.path.splitext(out_path)
+    return root + "_summary" + (ext or ".csv")
+
+
+if __name__ == "__main__":
+    parser = build_parser("Run Monte Carlo replications of the simulation without GUI")
+    parser.add_argument("--replications", type=int, default=10, help="number of replications per configuration")
+    parser.add_argument("--confidence", type=float, default=0.95, help="confidence level of the intervals")
+    cli_args = vars(parser.parse_args())
+    config = read_config(parser, cli_args)
+
+    summary = replicate(config, cli_args["replications"], cli_args["out"], cli_args["workers"], cli_args["confidence"])
+    for row in summary:
+        print(f"{row['node']}: success rate {row['success_rate']:.3f} [{row['success_rate_ci_low']:.3f}, {row['success_rate_ci_high']:.3f}], "
+              f"delay {row['delay']:.3f} [{row['delay_ci_low']:.3f}, {row['delay_ci_high']:.3f}], wakeups {row['wakeups']:.1f} ({row['replications']} replications)")
+    print(f"Aggregated results written to {os.path.abspath(summary_path(cli_args['out']))}")
@@ -0,0 +1,248 @@
+'''
+Columnar results store of the simulation runs.
+
+Every run writes one hdf5 file ('results.h5' in its output directory) holding:
+
+    attrs                    run parameters (json), seed, replication and run name
+    summary/<column>         one entry per node: name, node_id, wakeups, bonito_wakeups, connections, success_rate, delay,
+                             and the packets of the tasks (see utils/tasking.py): generated, delivered, dropped, latency
+    conn_ints/values         connection intervals of all nodes, concatenated (in secs)
+    conn_ints/offsets        start of the values of every node (len(nodes) + 1 entries)
+    bonito_tchrgs/values     charging times the connection intervals were computed with (in secs), same layout
+    bonito_tchrgs/offsets
+    latencies/values         end-to-end latencies of the packets every node received as destination (in secs), same layout
+    latencies/offsets
+    links/<column>           one entry per link of runs with links to many neighbours (see utils/topology.py): a, b, connections, delay
+
+The summaries of many runs are loaded into one pandas DataFrame without reading the arrays ('load_summaries'), which
+are read on demand ('RunResults'). The old text summaries can be rendered from a results file:
+
+    python -m utils.results <results.h5> [--out <directory>]
+'''
+
+import os
+import json
+import argparse
+import h5py
+import numpy as np
+
+RESULTS_FILE = "results.h5"
+
+summary_columns = ["wakeups", "bonito_wakeups", "connections", "success_rate", "delay", "generated", "delivered", "dropped", "drop_rate", "throughput", "latency", "task_runs", "task_skips", "energy_used", "energy_drained"]
+
+# Parameters that differ between any two runs without being parameters of the simulation
+_bookkeeping = {"output_dir", "start_time", "run_name"}
+
+
+def _json_params(args):
+    # Parameters that can be stored as json (objects like the stop event, the plot axes or the traces are skipped)
+    params = {}
+    for key, value in args.items():
+        if isinstance(value, np.generic): value = value.item()
+        try: json.dumps(value)
+        except TypeError: continue
+        params[key] = value
+    return params
+
+
+def _write_ragged(group, arrays):
+    lengths = [len(values) for values in arrays]
+    group.create_dataset("offsets", data=np.concatenate(([0], np.cumsum(lengths))).astype(np.int64))
+    group.create_dataset("values", data=np.concatenate([np.asarray(values, dtype=np.float64) for values in arrays]) if arrays else np.zeros((0,)))
+
+
+def write_results(path, args, sim_nodes, summary, topology=None):
+    """Writes the results of a run.
+
+    Args:
+        path (str): output hdf5 file
+        args (dict): parameters of the run
+        sim_nodes (iterable): 'BatteryfreeDevice' objects of the run
+        summary (dict): results per node name ('utils.simulation.summarize'), stored as the columns 'summary_columns'
+        topology (Topology): links of the nodes, if any (see utils/topology.py)
+    """
+
+    sim_nodes = list(sim_nodes)
+
+    with h5py.File(path, "w") as hf:
+        hf.attrs["params"] = json.dumps(_json_params(args))
+        hf.attrs["seed"] = int(args.get("seed", -1))
+        hf.attrs["replication"] = int(args.get("replication", 0))
+        hf.attrs["run_name"] = str(args.get("run_name") or "")
+
+        group = hf.create_group("summary")
+        group.create_dataset("name", data=np.array([node.name for node in sim_nodes], dtype=h5py.string_dtype()))
+        group.create_dataset("node_id", data=np.array([node.node_id for node in sim_nodes], dtype=np.int64))
+        for column in summary_columns: group.create_dataset(column, data=np.array([summary[node.name][column] for node in sim_nodes]))
+
+        _write_ragged(hf.create_group("conn_ints"), [node.conn_ints for node in sim_nodes])
+        _write_ragged(hf.create_group("bonito_tchrgs"), [node.bonito_tchrgs for node in sim_nodes])
+        _write_ragged(hf.create_group("latencies"), [node.latencies for node in sim_nodes])
+
+        if topology is not None:
+            links = hf.create_group("links")
+            for column, values in topology.summary().items():
+                links.create_dataset(column, data=values.astype(h5py.string_dtype()) if values.dtype == object else values)
+
+
+class RunResults(object):
+    """Lazy access to the results file of a run. Only the parts that are used are read.
+
+    Args:
+        path (str): results file or output directory of the run
+    """
+
+    def __init__(self, path):
+        self.path = os.path.join(path, RESULTS_FILE) if os.path.isdir(path) else path
+        self._params = None
+        self._nodes = None
+
+    def _read_header(self):
+        with h5py.File(self.path, "r") as hf:
+            self._params = json.loads(hf.attrs["params"])
+            self._params.update(seed=int(hf.attrs["seed"]), replication=int(hf.attrs["replication"]), run_name=str(hf.attrs["run_name"]))
+            self._nodes = [name.decode() if isinstance(name, bytes) else name for name in hf["summary/name"][:]]
+
+    @property
+    def params(self):
+        """Parameters of the run (dict), including seed and replication."""
+        if self._params is None: self._read_header()
+        return self._params
+
+    @property
+    def nodes(self):
+        """Names of the nodes of the run."""
+        if self._nodes is None: self._read_header()
+        return self._nodes
+
+    def summary(self):
+        """Summaries of the nodes.
+
+        Returns:
+            (dict): column name -> numpy array (one entry per node)
+        """
+
+        with h5py.File(self.path, "r") as hf:
+            columns = {"node": np.array(self.nodes, dtype=object), "node_id": hf["summary/node_id"][:]}
+            for column in summary_columns:
+                if column in hf["summary"]: columns[column] = hf["summary"][column][:] # Results of older runs lack the packet, rate and energy columns
+        return columns
+
+    def links(self):
+        """Results of the links of a run with links to many neighbours.
+
+        Returns:
+            (dict): column name -> numpy array (one entry per link), None if the run had no links
+        """
+
+        with h5py.File(self.path, "r") as hf:
+            if "links" not in hf: return None
+            columns = {column: hf["links"][column][:] for column in hf["links"]}
+        for column in ("a", "b"): columns[column] = np.array([name.decode() if isinstance(name, bytes) else name for name in columns[column]], dtype=object)
+        return columns
+
+    def _ragged(self, group, node):
+        i = self.nodes.index(node)
+        with h5py.File(self.path, "r") as hf:
+            start, stop = hf[group]["offsets"][i : i + 2]
+            return hf[group]["values"][start:stop]
+
+    def conn_ints(self, node):
+        """Connection intervals of a node (in secs)."""
+        return self._ragged("conn_ints", node)
+
+    def bonito_tchrgs(self, node):
+        """Charging times the connection intervals of a node were computed with (in secs)."""
+        return self._ragged("bonito_tchrgs", node)
+
+    def latencies(self, node):
+        """End-to-end latencies of the packets a node received as destination (in secs)."""
+        return self._ragged("latencies", node)
+
+
+def find_runs(root):
+    """Paths of the results files of all the runs below a directory (e.g. the logs of a dataset)."""
+
+    paths = []
+    for dirpath, _, filenames in os.walk(root):
+        if RESULTS_FILE in filenames: paths.append(os.path.join(dirpath, RESULTS_FILE))
+    return sorted(paths)
+
+
+def load_summaries(runs, params=None, **where):
+    """Loads the node summaries of many runs into one table, one row per run and node. Only the summaries and the
+    parameters are read, the arrays of the runs stay on disk.
+
+    Args:
+        runs (str or list): directory to search for runs (see 'find_runs') or list of results files / output directories
+        params (list): parameters of the runs added as columns (default: all the simulation parameters that differ between the runs)
+        **where: only runs whose parameters have the given values (e.g. capacity=17e-6)
+
+    Returns:
+        (pandas.DataFrame): columns 'path', the parameters, 'node', 'node_id' and the summary columns
+    """
+
+    import pandas as pd
+
+    if isinstance(runs, str): runs = find_runs(runs)
+
+    loaded = [RunResults(path) for path in runs]
+    loaded = [run for run in loaded if all(run.params.get(key) == value for key, value in where.items())]
+
+    if params is None:
+        keys = sorted(set().union(*(run.params for run in loaded))) if loaded else []
+        params = [key for key in keys if key not in _bookkeeping and len({json.dumps(run.params.get(key), sort_keys=True) for run in loaded}) > 1]
+
+    frames = []
+    for run in loaded:
+        columns = run.summary()
+        frame = pd.DataFrame(columns)
+        for key in reversed(params): frame.insert(0, key, [run.params.get(key)] * len(frame))
+        frame.insert(0, "path", run.path)
+        frames.append(frame)
+
+    if not frames: return pd.DataFrame(columns=["path"] + list(params) + ["node", "node_id"] + summary_columns)
+    return pd.concat(frames, ignore_index=True)
+
+
+def render_text(run, node):
+    """Renders the summary of a node in the format of the old 'metadata_<node>.txt' files.
+
+    Args:
+        run (RunResults): results of the run
+        node (str): name of the node
+
+    Returns:
+        (str): text of the summary
+    """
+
+    columns = run.summary()
+    i = run.nodes.index(node)
+    success_rate = columns["success_rate"][i]
+
+    lines = [
+        "---------------------\n", "Simulation Parameters\n", "---------------------\n",
+        f"\nRandom Seed: {run.params['seed']}", "\n\n",
+        "-------\n", "Results\n", "-------\n",
+        f"Total simulation time: {run.params.get('sim_time')} mins\n",
+        f"Total no. of wakeups: {columns['wakeups'][i]}\n",
+        f"No. of wakeups in 'Bonito' state: {columns['bonito_wakeups'][i]}\n",
+        f"No. of successful connections: {columns['connections'][i]}\n",
+        "Success Rate: Undefined%\n" if np.isnan(success_rate) else f"Success Rate: {success_rate*100:.2f}%\n",
+        f"Delay: {columns['delay'][i]:.3f}s\n",
+    ]
+    return "".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render the text summaries (metadata_<node>.txt) of a run from its results file")
+    parser.add_argument("path", help="results file or output directory of the run")
+    parser.add_argument("--out", default=None, help="output directory (default: directory of the results file)")
+    cli_args = parser.parse_args()
+
+    run = RunResults(cli_args.path)
+    out_dir = cli_args.out or os.path.dirname(os.path.abspath(run.path))
+
+    for node in run.nodes:
+        with open(os.path.join(out_dir, f"metadata_{node}.txt"), "w") as fp:
+            fp.write(render_text(run, node))
@@ -0,0 +1,232 @@
+'''
+Run-length compaction of the power traces.
+
+Long stretches of a power trace hold the same value (e.g. zero while it is dark indoors). A compacted trace keeps one
+segment (first sample, power) per run of equal values, stored next to the original trace in the hdf5 file:
+
+    rle/nodeX/starts    first sample of every segment (int64)
+    rle/nodeX/values    power of every segment (float64)
+
+While a node sleeps on a compacted trace, the charging engine jumps from segment to segment ('charge_until') instead
+of visiting every sample, with bit for bit the same wake-up iterations and stored energy as the per-sample loop of
+'utils.engine'. Traces are compacted once with:
+
+    python -m utils.rle data/pwr_office.h5 [--nodes node0 node1]
+
+and read compacted with DataReader(path, backend="rle").
+'''
+
+import math
+import argparse
+import h5py
+import numpy as np
+
+from utils import engine
+
+
+class RunLengthDataset(object):
+    """Power trace stored as run-length segments. Indexing and slicing expand the segments, so the trace can be used
+    like any other trace, and 'charge_until' works on the segments directly.
+
+    Args:
+        starts: first sample of every segment (starts[0] == 0)
+        values: value of every segment
+        length: number of samples of the trace
+    """
+
+    def __init__(self, starts, values, length):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.length = int(length)
+        self.ends = np.append(self.starts[1:], self.length)
+
+    @classmethod
+    def from_group(cls, group):
+        """Reads the segments of a trace from its 'rle/nodeX' group."""
+        return cls(group["starts"][:], group["values"][:], group.attrs["length"])
+
+    def segment(self, idx):
+        """Index of the segment holding a sample."""
+        return int(np.searchsorted(self.starts, idx, side="right")) - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if start >= stop: return np.empty((0,), dtype=np.float64)
+            first, last = self.segment(start), self.segment(stop - 1)
+            edges = np.concatenate(([start], self.starts[first + 1 : last + 1], [stop]))
+            values = np.repeat(self.values[first : last + 1], np.diff(edges))
+            return values[::step] if step != 1 else values
+
+        if key < 0: key += len(self)
+        if not 0 <= key < len(self): raise IndexError("index out of range")
+        return self.values[self.segment(key)]
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def compression(self):
+        """Number of samples per segment."""
+        return self.length / max(1, len(self.starts))
+
+
+def compact(values, block_size=1 << 22):
+    """Run-length segments of a trace.
+
+    Args:
+        values: trace (numpy array or hdf5 dataset), read in blocks
+        block_size (int): number of values per block
+
+    Returns:
+        (tuple): first sample and value of every segment
+    """
+
+    starts, seg_values = [], []
+    prev = None
+    for offset in range(0, len(values), block_size):
+        block = np.asarray(values[offset : offset + block_size], dtype=np.float64)
+        change = np.flatnonzero(block[1:] != block[:-1]) + 1
+        if prev is None or block[0] != prev: change = np.concatenate(([0], change)) # new segment at the block border
+        starts.append(change + offset)
+        seg_values.append(block[change])
+        prev = block[-1]
+
+    if not starts: return np.zeros((0,), dtype=np.int64), np.zeros((0,))
+    return np.concatenate(starts).astype(np.int64), np.concatenate(seg_values)
+
+
+def write_rle(path, nodes=None):
+    """Compacts the traces of an hdf5 file and stores the segments in the same file ('rle/nodeX').
+
+    Args:
+        path (str): hdf5 trace file (format of 'DataReader')
+        nodes (list): names of the nodes to compact (default: all)
+
+    Returns:
+        (dict): compression (samples per segment) of every compacted node
+    """
+
+    compression = {}
+    with h5py.File(path, "a") as hf:
+        rle = hf.require_group("rle")
+        for node in nodes or list(hf["data"].keys()):
+            dataset = hf["data"][node]
+            starts, values = compact(dataset)
+
+            if node in rle: del rle[node]
+            group = rle.create_group(node)
+            group.create_dataset("starts", data=starts)
+            group.create_dataset("values", data=values)
+            group.attrs["length"] = len(dataset)
+            compression[node] = len(dataset) / max(1, len(starts))
+
+    return compression
+
+
+def _first_reaching(x, step, n, x_n, threshold):
+    """Smallest k in [0, n] for which adding 'step' (> 0) k times to x reaches the threshold, n + 1 if there is none.
+    'x_n' is the value after n additions."""
+
+    if x >= threshold: return 0
+    if x_n < threshold: return n + 1
+
+    # The stored energy does not decrease. Rounding moves the crossing by a few additions at most, so it is bracketed
+    # around the exact-arithmetic estimate (galloping) and then found by bisection.
+    k = min(n, max(1, math.ceil((threshold - x) / step)))
+    if engine.repeat_add(x, step, k) >= threshold:
+        lo, hi, d = k - 1, k, 1
+        while lo > 0 and engine.repeat_add(x, step, lo) >= threshold:
+            hi, d = lo, 2 * d
+            lo = max(0, hi - d)
+    else:
+        lo, hi, d = k, min(n, k + 1), 1
+        while engine.repeat_add(x, step, hi) < threshold:
+            lo, d = hi, 2 * d
+            hi = min(n, lo + d)
+
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if engine.repeat_add(x, step, mid) >= threshold: hi = mid
+        else: lo = mid
+    return hi
+
+
+def charge_until(pwr, Ts, start, stop, estored, e_on, e_max, sleep_till):
+    """Drop-in replacement of 'utils.engine.charge_until' for run-length compacted traces (see there for the
+    arguments). Every segment of non-negative power is handled at once: the stored energy after k samples is computed
+    with 'utils.engine.repeat_add', which rounds exactly like k sequential additions, and the samples at which the node
+    reaches the wake-up threshold and the clamp are found by bisection. Segments of negative power fall back to the
+    per-sample engine.
+
+    Args:
+        pwr (RunLengthDataset): compacted power trace
+
+    Returns:
+        (tuple): iteration at which the node wakes up, stored energy at that iteration and the number of harvested
+                 samples after which the node was still below the wake-up threshold (i.e. charging time in slots)
+    """
+
+    it = int(start)
+    stop = min(int(stop), len(pwr))
+    estored = float(estored)
+    n_uncharged = 0
+    seg = pwr.segment(it)
+
+    while it < stop:
+        if estored >= e_on and it >= sleep_till: break
+
+        if estored >= e_max:
+            # Clamped: the stored energy does not change anymore, no need to look at the trace
+            if estored >= e_on:
+                it = max(it, min(stop, sleep_till))
+            else:
+                n_uncharged += stop - it
+                it = stop
+            break
+
+        while pwr.ends[seg] <= it: seg += 1
+        seg_end = min(stop, int(pwr.ends[seg]))
+        step = Ts * pwr.values[seg]
+
+        if step < 0:
+            it, estored, n_unch = engine.charge_until(pwr, Ts, it, seg_end, estored, e_on, e_max, sleep_till)
+            n_uncharged += n_unch
+            continue
+
+        # Same bookkeeping as a block of the vectorized engine, with the running sum of the segment in closed form
+        n = seg_end - it
+        j_min = sleep_till - it
+        if step == 0:
+            # Nothing harvested, only the wake-up condition can end the sleep cycle
+            x_n = estored
+            j_max = n + 1
+            j_on = 0 if estored >= e_on else n + 1
+        else:
+            x_n = engine.repeat_add(estored, step, n)
+            j_max = _first_reaching(estored, step, n, x_n, e_max)  # Samples until the clamp is reached
+            j_on = _first_reaching(estored, step, n, x_n, e_on)    # Samples until the node is charged
+        if j_on > j_max: j_on = math.inf                            # Threshold above the clamp, never charged
+
+        j_exit = max(j_on, j_min, 0)
+        done = j_exit <= n
+        j_end = j_exit if done else n
+
+        n_uncharged += max(0, min(j_end, j_on - 1))
+        j_stored = min(j_end, j_max)
+        estored = x_n if j_stored == n else engine.repeat_add(estored, step, j_stored)
+        it += j_end
+
+        if done: break
+
+    return it, estored, n_uncharged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact the power traces of an hdf5 trace file into run-length segments")
+    parser.add_argument("path", help="hdf5 trace file")
+    parser.add_argument("--nodes", nargs="+", default=None, help="nodes to compact (default: all)")
+    cli_args = parser.parse_args()
+
+    for node, factor in write_rle(cli_args.path, cli_args.nodes).items():
+        print(f"{node}: {factor:.1f} samples per segment")
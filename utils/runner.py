@@ -0,0 +1,235 @@
+'''
+Headless batch runner. Runs the simulation for every configuration of a parameter sweep on a pool of processes (one
+simulation per worker at a time) and collects the results of all nodes in one csv table.
+
+Usage:
+    python -m utils.runner --config sweep.json [--workers 64] [--out results.csv]
+    python -m utils.runner --trace_file pwr_office.h5 --capacity 17e-6 47e-6 --seed 1 2 3 --pairs node0:node2 node3:node4
+
+The keys are the ones of the command line GUI ('CMD_GUI.callback'), plus 'pairs' (targets of the nodes) or 'links' (neighbours of the nodes), 'tasks' (tasks of the nodes by name) and the optional
+keys of 'utils.simulation.simulate'. Every key holds a single value or a list of values, and the grid of all
+combinations of the lists is simulated. Command line values override the ones of the config file (json), e.g.:
+
+    {
+        "abs_path": "/home/hrishi/Repos/",
+        "trace_file": "pwr_office.h5",
+        "capacity": [17e-6, 47e-6],
+        "seed": [1, 2, 3],
+        "pairs": [["node0", "node2"], ["node3", "node4"]]
+    }
+'''
+
+import os
+import csv
+import json
+import time
+import argparse
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils import simulation
+
+# Defaults of the command line GUI
+defaults = {
+    "abs_path": "/home/hrishi/Repos/",
+    "trace_file": "pwr_office.h5",
+    "seed": -1,
+    "slot_length": 1e-5,
+    "target_probability": 0.99,
+    "max_offset": 0.000848,
+    "sim_time": 10.0,
+    "capacity": 17e-6,
+    "von": 3.0,
+    "voff": 2.4,
+    "vmax": 3.2,
+}
+
+cli_types = {"abs_path": str, "trace_file": str, "seed": int}
+
+# Wall-clock secs after which a simulation is stopped (override with the 'timeout' key, e.g. for very long runs)
+default_timeout = 6 * 3600
+
+# Keys whose value is a list without being swept
+_fixed_list_keys = ("pairs", "links", "tasks")
+
+result_columns = ["node", "wakeups", "bonito_wakeups", "connections", "success_rate", "delay", "generated", "delivered", "dropped", "drop_rate", "throughput", "latency", "task_runs", "task_skips", "energy_used", "energy_drained", "runtime", "output_dir", "error"]
+
+
+def expand_grid(config):
+    """Expands a configuration with lists of values into the configurations of all combinations.
+
+    Args:
+        config (dict): configuration, every value that is a list (except 'pairs') is swept
+
+    Returns:
+        (tuple): names of the swept keys and list of configurations (dict)
+    """
+
+    sweep_keys = [key for key, value in config.items() if isinstance(value, list) and key not in _fixed_list_keys]
+    configs = []
+    for values in itertools.product(*(config[key] for key in sweep_keys)):
+        run_config = dict(config)
+        run_config.update(zip(sweep_keys, values))
+        configs.append(run_config)
+
+    return sweep_keys, configs
+
+
+def run_one(config):
+    """Runs one simulation without GUI. Executed by the workers of the process pool.
+
+    Args:
+        config (dict): configuration of the simulation (see 'expand_grid')
+
+    Returns:
+        (list): one row (dict) of results per node
+    """
+
+    args = dict(config)
+    args["show_GUI"] = False
+    args.setdefault("create_plots", False)
+    args.setdefault("timeout", default_timeout)
+
+    # Set the random seed before performing any computation
+    if args["seed"] == -1: args["seed"] = np.random.randint(0, 1000)
+    np.random.seed(args["seed"])
+
+    start = time.time()
+    try:
+        summary = simulation.simulate(args)
+    except Exception as e:
+        return [{"seed": args["seed"], "error": repr(e)}]
+    finally:
+        # Stop the nodes that are still running (e.g. after a timeout)
+        for node in simulation.nodes.values(): node.stop()
+
+    runtime = time.time() - start
+    return [dict(node=name, seed=args["seed"], runtime=runtime, output_dir=args["output_dir"], **results) for name, results in summary.items()]
+
+
+def run_sweep(config, out_path, workers=None):
+    """Runs the simulations of all the configurations of a sweep and writes the results to a csv table. Rows are
+    written as soon as a simulation finishes, so the results of a long sweep can be inspected while it is running.
+
+    Args:
+        config (dict): configuration with lists of values for the swept keys
+        out_path (str): path of the csv table
+        workers (int): number of worker processes (default: number of cpus)
+
+    Returns:
+        (list): rows of the table (dict), including the ones of the simulations that failed ('error')
+    """
+
+    # A random seed is drawn once for the whole sweep, so that the replications of a configuration share it
+    if config.get("seed", -1) == -1: config = dict(config, seed=int(np.random.SeedSequence().generate_state(1)[0]))
+
+    sweep_keys, configs = expand_grid(config)
+    param_columns = ["run"] + sweep_keys + (["seed"] if "seed" not in sweep_keys else [])
+
+    all_rows = []
+    with open(out_path, "w", newline="") as fp, ProcessPoolExecutor(max_workers=workers) as executor:
+        writer = csv.DictWriter(fp, fieldnames=param_columns + result_columns)
+        writer.writeheader()
+
+        futures = {}
+        for i, run_config in enumerate(configs):
+            run_config["run_name"] = f"run{i:04d}"
+            futures[executor.submit(run_one, run_config)] = run_config
+
+        for n_done, future in enumerate(as_completed(futures), 1):
+            run_config = futures[future]
+            params = {"run": run_config["run_name"], "seed": run_config["seed"]}
+            params.update((key, run_config[key]) for key in sweep_keys)
+
+            try: rows = future.result()
+            except Exception as e: rows = [{"error": repr(e)}] # Worker died
+
+            for row in rows:
+                all_rows.append({**params, **row})
+                writer.writerow(all_rows[-1])
+            fp.flush()
+
+            print(f"{run_config['run_name']} done ({n_done}/{len(configs)})")
+
+    return all_rows
+
+
+def parse_pair(text):
+    name1, name2 = text.split(":")
+    return [name1, name2]
+
+
+def parse_link(text):
+    return text if text == "mesh" else parse_pair(text)
+
+
+def build_parser(description):
+    """Command line parser of the simulation parameters (shared by the runner and utils/replications.py)."""
+
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--config", default=None, help="json file with the (swept) simulation parameters")
+    parser.add_argument("--out", default="results.csv", help="csv table the results of all runs are written to")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: number of cpus)")
+    parser.add_argument("--pairs", nargs="+", type=parse_pair, default=None, help="targets as pairs of nodes, e.g. node0:node2")
+    parser.add_argument("--links", nargs="+", type=parse_link, default=None, help="links to many neighbours per node, e.g. node0:node1 node0:node2, or 'mesh' for all pairs (see utils/topology.py)")
+    parser.add_argument("--tasks", nargs="+", type=parse_pair, default=None, help="tasks of the nodes by name, e.g. node0:sense (see Battery_Free_Device/tasks.py)")
+    parser.add_argument("--sink", nargs="+", default=None, help="node the packets produced by the tasks are ferried to (see utils/tasking.py)")
+    parser.add_argument("--buffer_size", nargs="+", type=int, default=None, help="maximum no. of packets in the buffer of every node")
+    parser.add_argument("--tx_energy", nargs="+", type=float, default=None, help="energy consumed to hand one packet over to a connected node (in joules)")
+    parser.add_argument("--kernel", nargs="+", default=None, choices=["des", "threads"], help="simulation kernel")
+    parser.add_argument("--trace_backend", nargs="+", default=None, choices=["mmap", "cached", "rle"], help="access to the traces ('rle': run-length compacted, see utils/rle.py)")
+    parser.add_argument("--prefetch", nargs="+", type=int, default=None, help="blocks of the traces read ahead in the background, only with --trace_backend cached (ignored with a warning otherwise)")
+    parser.add_argument("--max_prefetch_bytes", nargs="+", type=int, default=None, help="memory cap of the blocks read ahead by all the traces of a run")
+    parser.add_argument("--timeout", type=float, default=None, help=f"wall-clock secs after which a simulation is stopped (default: {default_timeout})")
+    parser.add_argument("--profile", action="store_true", help="profile the runs (counters and timers of the nodes written to profile.csv, see utils/profiling.py)")
+    parser.add_argument("--profile_interval", type=float, default=None, help="secs between two stack samples of the profiled runs (written to profile_samples.csv)")
+    for key, value in defaults.items():
+        parser.add_argument(f"--{key}", nargs="+", type=cli_types.get(key, float), default=None)
+    return parser
+
+
+def read_config(parser, cli_args):
+    """Configuration of a sweep from the defaults, the config file and the command line (in increasing priority).
+
+    Args:
+        parser (argparse.ArgumentParser): parser of 'build_parser'
+        cli_args (dict): parsed command line arguments
+
+    Returns:
+        (dict): configuration (see 'expand_grid')
+    """
+
+    config = dict(defaults)
+    if cli_args["config"]:
+        with open(cli_args["config"]) as fp: config.update(json.load(fp))
+
+    for key in list(defaults) + ["pairs", "links", "tasks", "sink", "buffer_size", "tx_energy", "kernel", "trace_backend", "prefetch", "max_prefetch_bytes"]:
+        values = cli_args[key]
+        if values is None: continue
+        if key == "links" and "mesh" in values: config[key] = "mesh"
+        elif key in _fixed_list_keys: config[key] = values
+        else: config[key] = values if len(values) > 1 else values[0]
+
+    if cli_args.get("timeout"): config["timeout"] = cli_args["timeout"]
+    if cli_args.get("profile"): config["profile"] = True
+    if cli_args.get("profile_interval"): config.update(profile=True, profile_interval=cli_args["profile_interval"])
+
+    # Links to many neighbours only run on the discrete-event kernel (see utils.simulation.simulate)
+    kernels = config.get("kernel", "des")
+    if config.get("links") and "threads" in (kernels if isinstance(kernels, list) else [kernels]): parser.error("'links' need the discrete-event kernel (--kernel des)")
+
+    # Without targets the nodes never leave the stall state and the simulations would never end
+    if not config.get("pairs") and not config.get("links"): parser.error("no 'pairs' or 'links' given in the config or on the command line")
+
+    return config
+
+
+if __name__ == "__main__":
+    parser = build_parser("Run parameter sweeps of the simulation without GUI")
+    cli_args = vars(parser.parse_args())
+    config = read_config(parser, cli_args)
+
+    rows = run_sweep(config, cli_args["out"], cli_args["workers"])
+    n_failed = len({row["run"] for row in rows if row.get("error")})
+    print(f"Results written to {os.path.abspath(cli_args['out'])} ({n_failed} failed runs)")
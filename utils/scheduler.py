@@ -0,0 +1,432 @@
+'''
+Discrete-event simulation kernel for the battery-free devices.
+
+The state machine of a node ('BatteryfreeDevice.run') is a generator. Whenever the node has to wait for something
+(the end of a sleep cycle, the wake-up of its target, a target being set or the handshake of a Bonito connection) it
+yields one of the requests defined here and is resumed with the result of that request.
+
+The requests can be served in two ways:
+    1. 'ThreadClock.serve' serves the request on the calling thread. This is what the thread-per-node driver
+       ('BatteryfreeDevice.switchOn') does. Every node publishes the iteration it has simulated up to (its clock) and
+       does not go past an iteration before its target has reached it, so a node never reads the awake status of its
+       target ahead of (or behind) simulated time. The node with the earliest clock can always go on, and the threads
+       run in parallel otherwise.
+    2. 'Scheduler' serves all nodes on one thread and one shared simulated clock. Requests are turned into events in a
+       priority queue ordered by simulation iteration, so a run only costs time per event and is deterministic for a
+       given seed.
+'''
+
+import heapq
+import threading
+import itertools
+
+
+class Until(object):
+    """Resume the node at the given iteration (end of a sleep cycle).
+
+    Args:
+        iteration (int): iteration at which the node wakes up
+    """
+
+    synced = True
+
+    def __init__(self, iteration):
+        self.iteration = iteration
+
+    @property
+    def horizon(self):
+        return self.iteration
+
+    def block(self):
+        # The node is asleep till 'iteration', nothing else to wait for once its target got there (see 'ThreadClock')
+        return None
+
+    def schedule(self, scheduler, cycle):
+        scheduler.resume(self.iteration, cycle)
+
+
+class WaitFor(object):
+    """Resume the node as soon as 'event' is set, or after the iteration 'until' has passed.
+
+    The node is resumed with the iteration at which the waiting ended, i.e. the iteration at which the event was set or
+    'until + 1' if it was not set in time.
+
+    Args:
+        event:          awake status of the target node ('threading.Event' or 'SimEvent')
+        since (int):    iteration at which the node starts waiting
+        until (int):    last iteration the node waits for
+        target (BatteryfreeDevice): target node, publishes the iteration of its latest wake-up (thread driver only)
+    """
+
+    synced = True
+
+    def __init__(self, event, since, until, target=None):
+        self.event = event
+        self.since = since
+        self.until = until
+        self.target = target
+
+    @property
+    def horizon(self):
+        return self.since
+
+    def block(self):
+        # Simulated-time wait: instead of counting iterations till the event is set, jump straight to the iteration at
+        # which the target wakes up if that is inside the window, else to the end of the window. The target has
+        # simulated up to 'since' (see 'ThreadClock'), so it is either awake or asleep till its 'wake_iteration'.
+        if self.event.is_set(): return self.since
+
+        wake_iteration = self.target.wake_iteration if self.target is not None else -1
+        if self.since <= wake_iteration <= self.until: return wake_iteration
+        return self.until + 1
+
+    def schedule(self, scheduler, cycle):
+        if self.event.is_set():
+            scheduler.resume(scheduler.now, cycle, self.since)
+            return
+
+        waiter = _Waiter(scheduler, cycle, self.event)
+        self.event._waiters.append(waiter)
+        scheduler.push(self.until + 1, waiter.timeout, self.until + 1)
+
+
+class Stall(object):
+    """Park the node till it has a target.
+
+    The node is resumed with the iteration it continues from.
+
+    Args:
+        node (BatteryfreeDevice): node without a target
+    """
+
+    synced = False
+    horizon = float("inf") # A node without target does not affect any other node
+
+    def __init__(self, node):
+        self.node = node
+
+    def ready(self):
+        return self.node.target_is_set or self.node.iteration >= self.node.times_len
+
+    def block(self):
+        # Returns as soon as the node gets a target. The timeout only catches nodes stopped from outside (iteration set
+        # to the end of the trace)
+        self.node.target_event.wait(1)
+        return self.node.iteration
+
+    def schedule(self, scheduler, cycle):
+        self.node.on_target_set = scheduler.notify
+        scheduler.stall(self, cycle)
+
+
+class Handshake(object):
+    """Establish a Bonito connection. The node listens from iteration 'since' to 'until' and connects if all the parties
+    of the rendezvous are listening at the same iteration.
+
+    The node is resumed with a tuple: whether it connected, and the iteration at which the handshake ended (the iteration
+    at which all parties met, else 'until + 1').
+
+    Args:
+        rendezvous (Rendezvous): rendezvous shared between the current and the target node(s)
+        party (BatteryfreeDevice): current node
+        since (int): first iteration the node listens at
+        until (int): last iteration the node listens at
+    """
+
+    synced = False # The rendezvous waits in simulated time itself
+
+    def __init__(self, rendezvous, party, since, until):
+        self.rendezvous = rendezvous
+        self.party = party
+        self.since = since
+        self.until = until
+
+    @property
+    def horizon(self):
+        # The node stays awake, listening, till the end of its window unless its target arrives
+        return self.until
+
+    def block(self):
+        return self.rendezvous.wait(self.party, self.since, self.until)
+
+    def schedule(self, scheduler, cycle):
+        scheduler.handshake(self, cycle)
+
+
+class Rendezvous(object):
+    """Meeting point of a group of nodes in simulated time (replaces the threading.Barrier with wall-clock timeout).
+
+    Every party arrives with the window of iterations it listens in. All the parties connect once they have all arrived
+    and their windows overlap, i.e. at the latest arrival, if no window ends before it. Parties whose window ends
+    before that leave unconnected. Whether nodes connect thus only depends on the simulated iterations, not on how
+    fast the threads run.
+
+    Args:
+        parties (int): number of nodes that have to meet (2 for a Bonito pair, more for a group)
+    """
+
+    poll_interval = 0.01 # Wall-clock secs after which a waiting thread checks the iterations of the missing parties again
+
+    def __init__(self, parties=2):
+        self.parties = parties
+        self.members = []       # Nodes sharing the rendezvous, whose iterations tell waiting threads when a party missed them
+        self._cond = threading.Condition()
+        self._arrived = {}      # party -> (since, until, callback)
+        self._results = {}      # party -> (connected, iteration) of the parties waiting on a thread
+
+    def join(self, party):
+        """Adds a node to the members of the rendezvous."""
+        if party not in self.members: self.members.append(party)
+
+    def arrive(self, party, since, until, callback=None):
+        """Registers a party listening from iteration 'since' to 'until'. The outcome is handed to callback(connected,
+        iteration), or kept for 'wait' if there is no callback."""
+
+        with self._cond:
+            self._arrived[party] = (since, until, callback)
+
+            while len(self._arrived) == self.parties:
+                meet = max(since for since, _, _ in self._arrived.values())
+                missed = [other for other, (_, until, _) in self._arrived.items() if until < meet]
+                if not missed:
+                    for other in list(self._arrived): self._finish(other, True, meet)
+                    break
+                for other in missed: self.leave(other)
+
+    def leave(self, party, until=None):
+        """The window of a party ended without all the others arriving (ignored if the party is not waiting with the
+        window ending at 'until' anymore)."""
+
+        with self._cond:
+            if party not in self._arrived: return
+            if until is not None and self._arrived[party][1] != until: return
+            self._finish(party, False, self._arrived[party][1] + 1)
+
+    def _finish(self, party, connected, iteration):
+        _, _, callback = self._arrived.pop(party)
+        if callback is not None: callback(connected, iteration)
+        else: self._results[party] = (connected, iteration)
+        self._cond.notify_all()
+
+    def _missed(self, party, until):
+        # A member that has not arrived is past the window (or done) and will not arrive anymore
+        for other in self.members:
+            if other is party or other in self._arrived: continue
+            if other.clock > until or other.iteration >= other.times_len or other.stopped: return True
+        return False
+
+    def wait(self, party, since, until):
+        """Arrives and waits on the calling thread for the outcome (thread driver). The waiting thread gives up as soon
+        as another member is past the window without having arrived.
+
+        Returns:
+            (tuple): whether the party connected and the iteration at which the handshake ended
+        """
+
+        with self._cond:
+            self.arrive(party, since, until)
+            while party not in self._results:
+                if party.stopped or self._missed(party, until): self.leave(party)
+                else: self._cond.wait(self.poll_interval)
+            return self._results.pop(party)
+
+
+class ThreadClock(object):
+    """Simulated clocks of the nodes driven by their own threads (conservative synchronisation of the thread driver).
+
+    Before a node serves a request it publishes the iteration its state is known up to ('horizon' of the request: the
+    end of a sleep cycle, the start of a wait, the end of a handshake window). Requests that read the state of the
+    target ('synced') are only served once the target has published an iteration at least as late. Nodes at the same
+    iteration go on at once, so which of them comes first is up to the threads (like the insertion order of the
+    'Scheduler').
+
+    Args:
+        poll_interval (float): wall-clock secs after which a waiting thread checks again whether a node was stopped
+    """
+
+    def __init__(self, poll_interval=0.1):
+        self.poll_interval = poll_interval
+        self._cond = threading.Condition()
+
+    def advance(self, node, iteration):
+        """Publishes the iteration a node has simulated up to."""
+        with self._cond:
+            node.clock = iteration
+            self._cond.notify_all()
+
+    def sync(self, node, iteration):
+        """Waits till the target of a node has simulated up to the given iteration (or is stopped)."""
+        with self._cond:
+            while not node.stopped:
+                target = node.target_node
+                if target is None or target.stopped or target.clock >= iteration: return
+                self._cond.wait(self.poll_interval)
+
+    def serve(self, node, request):
+        """Serves a request of a node on the calling thread.
+
+        Returns:
+            the result of the request (see 'request.block')
+        """
+
+        self.advance(node, request.horizon)
+        if request.synced: self.sync(node, request.horizon)
+        value = request.block()
+
+        # A node resumed after a stall continues from its own iteration
+        if request.horizon == float("inf"): self.advance(node, node.iteration)
+        return value
+
+    def finish(self, node):
+        """The state machine of a node has ended, it does not hold up any other node anymore."""
+        self.advance(node, float("inf"))
+
+
+class SimEvent(object):
+    """Drop-in replacement of 'threading.Event' for nodes driven by the 'Scheduler'. Setting the event resumes all the
+    nodes waiting for it at the current simulated iteration.
+
+    Args:
+        scheduler (Scheduler): scheduler driving the nodes
+    """
+
+    __slots__ = ("_scheduler", "_flag", "_waiters")
+
+    def __init__(self, scheduler):
+        self._scheduler = scheduler
+        self._flag = False
+        self._waiters = []
+
+    def is_set(self):
+        return self._flag
+
+    def set(self):
+        self._flag = True
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            self._scheduler.push(self._scheduler.now, waiter.wake, self._scheduler.now)
+
+    def clear(self):
+        self._flag = False
+
+
+class _Waiter(object):
+    """A node waiting for an event with a timeout. Whatever comes first resumes the node, the other one is ignored."""
+
+    __slots__ = ("scheduler", "cycle", "event", "done")
+
+    def __init__(self, scheduler, cycle, event):
+        self.scheduler = scheduler
+        self.cycle = cycle
+        self.event = event
+        self.done = False
+
+    def wake(self, iteration):
+        if self.done: return
+        self.done = True
+        self.scheduler.step(self.cycle, iteration)
+
+    def timeout(self, iteration):
+        if self.done: return
+        self.done = True
+        try: self.event._waiters.remove(self)
+        except ValueError: pass
+        self.scheduler.step(self.cycle, iteration)
+
+
+class Scheduler(object):
+    """Single-threaded discrete-event scheduler driving the state machines of all nodes on one simulated clock.
+
+    Events are kept in a priority queue ordered by (iteration, priority, insertion order). Wake-ups and wait window ends
+    have priority 0. Ends of handshake windows have priority 1, so that all the nodes arriving at a rendezvous in the
+    last iteration of a window get the chance to meet before the handshake fails.
+
+    Args:
+        poll_interval (float): wall-clock time (in secs) after which the stalled nodes are checked again when all nodes
+                               stall, in case none of them is notified (e.g. nodes stopped from outside)
+    """
+
+    def __init__(self, poll_interval=1):
+        self.now = 0
+        self.poll_interval = poll_interval
+
+        self._queue = []
+        self._counter = itertools.count()
+        self._stalled = []
+        self._notified = threading.Event()
+        self._stopped = False
+
+    def event(self):
+        """Returns a new awake status event bound to this scheduler."""
+        return SimEvent(self)
+
+    def spawn(self, cycle):
+        """Adds the state machine (generator) of a node. It is started at the current iteration."""
+        self.resume(self.now, cycle)
+
+    def push(self, iteration, fn, *args, priority=0):
+        heapq.heappush(self._queue, (iteration, priority, next(self._counter), fn, args))
+
+    def resume(self, iteration, cycle, value=None):
+        self.push(iteration, self.step, cycle, value)
+
+    def step(self, cycle, value=None):
+        """Runs the state machine of a node till its next request."""
+        try:
+            request = cycle.send(value)
+        except StopIteration:
+            return
+        request.schedule(self, cycle)
+
+    def stop(self):
+        """Ends 'run' after the event being processed (thread-safe, e.g. on a timeout of the simulation)."""
+        self._stopped = True
+        self._notified.set()
+
+    def notify(self):
+        """Wakes the scheduler up if it is waiting for stalled nodes (thread-safe, called when a node gets a target)."""
+        self._notified.set()
+
+    def stall(self, request, cycle):
+        self._stalled.append((request, cycle))
+
+    def handshake(self, request, cycle):
+        def done(connected, iteration):
+            self.resume(max(iteration, self.now), cycle, (connected, iteration))
+
+        self.push(request.until + 1, request.rendezvous.leave, request.party, request.until, priority=1)
+        request.rendezvous.arrive(request.party, request.since, request.until, done)
+
+    def _release_stalled(self):
+        ready = []
+        stalled = []
+        for request, cycle in self._stalled:
+            if request.ready(): ready.append((request, cycle))
+            else: stalled.append((request, cycle))
+
+        if not ready: return
+        self._stalled = stalled
+
+        # If nothing else is scheduled, the clock continues from the earliest node (e.g. after the GUI reset the nodes)
+        if not self._queue: self.now = min(request.node.iteration for request, _ in ready)
+
+        for request, cycle in ready:
+            iteration = max(request.node.iteration, self.now)
+            self.resume(iteration, cycle, iteration)
+
+    def run(self):
+        """Processes events till all the state machines have finished."""
+
+        while not self._stopped and (self._queue or self._stalled):
+            if self._stalled and (not self._queue or self._queue[0][0] != self.now):
+                self._notified.clear()
+                self._release_stalled()
+
+            if not self._queue:
+                # Nothing can happen in simulated time till a node gets a target
+                self._notified.wait(self.poll_interval)
+                continue
+
+            iteration, _, _, fn, args = heapq.heappop(self._queue)
+            self.now = iteration
+            fn(*args)
@@ -0,0 +1,360 @@
+'''
+Simulation of the battery-free network, independent of the GUIs. Used by 'main.py' (interactive) and 'utils/runner.py' (headless).
+'''
+
+import os
+import time
+import threading
+import numpy as np
+from datetime import datetime
+
+from utils.utils import *
+from utils.replay import warm_start
+from utils.eventlog import EventLog
+from utils.results import write_results, RESULTS_FILE
+from utils.scheduler import Scheduler, ThreadClock, Rendezvous
+from utils.topology import Topology
+from utils.tasking import traffic_summary
+from utils.nodestore import NodeStore
+from utils import profiling
+from Battery_Free_Device.battery_free_device import BatteryfreeDevice
+
+from utils.distributions import NormalDistribution
+from utils.distributions import ExponentialDistribution
+from utils.distributions import GaussianMixtureModel
+from utils.distributions import IntervalCache
+
+model_map = {"norm": NormalDistribution, "exp": ExponentialDistribution, "gmm": GaussianMixtureModel}
+
+# Global dictionary containing the 'BatteryfreeDevice' objects of all the Battery-Free devices in the simulation environment 
+nodes = {}
+
+def waitForThreadsToJoin(threads, done):
+    for thread in threads.values():        
+        thread.join()
+    done.set()
+
+
+def run_guarded(fn, errors, stop, *args):
+    """Target of the simulation threads. An exception of a node (or of the scheduler) ends the simulation and is kept
+    for 'simulate' to re-raise, instead of dying with the thread while the simulation waits for its timeout.
+
+    Args:
+        fn (callable): function run by the thread, called with *args
+        errors (list): exceptions of the threads
+        stop (threading.Event): set to end the simulation
+    """
+
+    try:
+        fn(*args)
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+
+
+def stop_nodes(threads, scheduler, join_timeout=10):
+    """Ends the simulation of all the nodes still running (e.g. after a timeout) and waits for their threads.
+
+    Args:
+        threads (dict): threads of the simulation
+        scheduler (Scheduler): discrete-event scheduler, None for the thread-per-node driver
+        join_timeout (float): wall-clock secs to wait for the threads at most
+
+    Returns:
+        (boolean): Whether all the threads finished
+    """
+
+    for node in nodes.values(): node.stop()
+    if scheduler: scheduler.stop()
+
+    deadline = time.time() + join_timeout
+    for thread in threads.values():
+        thread.join(max(0, deadline - time.time()))
+
+    return not any(thread.is_alive() for thread in threads.values())
+
+
+def set_pair(name1, name2):
+    """Sets two nodes as the targets of each other (same as submitting them in the simulator GUI).
+
+    Args:
+        name1 (str): name of the first node
+        name2 (str): name of the second node
+    """
+
+    barrier = Rendezvous(2)
+    nodes[name1].setTarget(name2, barrier)
+    nodes[name2].setTarget(name1, barrier)
+    nodes[name1].target_is_set = True
+    nodes[name2].target_is_set = True
+
+
+def summarize(sim_nodes):
+    """Collects the results of the nodes of a simulation.
+
+    Args:
+        sim_nodes (iterable): 'BatteryfreeDevice' objects
+
+    Returns:
+        (dict): results per node name (no. of wakeups, no. of wakeups in 'Bonito' state, no. of successful connections, success rate and delay, and the packets of the tasks: no. generated, delivered and dropped, drop rate, throughput and median end-to-end latency, the no. of runs and skips of the task and the energy used and drained, see utils.tasking)
+    """
+
+    summary = {}
+    for node in sim_nodes:
+        summary[node.name] = {
+            "wakeups": node.wakeup_cnt,
+            "bonito_wakeups": node.bonito_wakeup_cnt,
+            "connections": node.connection_success,
+            "success_rate": node.connection_success / node.bonito_wakeup_cnt if node.bonito_wakeup_cnt else float("nan"),
+            "delay": float(np.median(node.conn_ints)),
+            "generated": node.packets_generated,
+            "delivered": len(node.latencies),
+            "dropped": node.packets_dropped,
+            "drop_rate": node.packets_dropped / node.packets_generated if node.packets_generated else float("nan"),
+            "throughput": len(node.latencies) / (node.times_len * node.Ts),
+            "latency": float(np.median(node.latencies)) if node.latencies else float("nan"),
+            "task_runs": node.task_runs,
+            "task_skips": node.task_skips,
+            "energy_used": node.energy_used,
+            "energy_drained": node.energy_drained,
+        }
+
+    return summary
+
+
+def simulate(args):
+    """Master thread of the simulation environment.
+
+    Does not depend on the GUI, so it can run headless (see utils/runner.py). Runs till all the nodes are done, the threading.Event args["stop"] is set (e.g. GUI closed) or args["timeout"] secs (default 2000, None for no limit) have passed. An exception of a node or of the scheduler ends the simulation right away and is raised again here.
+
+    1. Defines all the global variables.
+    2. Creates the log folder and the event log shared by all the nodes (args["event_log_format"] = "npy", "h5" or "parquet", args["log_verbosity"] see utils.eventlog).
+    3. Reads the data from the trace file (or takes the synthetic traces of args["traces"], see utils/synth.py), creates 'BatteryfreeDevice' objects for all the nodes and initializes all the variables.
+    4. Sets the targets of the nodes: pairs of nodes (args["pairs"]) or links to many neighbours (args["links"], a list of pairs of nodes or "mesh" for all pairs, see utils/topology.py).
+       Hands the state machines of all the nodes to a single discrete-event scheduler thread (default, args["kernel"] = "des") or assigns a separate thread for each node (args["kernel"] = "threads").
+    5. Starts all the threads simultaneously and waits for them to finish execution.
+    6. Collects the results and writes them to the columnar results file of the run (see utils/results.py), including the packets the tasks of the nodes ferried to the sink (args["tasks"] assigns tasks to nodes by name, args["sink"], args["buffer_size"] and args["tx_energy"] see utils/tasking.py). Profiled runs (args["profile"] = True, args["profile_interval"] for stack sampling, see utils/profiling.py) also write the counters and timers of the nodes.
+    7. Generates plots based on the results.
+
+    Args:
+        args (dict): dictionary containing all the input arguments taken from the command line GUI (or the headless runner)
+
+    Returns:
+        (dict): summary of the results of every node (see 'summarize')
+    """
+    start = time.time()
+
+    # Nodes serving many links wait at one rendezvous while their neighbours wait at others, which only works on the shared clock of the scheduler
+    if args.get("links") and args.get("kernel", "des") != "des": raise ValueError("'links' need the discrete-event kernel (kernel = 'des')")
+
+    global nodes
+    nodes.clear()
+
+    pwr = {}
+    dists = {}
+    events = {}
+    threads = {} 
+    
+    now = str(datetime.now()).replace(" ", "__")[:-7]
+
+    args["output_path"] = args["abs_path"] + "battery-free-network-simulator/logs/" + args["trace_file"].split('.')[0][4:] + "_dataset/"
+    args["input_path"] = args["abs_path"] + "battery-free-network-simulator/data/" + args["trace_file"]
+    args["opt_scale_path"] = args["abs_path"] + "battery-free-network-simulator/utils/opt_scale.csv"
+    
+    try: os.mkdir(args["output_path"])
+    except: pass
+
+    sim_time = args["sim_time"]
+    args["output_dir"] = args["output_path"] + f"{sim_time}_mins_" + now
+    if args.get("run_name"): args["output_dir"] += "_" + args["run_name"] # Keeps the runs of a sweep started in the same second apart
+
+    try: os.mkdir(args["output_dir"])
+    except: pass
+    
+    results_file = args["output_dir"] + "/" + RESULTS_FILE
+    events_file = args["output_dir"] + "/" + "events." + args.get("event_log_format", "npy")
+
+    # Traces generated in memory (see utils/synth.py) or read from the trace file
+    dr = args.get("traces")
+    reader = None # Trace file opened here, closed at the end of the run
+    if dr is None: dr = reader = DataReader(args['input_path'], backend=args.get("trace_backend", "mmap"), prefetch=args.get("prefetch", 0), max_prefetch_bytes=args.get("max_prefetch_bytes"))
+
+    times_len = min(int(60 * args['sim_time'] * 1e5), int(36e7), len(dr))
+
+    # Sampling interval is constant
+    Ts = 1e-5
+    iteration = [None]
+    
+    args['Ts'] = Ts
+    args['iteration'] = iteration
+    args['times_len'] = times_len
+    args['start_time'] = start
+
+    # Optional cache of connection intervals for unchanged pairs of charging time models
+    if args.get("conn_int_cache_digits"): args["conn_int_cache"] = IntervalCache(args["conn_int_cache_digits"])
+
+    # Discrete-event kernel: all nodes share one simulated clock on a single thread
+    scheduler = Scheduler() if args.get("kernel", "des") == "des" else None
+    clock = ThreadClock() if scheduler is None else None # Thread per node: the threads keep in step in simulated time
+
+    # Structured event log of all the nodes (render the old text logs with 'python -m utils.eventlog')
+    evlog = EventLog(events_file, verbosity=args.get("log_verbosity", 1))
+
+    # Integer node ids of any number of digits, in numeric order ('node2' before 'node10')
+    node_names = sorted(dr.nodes, key=node_index)
+    # node_names = [dr.nodes[1], dr.nodes[3]]
+
+    # Tasks assigned to the nodes by name, as a dict or as pairs of node and task (see utils.tasking)
+    if args.get("tasks") and not isinstance(args["tasks"], dict): args["tasks"] = dict(args["tasks"])
+
+    # Scalar state of all the nodes in one struct-of-arrays store
+    args["node_store"] = NodeStore(len(node_names))
+
+    # Independent random streams for every node of every replication (SeedSequence(seed, spawn_key=(replication,)) spawns one child per node)
+    seed_seq = np.random.SeedSequence(args["seed"], spawn_key=(args.get("replication", 0),))
+    node_rngs = [np.random.default_rng(child) for child in seed_seq.spawn(len(node_names))]
+
+    for node, rng in zip(node_names, node_rngs):
+        node_pwr = dr[node]
+        node_dist_cls = model_map[dr.get_dist_model(node)]
+        node_cls = BatteryfreeDevice(node, rng=rng, **args)
+        event = scheduler.event() if scheduler else threading.Event()
+
+        pwr[node] = node_pwr
+        dists[node] = node_dist_cls()
+        dists[node].rng = rng
+        nodes[node] = node_cls
+        events[node] = event
+
+    # Warm-start the charging time models with the charging times of a previous run
+    if args.get("warm_start"): warm_start(dists, args["warm_start"])
+
+    # Set when all the node threads have finished, when one of them failed, or by whoever wants the simulation to end early
+    stop = args.setdefault("stop", threading.Event())
+    errors = []
+
+    for node in nodes.values():
+        node.setup(pwr, dists, nodes, evlog, events)
+        if scheduler: scheduler.spawn(node.run())
+        else: threads[node.name] = threading.Thread(target=run_guarded, args=(node.switchOn, errors, stop, clock))
+
+    if scheduler: threads["scheduler"] = threading.Thread(target=run_guarded, args=(scheduler.run, errors, stop))
+    
+    # Targets given upfront as pairs of node names (e.g. by the headless runner)
+    for name1, name2 in args.get("pairs") or ():
+        set_pair(name1, name2)
+
+    # Links to many neighbours per node, served by earliest predicted connection
+    topology = None
+    if args.get("links"):
+        topology = Topology.mesh(node_names) if args["links"] == "mesh" else Topology.from_edges(args["links"])
+        topology.apply(nodes)
+
+    # With the targets given upfront, nodes left without one would stall forever (and the simulation would never end). They are done right away.
+    if args.get("pairs") or args.get("links"):
+        for node in nodes.values():
+            if not node.target_is_set:
+                print(f"{node.name} has no target, skipped")
+                node.iteration = times_len
+
+    ''' Example to Set targets internally via master thread
+
+    barrier1 = Rendezvous(2)
+    barrier2 = Rendezvous(2)
+
+    nodes['node0'].setTarget("node2", barrier1)
+    nodes['node2'].setTarget("node0", barrier1)
+    nodes['node3'].setTarget("node4", barrier2)
+    nodes['node4'].setTarget("node3", barrier2)
+
+    nodes['node0'].target_is_set = True
+    nodes['node2'].target_is_set = True
+    nodes['node3'].target_is_set = True
+    nodes['node4'].target_is_set = True
+    '''
+
+    # Counters and timers of the hot paths of the nodes (see utils/profiling.py)
+    profiler = profiling.enable() if args.get("profile") else None
+    sampler = profiling.SamplingProfiler(args["profile_interval"], list(threads.values())) if profiler and args.get("profile_interval") else None
+    if profiler: args["profiler"] = profiler
+
+    print('Simulation started!')
+
+    if profiler: profiler.start()
+    for thread in threads.values():
+        thread.start()
+    if sampler: sampler.start()
+
+    wait_thread = threading.Thread(target=waitForThreadsToJoin, args=(threads, stop))
+    wait_thread.start()
+
+    ''' Example to Update targets internally via master thread
+
+    time.sleep(10)
+
+    barrier3 = Rendezvous(2)
+    barrier4 = Rendezvous(2)
+
+    nodes['node0'].setTarget("node3", barrier3)
+    nodes['node2'].setTarget("node4", barrier3)
+    nodes['node3'].setTarget("node0", barrier4)
+    nodes['node4'].setTarget("node2", barrier4)
+
+    nodes['node0'].target_is_set = True
+    nodes['node2'].target_is_set = True
+    nodes['node3'].target_is_set = True
+    nodes['node4'].target_is_set = True
+    '''
+
+    timeout = args.get("timeout", 2000)
+    stop.wait(None if timeout is None else max(0, timeout - (time.time() - start)))
+
+    # Nodes still running (timeout or stopped from outside) are stopped before the event log is closed and their results are collected
+    if not stop_nodes(threads, scheduler): print("Warning: simulation threads still running after the end of the simulation")
+        
+    evlog.close()
+    if reader is not None: reader.close()
+
+    if profiler:
+        profiler.stop()
+        profiling.disable()
+        profiler.write(args["output_dir"] + "/profile.csv")
+        print(profiler.format_table(sim_secs=min(times_len, max(node.iteration for node in nodes.values())) * Ts))
+        if sampler:
+            sampler.stop()
+            sampler.write(args["output_dir"] + "/profile_samples.csv")
+
+    # A node or the scheduler failed, the simulation has no results
+    if errors: raise errors[0]
+
+    summary = summarize(nodes.values())
+
+    # Packets ferried to the sink by the tasks of the nodes (see utils.tasking)
+    traffic = traffic_summary(nodes.values(), times_len * Ts)
+    if traffic["generated"]:
+        print(f"Packets: {traffic['generated']} generated, {traffic['delivered']} delivered, {traffic['dropped']} dropped ({traffic['drop_rate']:.1%}), {traffic['buffered']} buffered")
+        print(f"Throughput: {traffic['throughput']:.3f} packets/s, end-to-end latency: {traffic['latency_median']:.3f} s median, {traffic['latency_p95']:.3f} s 95th percentile")
+
+    # Columnar results of the run (summaries, connection intervals, parameters), see utils/results.py
+    write_results(results_file, args, nodes.values(), summary, topology)
+
+    for name in node_names:
+        node_conn_ints_arr = nodes[name].conn_ints
+        node_bonito_tchrgs_arr = nodes[name].bonito_tchrgs
+
+        try:
+            if args["create_plots"]:
+                import matplotlib.pyplot as plt
+                ax = args["ax"]
+                ax.plot(node_conn_ints_arr, color="green", label="connection interval bonito")
+                ax.plot(node_bonito_tchrgs_arr, color="red", label="charging time")
+                ax.legend()
+                plt.savefig(args["output_dir"] + f"/{name}_plot.png")
+                ax.get_legend().remove()
+                plt.cla()
+        except: pass
+
+    end = time.time()
+    print(f"Total Runtime: {end - start} s")
+
+    return summary
@@ -9,6 +9,8 @@ from PyQt5.QtWidgets import QApplication, QWidget, QLabel, QHBoxLayout, QVBoxLay
 from PyQt5.QtGui import QIcon, QPainter, QBrush, QPen, QColor
 
 from Battery_Free_Device.battery_free_device import BatteryfreeDevice
+from utils.scheduler import Rendezvous
+from utils.topology import Topology
 
 lock = threading.Lock() # Semaphore for reading and updating data used by various threads
 
@@ -227,37 +229,37 @@ class App(QWidget):
         label0 = QLabel('Node 0:', self)
         label0.move(230, 10)
         self.input0 = QLineEdit(self)
-        self.input0.setFixedWidth(50)
+        self.input0.setFixedWidth(60)
         self.input0.move(300, 5)
 
         label1 = QLabel('Node 1:', self)
         label1.move(360, 10)
         self.input1 = QLineEdit(self)
-        self.input1.setFixedWidth(50)
+        self.input1.setFixedWidth(60)
         self.input1.move(430, 5)
 
         label2 = QLabel('Node 2:', self)
         label2.move(490, 10)
         self.input2 = QLineEdit(self)
-        self.input2.setFixedWidth(50)
+        self.input2.setFixedWidth(60)
         self.input2.move(560, 5)
 
         label3 = QLabel('Node 3:', self)
         label3.move(230, 60)
         self.input3 = QLineEdit(self)
-        self.input3.setFixedWidth(50)
+        self.input3.setFixedWidth(60)
         self.input3.move(300, 55)
 
         label4 = QLabel('Node 4:', self)
         label4.move(360, 60)
         self.input4 = QLineEdit(self)
-        self.input4.setFixedWidth(50)
+        self.input4.setFixedWidth(60)
         self.input4.move(430, 55)
 
         label5 = QLabel('Node 5:', self)
         label5.move(490, 60)
         self.input5 = QLineEdit(self)
-        self.input5.setFixedWidth(50)
+        self.input5.setFixedWidth(60)
         self.input5.move(560, 55)
 
         start_button = QPushButton('Start', self)
@@ -321,6 +323,7 @@ class App(QWidget):
         for i in range(len(self.nodes)):
             self.nodes[f"node{i}"].target_is_set = False
             self.nodes[f"node{i}"].target_name = None
+            self.nodes[f"node{i}"].link_scheduler = None
             self.nodes[f"node{i}"].iteration = 0
 
         lock.release()
@@ -355,7 +358,7 @@ class App(QWidget):
         self.update()
 
     def submit(self):
-        """Get user target inputs and update them accordingly
+        """Get user target inputs and update them accordingly. An input holds one neighbour (e.g. "2") or, for links to many neighbours, a comma separated list of them (e.g. "1, 2", see utils/topology.py)
         """
 
         input = [None for i in range(6)]
@@ -367,16 +370,23 @@ class App(QWidget):
         input[4] = self.input4.text()
         input[5] = self.input5.text()
 
-        for i in range(6):
-            if input[i] != "":
-                node1 = self.nodes[f"node{i}"]
-                node2 = self.nodes[f"node{input[i]}"]
+        topology = Topology.parse({f"node{i}": input[i] for i in range(6) if input[i] != ""})
 
-                barrier = threading.Barrier(2)
+        if all(len(neighbours) == 1 for neighbours in topology.neighbours.values()):
+            for link in topology:
+                node1 = self.nodes[link.nodes[0]]
+                node2 = self.nodes[link.nodes[1]]
 
-                print(f"Setting targets for Node {i} and {input[i]}")
-                node1.setTarget(f"node{input[i]}", barrier)
-                node2.setTarget(f"node{i}", barrier)
+                barrier = Rendezvous(2)
+
+                print(f"Setting targets for Node {node1.node_id} and {node2.node_id}")
+                node1.setTarget(node2.name, barrier)
+                node2.setTarget(node1.name, barrier)
+
+        else:
+            for name in topology.neighbours:
+                print(f"Setting links of {name} to {', '.join(topology.neighbours[name])}")
+                self.nodes[name].setLinks(topology.links_of(name))
 
         self.refresh()
         if not self.first_submit: self.start()
@@ -0,0 +1,544 @@
+'''
+Synthetic power traces for any number of nodes.
+
+A trace process generates the power of many nodes ('streams') block by block, so traces far larger than the memory
+(e.g. 1000 nodes x 1 hour at 100 kHz) can be produced:
+
+- 'OnOffMarkov':          two-state (on/off) Markov chain per node, e.g. a light switched on and off
+- 'ScaledReplay':         the recorded traces of an hdf5 file, each node replaying one of them from a random offset and
+                          scaled by a random factor
+- 'ChargingTimeProcess':  power that charges the nodes in charging times following the 'norm', 'exp' or 'gmm' models
+                          of the simulator
+- 'Correlated':           makes the nodes of any other process correlated by mixing their streams with a common one
+
+The traces are streamed into an hdf5 file of the format read by 'DataReader' ('write_h5'), or generated lazily block by
+block as the nodes read them and handed to the simulation directly ('SyntheticTraces', args["traces"] of
+'utils.simulation.simulate').
+
+Usage:
+    python -m utils.synth --out data/pwr_synth.h5 --n_nodes 1000 --duration 3600 --process markov [--rho 0.3]
+'''
+
+import copy
+import argparse
+import threading
+from collections import OrderedDict
+from itertools import combinations
+
+import h5py
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from utils.utils import DataReader
+from utils.distributions import NormalDistribution, ExponentialDistribution, GaussianMixtureModel
+
+_model_map = {"norm": NormalDistribution, "exp": ExponentialDistribution, "gmm": GaussianMixtureModel}
+
+
+class TraceProcess(object):
+    """Base class of the trace processes. 'reset' starts the streams, every call of 'next' returns the following block
+    of samples of all of them. 'get_state' and 'set_state' save and restore the process between two blocks, so blocks
+    can be generated again (see 'SyntheticTraces')."""
+
+    _state_attrs = () # attributes changed by 'next', saved by 'get_state' together with the state of the rng
+
+    def reset(self, n_streams, rng):
+        """Starts the process.
+
+        Args:
+            n_streams (int): number of streams (nodes)
+            rng (np.random.Generator): random number generator of the process
+        """
+
+        raise NotImplementedError
+
+    def next(self, length):
+        """Generates the next block of samples.
+
+        Args:
+            length (int): number of samples per stream
+
+        Returns:
+            np.ndarray: power (in watts) of shape (n_streams, length)
+        """
+
+        raise NotImplementedError
+
+    def get_state(self):
+        """State of the process between two blocks."""
+        state = {name: copy.copy(getattr(self, name)) for name in self._state_attrs}
+        state["rng"] = self.rng.bit_generator.state
+        return state
+
+    def set_state(self, state):
+        """Continues the process from a state of 'get_state': the following blocks are the ones that followed it."""
+        for name in self._state_attrs: setattr(self, name, copy.copy(state[name]))
+        self.rng.bit_generator.state = state["rng"]
+
+    def models(self):
+        """Charging time model ('norm', 'exp' or 'gmm') the simulator uses for every stream."""
+        return [self.model] * self.n_streams
+
+
+class _RunProcess(TraceProcess):
+    """Piecewise constant power: every stream is a sequence of runs of samples with the same power. Subclasses draw
+    the runs ('_runs'), the runs are laid out into the blocks here. The runs of all the streams are drawn at once and
+    laid out with one 'np.repeat' per block."""
+
+    mean_run = 1000 # expected length of a run (in samples), only used to guess how many runs to draw at a time
+    _state_attrs = ("_remaining", "_value", "_state")
+
+    def reset(self, n_streams, rng):
+        self.n_streams = n_streams
+        self.rng = rng
+        self._remaining = np.zeros((n_streams,), dtype=np.int64)   # samples left of the current run
+        self._value = np.zeros((n_streams,))                        # power of the current run
+        self._state = self._initial_state(n_streams)                # state the next run starts in
+
+    def _initial_state(self, n_streams):
+        return np.zeros((n_streams,), dtype=np.int8)
+
+    def _runs(self, states, k):
+        """Draws the next k runs of several streams.
+
+        Args:
+            states (np.ndarray): state the first run of every stream starts in
+            k (int): number of runs per stream
+
+        Returns:
+            (tuple): lengths (in samples, >= 1), power and state after every run, each of shape (len(states), k)
+        """
+
+        raise NotImplementedError
+
+    def next(self, length):
+        n = self.n_streams
+
+        # The current runs continue the block. Every stream gets runs filling exactly 'length' samples, padded with
+        # runs of length 0, so all of them are laid out in one go
+        filled = np.minimum(self._remaining, length)
+        self._remaining -= filled
+        lengths, values = [filled[:, None].copy()], [self._value[:, None].copy()]
+
+        active = np.flatnonzero(filled < length)
+        while len(active):
+            need = length - filled[active]
+            k = int(need.max() / self.mean_run) + 16
+            run_lengths, run_values, run_states = self._runs(self._state[active], k)
+            ends = np.cumsum(run_lengths, axis=1)
+
+            # The last run used is cut at the end of the block, the rest of it continues the next block
+            used = np.zeros((n, k), dtype=np.int64)
+            used[active] = np.clip(need[:, None] - (ends - run_lengths), 0, run_lengths)
+            block_values = np.zeros((n, k))
+            block_values[active] = run_values
+            lengths.append(used)
+            values.append(block_values)
+
+            done = ends[:, -1] >= need
+            last = np.minimum(np.sum(ends < need[:, None], axis=1), k - 1)
+            rows = np.arange(len(active))
+            self._state[active] = run_states[rows, last]
+            self._remaining[active[done]] = (ends[rows, last] - need)[done]
+            self._value[active[done]] = run_values[rows, last][done]
+
+            filled[active] += np.minimum(ends[:, -1], need)
+            active = active[~done]
+
+        return np.repeat(np.concatenate(values, axis=1).ravel(), np.concatenate(lengths, axis=1).ravel()).reshape(n, length)
+
+
+class OnOffMarkov(_RunProcess):
+    """Two-state Markov chain per node: 'power_on' while on, 'power_off' while off.
+
+    Args:
+        p_on (float): probability per sample to switch on while off (mean off time: 1/p_on samples)
+        p_off (float): probability per sample to switch off while on (mean on time: 1/p_off samples)
+        power_on (float): power while on (in watts)
+        power_off (float): power while off (in watts)
+        noise (float): standard deviation of multiplicative gaussian noise per sample (relative to the power)
+        model (str): charging time model the simulator uses for the nodes
+    """
+
+    def __init__(self, p_on=1e-4, p_off=1e-4, power_on=2e-3, power_off=0.0, noise=0.0, model="norm"):
+        self.p_on = p_on
+        self.p_off = p_off
+        self.power_on = power_on
+        self.power_off = power_off
+        self.noise = noise
+        self.model = model
+        self.mean_run = 0.5 * (1 / p_on + 1 / p_off)
+
+    def _initial_state(self, n_streams):
+        # Stationary distribution of the chain
+        return (self.rng.random(n_streams) < self.p_on / (self.p_on + self.p_off)).astype(np.int8)
+
+    def _runs(self, states, k):
+        on = (np.arange(k) % 2 == 0) == states[:, None].astype(bool)
+        lengths = self.rng.geometric(np.where(on, self.p_off, self.p_on))
+        values = np.where(on, self.power_on, self.power_off)
+        return lengths, values, (~on).astype(np.int8)
+
+    def next(self, length):
+        out = super().next(length)
+        if self.noise:
+            out *= 1 + self.noise * self.rng.standard_normal(out.shape)
+            np.maximum(out, 0, out=out)
+        return out
+
+
+class ChargingTimeProcess(_RunProcess):
+    """Power that charges a node from the turn-off to the turn-on threshold in charging times drawn from a charging
+    time model of the simulator. Every charging cycle is a run of constant power.
+
+    Args:
+        model (str): 'norm', 'exp' or 'gmm'
+        model_parameters (np.ndarray): parameters of the model (default: defaults of the model, see utils/distributions.py)
+        capacity (float): energy storage capacity of the nodes (in farad)
+        von (float): turn-on threshold (in volts)
+        voff (float): turn-off threshold (in volts)
+        Ts (float): sampling interval (in secs)
+    """
+
+    def __init__(self, model="norm", model_parameters=None, capacity=17e-6, von=3.0, voff=2.4, Ts=1e-5):
+        self.model = model
+        self.model_parameters = np.asarray(model_parameters if model_parameters is not None else _model_map[model]()._mp, dtype=float)
+        self.energy_per_cycle = 0.5 * capacity * (von**2 - voff**2)
+        self.Ts = Ts
+        self.mean_run = max(1.0, self._mean() / Ts)
+
+    def _mean(self):
+        mp = self.model_parameters
+        if self.model == "norm": return mp[0]
+        if self.model == "exp": return 1 / mp[0]
+        return float(np.sum(mp[:, 0] * mp[:, 1]))
+
+    def sample(self, size):
+        """Draws charging times (in secs) from the model.
+
+        Args:
+            size (int or tuple): number or shape of the charging times
+        """
+
+        mp = self.model_parameters
+        if self.model == "norm": return self.rng.normal(mp[0], np.sqrt(mp[1]), size)
+        if self.model == "exp": return self.rng.exponential(1 / mp[0], size)
+        comp = self.rng.choice(len(mp), size=size, p=mp[:, 0] / mp[:, 0].sum())
+        return self.rng.normal(mp[comp, 1], np.sqrt(mp[comp, 2]))
+
+    def _runs(self, states, k):
+        lengths = np.maximum(1, np.rint(self.sample((len(states), k)) / self.Ts)).astype(np.int64)
+        values = self.energy_per_cycle / (lengths * self.Ts)
+        return lengths, values, np.zeros(lengths.shape, dtype=np.int8)
+
+
+class ScaledReplay(TraceProcess):
+    """Replays the recorded traces of an hdf5 file (format of 'DataReader'). Every node replays one of them (in turn)
+    from a random offset, wrapping around at the end, scaled by a random factor.
+
+    Args:
+        path (str): hdf5 file with the recorded traces
+        nodes (list): names of the recorded nodes to replay (default: all)
+        scale (tuple): range of the scale factors (uniform)
+    """
+
+    window_copy_length = 2048 # longest block copied for all the streams of a trace at once
+    _state_attrs = ("_pos",)
+
+    def __init__(self, path, nodes=None, scale=(0.5, 2.0)):
+        self.path = path
+        self.scale = scale
+        self._reader = DataReader(path, backend="mmap")
+        self.sources = list(nodes or self._reader.nodes)
+
+    def reset(self, n_streams, rng):
+        self.n_streams = n_streams
+        self.rng = rng
+        self._source = [self.sources[i % len(self.sources)] for i in range(n_streams)]
+        self._pos = rng.integers(np.array([len(self._reader[name]) for name in self._source], dtype=np.int64))
+        self._factor = rng.uniform(self.scale[0], self.scale[1], n_streams)
+        self._rows = {name: np.arange(i, n_streams, len(self.sources)) for i, name in enumerate(self.sources[:n_streams])}
+
+    def next(self, length):
+        out = np.empty((self.n_streams, length))
+
+        for name, rows in self._rows.items():
+            trace = self._reader[name]
+            n, pos = len(trace), self._pos[rows]
+            self._pos[rows] = (pos + length) % n
+
+            if hasattr(trace, "view") and length <= self.window_copy_length:
+                # Short blocks: the windows of all the streams replaying the trace (that do not wrap around) are copied
+                # from the memory map at once. Longer blocks are copied faster one slice per stream
+                inside = pos + length <= n
+                out[rows[inside]] = sliding_window_view(trace.view(), length)[pos[inside]]
+                rows, pos = rows[~inside], pos[~inside]
+            for i, start in zip(rows, pos): out[i] = self._read(trace, int(start), length)
+
+        out *= self._factor[:, None]
+        return out
+
+    @staticmethod
+    def _read(trace, pos, length):
+        # Samples [pos, pos + length) of a trace that cannot be memory-mapped, wrapping around at its end
+        parts, n = [], len(trace)
+        while length > 0:
+            parts.append(trace[pos : min(n, pos + length)])
+            length -= len(parts[-1])
+            pos = 0
+        return np.concatenate(parts)
+
+    def models(self):
+        return [self._reader.get_dist_model(name) for name in self._source]
+
+
+class Correlated(TraceProcess):
+    """Correlates the nodes of a process by mixing: each node takes its samples from a stream common to all the nodes
+    with probability sqrt(rho) and from its own stream otherwise. With streams of the same distribution, the samples
+    of two nodes then have the correlation coefficient rho and each node keeps the distribution of the process.
+
+    Args:
+        process (TraceProcess): process of the streams
+        rho (float): pairwise correlation coefficient of the nodes (0 to 1)
+        hold (int): number of consecutive samples taken from the same stream (keeps the runs of the process intact)
+    """
+
+    _state_attrs = ("_t", "_mask")
+
+    def __init__(self, process, rho, hold=1):
+        self.process = process
+        self.rho = rho
+        self.hold = max(1, int(hold))
+
+    def reset(self, n_streams, rng):
+        self.n_streams = n_streams
+        self.rng = rng
+        self.process.reset(n_streams + 1, rng) # stream 0 is the common one
+        self._t = 0
+        self._mask = None
+
+    def next(self, length):
+        block = self.process.next(length)
+
+        # One draw per node and hold period
+        periods = (self._t + np.arange(length)) // self.hold
+        periods -= periods[0]
+        common = self.rng.random((self.n_streams, periods[-1] + 1)) < np.sqrt(self.rho)
+        if self._t % self.hold: common[:, 0] = self._mask # hold period started in the previous block
+        self._mask = common[:, -1].copy()
+        self._t += length
+
+        return np.where(common[:, periods], block[0], block[1:])
+
+    def get_state(self):
+        return dict(super().get_state(), process=self.process.get_state())
+
+    def set_state(self, state):
+        self.process.set_state(state["process"])
+        super().set_state(state)
+
+    def models(self):
+        return self.process.models()[1:]
+
+
+def _block_length(n_streams, block_bytes):
+    return max(1, block_bytes // (8 * n_streams))
+
+
+def write_h5(path, process, n_nodes, n_samples, Ts=1e-5, seed=None, dtype=np.float64, block_bytes=1 << 28):
+    """Streams synthetic traces into an hdf5 file of the format read by 'DataReader' (datasets 'data/nodeX' with a
+    'model' attribute, and 'time'). The traces are stored contiguously, so the simulator can memory-map them.
+
+    Args:
+        path (str): output hdf5 file
+        process (TraceProcess): process of the traces
+        n_nodes (int): number of nodes
+        n_samples (int): number of samples per node
+        Ts (float): sampling interval (in secs)
+        seed (int): seed of the random number generator
+        dtype: data type of the traces (e.g. np.float32 halves the size of the file)
+        block_bytes (int): memory held by one block of all the nodes
+    """
+
+    rng = np.random.default_rng(seed)
+    process.reset(n_nodes, rng)
+    block_length = _block_length(n_nodes, block_bytes)
+
+    with h5py.File(path, "w") as hf:
+        data = hf.create_group("data")
+        datasets = [data.create_dataset(f"node{i}", shape=(n_samples,), dtype=dtype) for i in range(n_nodes)]
+        for ds, model in zip(datasets, process.models()): ds.attrs["model"] = model
+        time = hf.create_dataset("time", shape=(n_samples,), dtype=np.float64, chunks=(min(n_samples, 1 << 16),), compression="gzip")
+
+        for start in range(0, n_samples, block_length):
+            stop = min(n_samples, start + block_length)
+            block = process.next(stop - start)
+            for ds, values in zip(datasets, block): ds[start:stop] = values
+            time[start:stop] = np.arange(start, stop) * Ts
+
+
+class SyntheticTraces(object):
+    """Synthetic traces with the interface of 'DataReader', generated lazily block by block as the nodes read them
+    (the traces are 'SyntheticDataset's). Only the latest 'cache_blocks' blocks of all the nodes are held in memory.
+    The state of the process is saved at the start of every block, so a block that was dropped from the cache is
+    generated again, with the same samples, if a node reads it later.
+
+    Args:
+        process (TraceProcess): process of the traces
+        n_nodes (int): number of nodes
+        n_samples (int): number of samples per node
+        Ts (float): sampling interval (in secs)
+        seed (int): seed of the random number generator
+        dtype: data type of the traces
+        block_bytes (int): memory held by one block of all the nodes
+        cache_blocks (int): number of blocks held in memory
+    """
+
+    def __init__(self, process, n_nodes, n_samples, Ts=1e-5, seed=None, dtype=np.float64, block_bytes=1 << 26, cache_blocks=4):
+        self.Ts = Ts
+        self.nodes = [f"node{i}" for i in range(n_nodes)]
+        self.dtype = np.dtype(dtype)
+        self.n_samples = n_samples
+        self.block_length = _block_length(n_nodes, block_bytes)
+        self.cache_blocks = max(1, cache_blocks)
+
+        self._process = process
+        process.reset(n_nodes, np.random.default_rng(seed))
+        self._models = dict(zip(self.nodes, process.models()))
+
+        self._checkpoints = [process.get_state()]  # state of the process at the start of every block generated so far
+        self._next_block = 0                        # block the process generates next
+        self._blocks = OrderedDict()                # block index -> samples of all the nodes, least recently used first
+        self._lock = threading.Lock()               # nodes of the thread driver read concurrently
+
+        self._datasets = {name: SyntheticDataset(self, i) for i, name in enumerate(self.nodes)}
+
+    def block(self, k):
+        """Samples of all the nodes in block k, shape (n_nodes, block length)."""
+
+        with self._lock:
+            if k in self._blocks:
+                self._blocks.move_to_end(k)
+                return self._blocks[k]
+
+            # Continue from the latest state saved at or before block k
+            start = min(k, len(self._checkpoints) - 1)
+            if start != self._next_block: self._process.set_state(self._checkpoints[start])
+
+            for j in range(start, k + 1):
+                length = min(self.n_samples, (j + 1) * self.block_length) - j * self.block_length
+                values = self._process.next(length).astype(self.dtype, copy=False)
+                if j + 1 == len(self._checkpoints): self._checkpoints.append(self._process.get_state())
+                self._blocks[j] = values
+                self._blocks.move_to_end(j)
+                if len(self._blocks) > self.cache_blocks: self._blocks.popitem(last=False)
+
+            self._next_block = k + 1
+            return values
+
+    @property
+    def time(self):
+        return np.arange(self.n_samples) * self.Ts
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return self._datasets[f"node{key}"]
+        else:
+            return self._datasets[key]
+
+    def __len__(self):
+        return self.n_samples
+
+    def pairs(self):
+        """Returns all unique combinations between the nodes."""
+        return combinations(range(len(self.nodes)), 2)
+
+    def get_dist_model(self, node):
+        return self._models[node]
+
+
+class SyntheticDataset(object):
+    """Trace of one node of 'SyntheticTraces', with the interface of 'StreamedDataset'. Slices inside a block are
+    returned as views of that block.
+
+    Args:
+        traces (SyntheticTraces): traces of all the nodes
+        row (int): index of the node
+    """
+
+    def __init__(self, traces, row):
+        self._traces = traces
+        self._row = row
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1: return np.concatenate([values for _, values in self.iter_chunks(start, stop)])[::step]
+            if start >= stop: return np.empty((0,), dtype=self._traces.dtype)
+
+            parts = [values for _, values in self.iter_chunks(start, stop)]
+            return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+        elif isinstance(key, (int, np.integer)):
+            if key < 0: key += len(self)
+            if not 0 <= key < len(self): raise IndexError("index out of range")
+            offset, block = self.get_block(key)
+            return block[key - offset]
+
+    def __len__(self):
+        return self._traces.n_samples
+
+    def get_block(self, idx):
+        """Returns (offset, values) of the block containing 'idx'."""
+        k = idx // self._traces.block_length
+        return k * self._traces.block_length, self._traces.block(k)[self._row]
+
+    def iter_chunks(self, start=0, stop=None):
+        """Yields (offset, values) blocks of the trace from 'start' to 'stop'."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        while start < stop:
+            offset, block = self.get_block(start)
+            end = min(stop, offset + len(block))
+            yield start, block[start - offset : end - offset]
+            start = end
+
+
+def make_process(kind, **kwargs):
+    """Creates a trace process by name ('markov', 'replay', 'norm', 'exp' or 'gmm'), correlated if kwargs["rho"] > 0."""
+
+    rho, hold = kwargs.pop("rho", 0.0), kwargs.pop("hold", 1)
+    if kind == "markov": process = OnOffMarkov(**kwargs)
+    elif kind == "replay": process = ScaledReplay(**kwargs)
+    elif kind in _model_map: process = ChargingTimeProcess(kind, **kwargs)
+    else: raise ValueError(f"Unknown trace process '{kind}'")
+
+    return Correlated(process, rho, hold) if rho > 0 else process
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic power traces")
+    parser.add_argument("--out", required=True, help="output hdf5 file")
+    parser.add_argument("--n_nodes", type=int, default=10, help="number of nodes")
+    parser.add_argument("--duration", type=float, default=60.0, help="length of the traces (in secs)")
+    parser.add_argument("--Ts", type=float, default=1e-5, help="sampling interval (in secs)")
+    parser.add_argument("--process", default="markov", choices=["markov", "replay", "norm", "exp", "gmm"], help="trace process")
+    parser.add_argument("--rho", type=float, default=0.0, help="pairwise correlation of the nodes")
+    parser.add_argument("--hold", type=int, default=1, help="samples taken from the same stream when correlating")
+    parser.add_argument("--p_on", type=float, default=1e-4, help="markov: probability per sample to switch on")
+    parser.add_argument("--p_off", type=float, default=1e-4, help="markov: probability per sample to switch off")
+    parser.add_argument("--power_on", type=float, default=2e-3, help="markov: power while on (in watts)")
+    parser.add_argument("--noise", type=float, default=0.0, help="markov: relative noise of the power")
+    parser.add_argument("--replay_path", default=None, help="replay: hdf5 file with the recorded traces")
+    parser.add_argument("--scale", type=float, nargs=2, default=(0.5, 2.0), help="replay: range of the scale factors")
+    parser.add_argument("--dtype", default="float64", choices=["float32", "float64"], help="data type of the traces")
+    parser.add_argument("--seed", type=int, default=None, help="random seed")
+    cli_args = parser.parse_args()
+
+    if cli_args.process == "markov": kwargs = dict(p_on=cli_args.p_on, p_off=cli_args.p_off, power_on=cli_args.power_on, noise=cli_args.noise)
+    elif cli_args.process == "replay": kwargs = dict(path=cli_args.replay_path, scale=tuple(cli_args.scale))
+    else: kwargs = dict(Ts=cli_args.Ts)
+
+    process = make_process(cli_args.process, rho=cli_args.rho, hold=cli_args.hold, **kwargs)
+    n_samples = int(round(cli_args.duration / cli_args.Ts))
+    write_h5(cli_args.out, process, cli_args.n_nodes, n_samples, cli_args.Ts, cli_args.seed, np.dtype(cli_args.dtype))
+    print(f"{cli_args.n_nodes} traces of {n_samples} samples written to {cli_args.out}")
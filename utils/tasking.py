@@ -0,0 +1,191 @@
+'''
+Tasks of the nodes and the packets they ferry over Bonito connections.
+
+Tasks are registered with the 'task' decorator (see Battery_Free_Device/tasks.py), with the energy (in joules) and the
+simulated time (in secs) one run of the task costs:
+
+    @task("node0", "node1", energy=5e-6, duration=1e-3)
+    def sense(curr_node):
+        curr_node.produce()
+
+A node runs its task once per charging cycle, before it drains out its energy. The task is skipped if the energy left
+in the node does not cover its cost, and the node stays awake for the duration of the task otherwise. The energy of a
+task is thus paid from energy the node would drain anyway: the cost decides whether the task runs, not when the node
+wakes up next. The nodes count the energy of their tasks and hand-overs ('energy_used') apart from the energy they
+drain ('energy_drained'). Tasks produce
+packets for the sink of the network ('produce'), which are kept in a bounded buffer of the node ('PacketBuffer') and
+handed to the connected neighbour at every successful Bonito connection, at a cost of 'tx_energy' per packet, till
+they reach the sink. A packet is never handed back to a node it already passed through. Packets produced while the
+buffer is full are dropped. The sink records the end-to-end latency of every packet it receives, see 'traffic_summary'
+for the latency, throughput and drop rate of a run.
+'''
+
+import threading
+from contextlib import nullcontext
+from collections import deque
+
+import numpy as np
+
+
+class Task(object):
+    """Task of a node with its cost.
+
+    Args:
+        fn (callable): function of the task, called with the 'BatteryfreeDevice' of the node
+        energy (float): energy consumed by one run of the task (in joules)
+        duration (float): simulated time one run of the task takes (in secs)
+    """
+
+    __slots__ = ("name", "fn", "energy", "duration")
+
+    def __init__(self, fn, energy=0.0, duration=0.0):
+        self.name = fn.__name__
+        self.fn = fn
+        self.energy = energy
+        self.duration = duration
+
+    def __call__(self, node):
+        return self.fn(node)
+
+    def __repr__(self):
+        return f"Task({self.name!r}, energy={self.energy}, duration={self.duration})"
+
+
+tasks = {}          # Registered tasks by name
+task_mapping = {}   # Name of the node -> 'Task' it runs by default
+
+
+def task(*nodes, energy=0.0, duration=0.0):
+    """Registers a task (decorator). The task runs on the given nodes by default, other nodes can be assigned to it by
+    name (args["tasks"] of 'utils.simulation.simulate').
+
+    Args:
+        *nodes (str): names of the nodes running the task by default
+        energy (float): energy consumed by one run of the task (in joules)
+        duration (float): simulated time one run of the task takes (in secs)
+    """
+
+    def register(fn):
+        registered = Task(fn, energy, duration)
+        tasks[registered.name] = registered
+        for name in nodes: task_mapping[name] = registered
+        return fn
+    return register
+
+
+def get_task(node, assigned=None):
+    """Task of a node: the one assigned to it by name, or else the one it runs by default (None if it has none).
+
+    Args:
+        node (str): name of the node
+        assigned (dict): name of the node -> name of the registered task
+    """
+
+    if assigned and node in assigned:
+        if assigned[node] not in tasks: raise ValueError(f"Unknown task '{assigned[node]}' of node '{node}', registered tasks: {', '.join(sorted(tasks))}")
+        return tasks[assigned[node]]
+    return task_mapping.get(node)
+
+
+class Packet(object):
+    """Packet ferried towards its destination.
+
+    Args:
+        src (str): name of the node that produced the packet
+        dst (str): name of the destination node
+        created (int): iteration at which the packet was produced
+    """
+
+    __slots__ = ("src", "dst", "created", "route")
+
+    def __init__(self, src, dst, created):
+        self.src = src
+        self.dst = dst
+        self.created = created
+        self.route = [src]  # Nodes the packet passed through
+
+    @property
+    def hops(self):
+        return len(self.route) - 1
+
+
+_no_lock = nullcontext() # Buffers of nodes driven by the single-threaded scheduler
+
+
+class PacketBuffer(object):
+    """Bounded FIFO buffer of packets, shared between a node and its neighbours. The queue is only allocated once the
+    first packet arrives, as most nodes of a large network never hold one.
+
+    Args:
+        capacity (int): maximum no. of packets
+        threadsafe (bool): whether the buffer is accessed by the threads of several nodes (thread driver)
+    """
+
+    __slots__ = ("capacity", "_packets", "_lock")
+
+    def __init__(self, capacity, threadsafe=True):
+        self.capacity = capacity
+        self._packets = None
+        self._lock = threading.Lock() if threadsafe else _no_lock
+
+    def __len__(self):
+        return len(self._packets) if self._packets is not None else 0
+
+    def put(self, packet):
+        """Appends a packet. Returns False (and drops the packet) if the buffer is full."""
+
+        with self._lock:
+            if self._packets is None: self._packets = deque()
+            if len(self._packets) >= self.capacity: return False
+            self._packets.append(packet)
+            return True
+
+    def take(self, accept):
+        """Takes the oldest packet for which accept(packet) is True out of the buffer (None if there is none)."""
+
+        with self._lock:
+            for i, packet in enumerate(self._packets or ()):
+                if accept(packet):
+                    del self._packets[i]
+                    return packet
+        return None
+
+    def put_back(self, packet):
+        """Returns a packet taken out of the buffer to its front (e.g. if it could not be handed over)."""
+
+        with self._lock:
+            if self._packets is None: self._packets = deque()
+            self._packets.appendleft(packet)
+
+    def clear(self):
+        with self._lock:
+            self._packets = None
+
+
+def traffic_summary(sim_nodes, sim_secs):
+    """Network-wide results of the packets of a run.
+
+    Args:
+        sim_nodes (iterable): 'BatteryfreeDevice' objects of the run
+        sim_secs (float): simulated time of the run (in secs)
+
+    Returns:
+        (dict): no. of packets generated, delivered, dropped and still buffered, the drop rate, the throughput (packets delivered per sec) and the median, mean and 95th percentile of the end-to-end latency (in secs)
+    """
+
+    sim_nodes = list(sim_nodes)
+    generated = sum(node.packets_generated for node in sim_nodes)
+    dropped = sum(node.packets_dropped for node in sim_nodes)
+    latencies = np.concatenate([np.asarray(node.latencies, dtype=np.float64) for node in sim_nodes]) if sim_nodes else np.zeros((0,))
+
+    return {
+        "generated": generated,
+        "delivered": len(latencies),
+        "dropped": dropped,
+        "buffered": sum(len(node.buffer) for node in sim_nodes),
+        "drop_rate": dropped / generated if generated else float("nan"),
+        "throughput": len(latencies) / sim_secs if sim_secs > 0 else float("nan"),
+        "latency_median": float(np.median(latencies)) if len(latencies) else float("nan"),
+        "latency_mean": float(np.mean(latencies)) if len(latencies) else float("nan"),
+        "latency_p95": float(np.percentile(latencies, 95)) if len(latencies) else float("nan"),
+    }
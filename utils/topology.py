@@ -0,0 +1,232 @@
+'''
+Topologies of many-to-many Bonito connections.
+
+Instead of one fixed partner, a node holds a set of links to its neighbours. Every link keeps its own Bonito state per
+endpoint ('LinkEnd'): the protocol state on the link, the iteration of its next connection, its connection intervals
+and the model of the partner learned at the latest connection. A node serves one link at a time, as in the pairwise
+protocol, and its 'LinkScheduler' picks the link to serve next:
+
+- links in the 'Bonito' state are due at their next connection (latest connection + connection interval)
+- links in the 'Find' state (not discovered yet, or lost) are expected to connect one charging cycle from now at the
+  earliest, and take turns in the order they were last served
+
+and the link with the earliest predicted connection wins. Links are plain objects with a 'Rendezvous' created on first
+use, so dense meshes need neither threads nor barriers per pair.
+
+    topology = Topology.from_edges([("node0", "node1"), ("node0", "node2"), ("node1", "node2")])
+    topology.apply(nodes)
+'''
+
+import copy
+import heapq
+import itertools
+import numpy as np
+from collections import defaultdict
+
+from utils.scheduler import Rendezvous
+from utils.utils import node_index
+
+
+class LinkEnd(object):
+    """Bonito state of a link as seen by one of its endpoints."""
+
+    __slots__ = ("state", "due", "conn_no", "connections", "conn_ints", "partner_model")
+
+    def __init__(self):
+        self.state = "Find"         # Protocol state of the endpoint on the link, 'Find' or 'Bonito'
+        self.due = -1               # Iteration of the next connection (while in 'Bonito' state)
+        self.conn_no = 0            # Connection no. since the link was (re)discovered
+        self.connections = 0        # No. of successful connections
+        self.conn_ints = []         # Connection intervals generated (in secs)
+        self.partner_model = None   # Charging time model of the partner learned at the latest connection
+
+
+class Link(object):
+    """Link between two neighbouring nodes.
+
+    Args:
+        a (str): name of the first node
+        b (str): name of the second node
+    """
+
+    __slots__ = ("nodes", "ends", "_rendezvous")
+
+    def __init__(self, a, b):
+        self.nodes = (a, b)
+        self.ends = {a: LinkEnd(), b: LinkEnd()}
+        self._rendezvous = None
+
+    @property
+    def rendezvous(self):
+        """Rendezvous of the handshakes on the link (created on first use)."""
+        if self._rendezvous is None: self._rendezvous = Rendezvous(2)
+        return self._rendezvous
+
+    def other(self, name):
+        """Name of the neighbour of a node on the link."""
+        return self.nodes[1] if name == self.nodes[0] else self.nodes[0]
+
+    def end(self, name):
+        return self.ends[name]
+
+    def connected(self, name, iteration, conn_int, next_iteration):
+        """Records a connection of one endpoint.
+
+        Args:
+            name (str): name of the endpoint
+            iteration (int): iteration of the connection
+            conn_int (float): connection interval computed at the connection (in secs)
+            next_iteration (int): iteration of the next connection
+        """
+
+        end = self.ends[name]
+        end.connections += 1
+        end.conn_ints.append(conn_int)
+        end.due = next_iteration
+
+    def learn(self, name, model):
+        """Stores a snapshot of the charging time model of the partner of an endpoint (exchanged while connected) and
+        returns it."""
+
+        snapshot = copy.copy(model)
+        snapshot._mp = np.copy(model._mp)
+        self.ends[name].partner_model = snapshot
+        return snapshot
+
+    def __repr__(self):
+        return f"Link({self.nodes[0]!r}, {self.nodes[1]!r})"
+
+
+class LinkScheduler(object):
+    """Picks the link a node serves next, by earliest predicted connection. The links not being served wait in two
+    heaps: the ones in 'Bonito' state keyed on their next connection, the ones in 'Find' state on the iteration they
+    were last served at.
+
+    Args:
+        name (str): name of the node
+        links (iterable): links of the node
+    """
+
+    def __init__(self, name, links):
+        self.name = name
+        self._bonito = []
+        self._find = []
+        self._counter = itertools.count()
+        for link in links: self.update(link, -1)
+
+    def __len__(self):
+        return len(self._bonito) + len(self._find)
+
+    def update(self, link, iteration):
+        """Queues a link that is not served anymore.
+
+        Args:
+            link (Link): link of the node
+            iteration (int): current iteration
+        """
+
+        end = link.ends[self.name]
+        if end.state == "Bonito": heapq.heappush(self._bonito, (end.due, next(self._counter), link))
+        else: heapq.heappush(self._find, (iteration, next(self._counter), link))
+
+    def next(self, iteration, charge_slots):
+        """Takes the link to serve next out of the queues.
+
+        Args:
+            iteration (int): current iteration
+            charge_slots (int): expected charging time of the node (in iterations)
+
+        Returns:
+            Link: link with the earliest predicted connection
+        """
+
+        if self._bonito and (not self._find or self._bonito[0][0] <= iteration + charge_slots):
+            return heapq.heappop(self._bonito)[2]
+        return heapq.heappop(self._find)[2]
+
+
+class Topology(object):
+    """Links between the nodes of a simulation."""
+
+    def __init__(self):
+        self.links = {}                         # (name, name) in node order -> Link
+        self.neighbours = defaultdict(dict)     # name -> name of the neighbour -> Link
+
+    @staticmethod
+    def _key(a, b):
+        return (a, b) if node_index(a) <= node_index(b) else (b, a)
+
+    def add_link(self, a, b):
+        """Adds a link between two nodes (if there is none yet) and returns it."""
+
+        if a == b: raise ValueError(f"Node '{a}' cannot be linked to itself")
+        key = self._key(a, b)
+        link = self.links.get(key)
+        if link is None:
+            link = self.links[key] = Link(*key)
+            self.neighbours[a][b] = link
+            self.neighbours[b][a] = link
+        return link
+
+    @classmethod
+    def from_edges(cls, edges):
+        """Topology of the given pairs of node names."""
+
+        topology = cls()
+        for a, b in edges: topology.add_link(a, b)
+        return topology
+
+    @classmethod
+    def mesh(cls, names):
+        """Fully connected topology of the given nodes."""
+        return cls.from_edges(itertools.combinations(names, 2))
+
+    @classmethod
+    def parse(cls, neighbours):
+        """Topology from the neighbours of every node as text, e.g. {"node0": "1, 2", "node1": "2"} (as entered in the
+        simulator GUI). Empty entries are skipped."""
+
+        topology = cls()
+        for name, text in neighbours.items():
+            for item in text.replace(";", ",").split(","):
+                item = item.strip()
+                if item: topology.add_link(name, item if item.startswith("node") else f"node{item}")
+        return topology
+
+    def __len__(self):
+        return len(self.links)
+
+    def __iter__(self):
+        return iter(self.links.values())
+
+    def links_of(self, name):
+        """Links of a node."""
+        return list(self.neighbours.get(name, {}).values())
+
+    def apply(self, nodes):
+        """Hands every node of the topology its links (see 'BatteryfreeDevice.setLinks').
+
+        Args:
+            nodes (dict): 'BatteryfreeDevice' objects by name
+        """
+
+        for name in sorted(self.neighbours, key=node_index):
+            nodes[name].setLinks(self.links_of(name))
+        for name in self.neighbours:
+            nodes[name].target_is_set = True
+
+    def summary(self):
+        """Results of every link.
+
+        Returns:
+            (dict): arrays of the names of the endpoints, the no. of successful connections and the median connection interval of every link
+        """
+
+        links = list(self)
+        ends = [link.ends[link.nodes[0]] for link in links]
+        return {
+            "a": np.array([link.nodes[0] for link in links], dtype=object),
+            "b": np.array([link.nodes[1] for link in links], dtype=object),
+            "connections": np.array([end.connections for end in ends], dtype=np.int64),
+            "delay": np.array([np.median(end.conn_ints) if end.conn_ints else np.nan for end in ends], dtype=np.float64),
+        }
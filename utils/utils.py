@@ -1,6 +1,14 @@
+import re
 import h5py
 import math
+import warnings
+import threading
+import numpy as np
 from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.rle import RunLengthDataset
+from utils import profiling
 
 def roundup_duration_to_simulation_timestep(duration, timestep):
     return timestep * math.ceil(duration/timestep)
@@ -15,6 +23,33 @@ def slots_to_secs(slots, slot_length, timestep):
 def secs_to_slots(duration, slot_length):
     return math.ceil(duration / slot_length)
 
+def node_index(name):
+    # Integer id of a node from its name, e.g. 'node12' -> 12
+    return int(re.search(r"(\d+)$", name).group(1))
+
+class MemoryBudget(object):
+    """Thread-safe byte counter limiting the memory held by blocks that were read ahead.
+
+    Args:
+        max_bytes: maximum number of bytes that can be reserved at the same time (None for no limit)
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, n_bytes):
+        """Reserves 'n_bytes' if they fit in the budget. Returns whether the reservation succeeded."""
+        with self._lock:
+            if self.max_bytes is not None and self.used + n_bytes > self.max_bytes: return False
+            self.used += n_bytes
+            return True
+
+    def release(self, n_bytes):
+        with self._lock:
+            self.used -= n_bytes
+
 class CachedDataset(object):
     """Wrapper around default h5py Dataset that accelerates single index access to the data.
 
@@ -23,30 +58,85 @@ class CachedDataset(object):
     a gain. Instead, this class implements a simple cached dataset, where data is read into memory in blocks
     and single index access reads from that cache.
 
+    Optionally, the following blocks are read ahead by a background thread while the current block is consumed, so that
+    crossing a block boundary does not stall the caller on the hdf5 read.
+
     Args:
         dataset: underlying hdf5 dataset
         cache_size: number of values to be held in memory
+        prefetch: number of blocks read ahead (0 disables read-ahead)
+        budget: 'MemoryBudget' shared with other datasets that limits the memory held by blocks read ahead
+        reader: executor the blocks are read ahead on, shared with other datasets (default: a thread of its own, created when needed)
     """
 
-    def __init__(self, dataset: h5py.Dataset, cache_size: int = 10_000_000):
+    def __init__(self, dataset: h5py.Dataset, cache_size: int = 10_000_000, prefetch: int = 0, budget: MemoryBudget = None, reader: ThreadPoolExecutor = None):
         self._ds = dataset
         self._istart = 0
         self._iend = -1
         self._cache_size = cache_size
 
+        self._prefetch = prefetch
+        self._budget = budget if budget is not None else MemoryBudget()
+        self._pending = {} # block index -> (future of the values, reserved bytes)
+        self._reader = reader if reader is not None or prefetch == 0 else ThreadPoolExecutor(max_workers=1)
+
     def __getitem__(self, key):
         if isinstance(key, slice):
-            return self._ds[key]
+            start, stop, step = key.indices(len(self))
+            if step != 1 or start >= stop: return self._ds[key]
+
+            parts = []
+            while start < stop:
+                if not (start >= self._istart and start < self._iend): self.update_cache(start)
+                end = min(stop, self._iend)
+                parts.append(self._buf[start - self._istart : end - self._istart])
+                start = end
+
+            return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
         elif isinstance(key, int):
             return self.get_cached(key)
 
     def __len__(self):
         return len(self._ds)
 
+    def _read(self, k):
+        return self._ds[k * self._cache_size : min(len(self._ds), (k + 1) * self._cache_size)]
+
+    def _release(self, n_bytes, future):
+        if future.cancel(): self._budget.release(n_bytes)
+        else: future.add_done_callback(lambda _: self._budget.release(n_bytes))
+
+    def read_ahead(self, k):
+        """Starts reading the blocks following block 'k' in the background (as far as the memory budget allows) and drops the blocks read ahead that are not needed anymore."""
+        for j in list(self._pending):
+            if j <= k or j > k + self._prefetch:
+                future, n_bytes = self._pending.pop(j)
+                self._release(n_bytes, future)
+
+        n_blocks = math.ceil(len(self._ds) / self._cache_size)
+        for j in range(k + 1, min(n_blocks, k + 1 + self._prefetch)):
+            if j in self._pending: continue
+
+            n_bytes = (min(len(self._ds), (j + 1) * self._cache_size) - j * self._cache_size) * self._ds.dtype.itemsize
+            if not self._budget.reserve(n_bytes): break
+            self._pending[j] = (self._reader.submit(self._read, j), n_bytes)
+
     def update_cache(self, idx):
-        self._istart = (idx // self._cache_size) * self._cache_size
+        k = idx // self._cache_size
+        self._istart = k * self._cache_size
         self._iend = min(len(self._ds), self._istart + self._cache_size)
-        self._buf = self._ds[self._istart : self._iend]
+
+        if k in self._pending:
+            future, n_bytes = self._pending.pop(k)
+            self._buf = future.result()
+            self._budget.release(n_bytes)
+            if profiling.active: profiling.active.count("cache_prefetched")
+        else:
+            self._buf = self._read(k)
+            if profiling.active: profiling.active.count("cache_misses")
+
+        if self._prefetch > 0: self.read_ahead(k)
 
     def get_cached(self, idx):
         if idx >= self._istart and idx < self._iend:
@@ -55,20 +145,195 @@ class CachedDataset(object):
             self.update_cache(idx)
             return self.get_cached(idx)
 
+class MappedDataset(object):
+    """Zero-copy access to a contiguous, uncompressed hdf5 dataset.
+
+    The raw data of such a dataset is stored in one piece in the hdf5 file, so it can be memory-mapped with numpy
+    directly. Slicing returns views of the memory map and the operating system pages the data in on demand.
+
+    Args:
+        path: path of the hdf5 file
+        dataset: underlying hdf5 dataset
+        block_size: number of values per block yielded by 'iter_chunks'
+    """
+
+    def __init__(self, path, dataset: h5py.Dataset, block_size: int = 10_000_000):
+        self._arr = np.memmap(path, dtype=dataset.dtype, mode="r", offset=dataset.id.get_offset(), shape=dataset.shape)
+        self._block_size = block_size
+
+    @staticmethod
+    def supported(dataset: h5py.Dataset):
+        """Whether the raw data of the dataset is stored contiguously and uncompressed in the file."""
+        return dataset.chunks is None and dataset.compression is None and dataset.id.get_offset() is not None
+
+    def __getitem__(self, key):
+        return self._arr[key]
+
+    def __len__(self):
+        return len(self._arr)
+
+    def view(self):
+        """Returns the whole trace as a (read-only) numpy array."""
+        return self._arr
+
+    def iter_chunks(self, start=0, stop=None):
+        """Yields (offset, values) blocks of the trace from 'start' to 'stop'."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        for offset in range(start, stop, self._block_size):
+            yield offset, self._arr[offset : min(stop, offset + self._block_size)]
+
+class ArrayDataset(MappedDataset):
+    """In-memory trace with the interface of 'MappedDataset'.
+
+    Args:
+        array: values of the trace (1-D numpy array)
+        block_size: number of values per block yielded by 'iter_chunks'
+    """
+
+    def __init__(self, array: np.ndarray, block_size: int = 10_000_000):
+        self._arr = array
+        self._block_size = block_size
+
+class StreamedDataset(object):
+    """Double-buffered access to a chunked or compressed hdf5 dataset, which cannot be memory-mapped.
+
+    The dataset is read in blocks made of whole hdf5 chunks. While one block is consumed, the next one is already read
+    (and decompressed) by a background thread. Slices inside a block are returned as views of that block.
+
+    Args:
+        dataset: underlying hdf5 dataset
+        block_size: approximate number of values per block (rounded to whole hdf5 chunks)
+        reader: executor the next block is read on, shared with other datasets (default: a thread of its own)
+    """
+
+    def __init__(self, dataset: h5py.Dataset, block_size: int = 10_000_000, reader: ThreadPoolExecutor = None):
+        self._ds = dataset
+        chunk = dataset.chunks[0] if dataset.chunks else block_size
+        self._block_size = max(1, block_size // chunk) * chunk
+
+        self._current = None    # (block index, values)
+        self._next = None       # (block index, future of the values)
+        self._reader = reader if reader is not None else ThreadPoolExecutor(max_workers=1)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1: return self._ds[key]
+            if start >= stop: return np.empty((0,), dtype=self._ds.dtype)
+
+            parts = []
+            while start < stop:
+                offset, block = self.get_block(start)
+                end = min(stop, offset + len(block))
+                parts.append(block[start - offset : end - offset])
+                start = end
+
+            return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+        elif isinstance(key, (int, np.integer)):
+            offset, block = self.get_block(key)
+            return block[key - offset]
+
+    def __len__(self):
+        return len(self._ds)
+
+    def _read(self, k):
+        return self._ds[k * self._block_size : min(len(self._ds), (k + 1) * self._block_size)]
+
+    def get_block(self, idx):
+        """Returns (offset, values) of the block containing 'idx' and starts reading the following block."""
+        k = idx // self._block_size
+
+        if self._current is None or self._current[0] != k:
+            if self._next is not None and self._next[0] == k:
+                self._current = (k, self._next[1].result())
+            else:
+                self._current = (k, self._read(k))
+
+            # Read the following block in the background
+            if (k + 1) * self._block_size < len(self._ds):
+                self._next = (k + 1, self._reader.submit(self._read, k + 1))
+            else:
+                self._next = None
+
+        return k * self._block_size, self._current[1]
+
+    def iter_chunks(self, start=0, stop=None):
+        """Yields (offset, values) blocks of the trace from 'start' to 'stop'. The next block is read while the current one is consumed."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        while start < stop:
+            offset, block = self.get_block(start)
+            end = min(stop, offset + len(block))
+            yield start, block[start - offset : end - offset]
+            start = end
+
 class DataReader(object):
-    """Convenient and cached access to an hdf5 database with power traces from multiple nodes."""
+    """Convenient and cached access to an hdf5 database with power traces from multiple nodes.
+
+    Args:
+        path: path of the hdf5 file
+        cache_size: number of values held in memory per node (block size of the cached and streamed backends)
+        backend: 'cached' wraps every trace in a 'CachedDataset'. 'mmap' memory-maps every contiguous, uncompressed
+                 trace ('MappedDataset') and streams the others with double buffering ('StreamedDataset').
+                 'rle' reads the run-length segments of every compacted trace ('RunLengthDataset', see utils/rle.py)
+                 and memory-maps the others.
+        prefetch: number of blocks every 'CachedDataset' reads ahead in the background (0 disables read-ahead). Only the
+                  'cached' backend reads ahead this way ('mmap' leaves it to the operating system and streams
+                  chunked traces with double buffering), other backends warn and ignore it
+        max_prefetch_bytes: memory cap for the blocks read ahead by all the traces of this reader (None for no cap)
+    """
 
-    def __init__(self, path, cache_size=10_000_000):
+    def __init__(self, path, cache_size=10_000_000, backend="cached", prefetch=0, max_prefetch_bytes=None):
         self.path = path
         self.cache_size = cache_size
+        self.backend = backend
+        self.prefetch = prefetch
+        self.budget = MemoryBudget(max_prefetch_bytes)
         self._datasets = dict()
+        self._reader = None # Background reads of all the traces (see 'reader')
+
+        if prefetch > 0 and backend != "cached": warnings.warn(f"prefetch={prefetch} is ignored by the '{backend}' trace backend (read-ahead needs backend='cached')")
 
         self._hf = h5py.File(self.path, "r")
         self.nodes = list(self._hf["data"].keys())
 
         self.time = self._hf["time"]
         for node in self._hf["data"].keys():
-            self._datasets[node] = CachedDataset(self._hf["data"][node], self.cache_size)
+            self._datasets[node] = self._open(self._hf["data"][node])
+
+    def _open(self, dataset):
+        if self.backend == "rle":
+            node = dataset.name.split("/")[-1]
+            if "rle" in self._hf and node in self._hf["rle"]: return RunLengthDataset.from_group(self._hf["rle"][node])
+
+        if self.backend in ("mmap", "rle"):
+            if MappedDataset.supported(dataset): return MappedDataset(self.path, dataset, self.cache_size)
+            return StreamedDataset(dataset, self.cache_size, self.reader)
+
+        elif self.backend == "cached":
+            return CachedDataset(dataset, self.cache_size, self.prefetch, self.budget, self.reader if self.prefetch > 0 else None)
+
+        raise ValueError(f"Unknown trace backend '{self.backend}'")
+
+    @property
+    def reader(self):
+        """Executor shared by the traces for their background reads, one thread for all of them (h5py serializes the
+        reads of a file anyway). Created on first use."""
+        if self._reader is None: self._reader = ThreadPoolExecutor(max_workers=1)
+        return self._reader
+
+    def close(self):
+        """Stops the background reads and closes the hdf5 file."""
+        if self._reader is not None:
+            self._reader.shutdown(wait=True, cancel_futures=True)
+            self._reader = None
+        self._hf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def __getitem__(self, key):
         if isinstance(key, int):